@@ -0,0 +1,38 @@
+"""Micro-benchmark for resolving the configured backend parser.
+
+Compares re-resolving the backend on every request (the previous behaviour
+of get_backend_instance) with the shared, cached instance.
+
+    $ python benchmarks/bench_backends.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+
+from inbound_email.backends import get_backend_class, get_backend_instance  # noqa: E402
+
+ITERATIONS = 100000
+
+
+def uncached():
+    return get_backend_class()()
+
+
+def main():
+    settings.INBOUND_EMAIL_PARSER = 'inbound_email.backends.sendgrid.SendGridRequestParser'
+    for func in (uncached, get_backend_instance):
+        elapsed = timeit.timeit(func, number=ITERATIONS)
+        print("%-24s %8.3f us/call" % (func.__name__, elapsed / ITERATIONS * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Benchmark for detecting and decoding unflagged base64 Mandrill attachments.
+
+Compares the previous regex check over the whole string followed by a
+separate b64decode with the sampled check and single-pass validating decode.
+
+    $ python benchmarks/bench_mandrill_base64.py
+"""
+import base64
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from inbound_email.backends.mandrill import _decode_base64  # noqa: E402
+
+
+def regex_then_decode(s):
+    if (len(s) % 4 == 0) and re.match('^[A-Za-z0-9+/]+[=]{0,2}$', s):
+        return base64.b64decode(s)
+    return s
+
+
+def main():
+    for size in (10 * 2 ** 10, 2 ** 20, 10 * 2 ** 20):
+        encoded = base64.b64encode(os.urandom(size)).decode()
+        # plain text that passes the length check, but isn't base64
+        text = ('Hello, world. ' * (size // 14 + 1))[:len(encoded)]
+        print("%5dKB attachment" % (size // 2 ** 10))
+        number = max(1, 2 ** 22 // size)
+        for func in (regex_then_decode, _decode_base64):
+            for label, content in (('base64', encoded), ('text', text)):
+                elapsed = timeit.timeit(lambda: func(content), number=number)
+                print("  %-18s %-7s %10.3f ms" % (func.__name__, label, elapsed / number * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Memory benchmark for checking Mandrill signatures on large batches.
+
+Compares peak memory (tracemalloc) and time of building a single string from
+the whole request (the previous behaviour) with feeding the params into the
+HMAC incrementally.
+
+    $ python benchmarks/bench_mandrill_signature.py [size in MB]
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.test.client import RequestFactory  # noqa: E402
+
+from inbound_email.backends.mandrill import (  # noqa: E402
+    MandrillSignatureMismatchError,
+    _check_mandrill_signature,
+)
+from inbound_email.tests.test_files.mandrill_post import post_data_json  # noqa: E402
+
+KEY = 'mandrill_key'
+
+
+def concatenated(request, key):
+    url = request.build_absolute_uri()
+    params = sorted(request.POST.items(), key=lambda x: x[0])
+    message = url + ''.join(key + value for key, value in params)
+    signed_binary = hmac.new(key.encode('utf-8'), message.encode('utf-8'), hashlib.sha1)
+    return base64.b64encode(signed_binary.digest()).decode('utf-8')
+
+
+def incremental(request, key):
+    try:
+        _check_mandrill_signature(request, key)
+    except MandrillSignatureMismatchError as ex:
+        return ex.calculated_signature
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    settings.DATA_UPLOAD_MAX_MEMORY_SIZE = None
+    settings.ALLOWED_HOSTS = ['testserver']
+    events = json.loads(json.dumps(post_data_json))
+    events[0]['msg']['attachments'] = {
+        'big.bin': {
+            'name': 'big.bin',
+            'type': 'application/octet-stream',
+            'base64': True,
+            'content': base64.b64encode(os.urandom(size * 2 ** 20 * 3 // 4)).decode(),
+        }
+    }
+    request = RequestFactory().post('/inbound/', data={'mandrill_events': json.dumps(events)})
+    request.POST
+    print("mandrill_events: %.1fMB" % (len(request.POST['mandrill_events']) / 2 ** 20))
+
+    results = set()
+    for func in (concatenated, incremental):
+        tracemalloc.start()
+        start = time.perf_counter()
+        results.add(func(request, KEY))
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("%-14s peak %7.1fMB  %7.1fms" % (func.__name__, peak / 2 ** 20, elapsed * 1000))
+    assert len(results) == 1, "signatures do not match"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Micro-benchmark for decoding SendGrid POST fields.
+
+Compares parsing the 'charsets' JSON once per field (the previous behaviour)
+with the per-request _POSTDecoder.
+
+    $ python benchmarks/bench_sendgrid_charsets.py
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.test.client import RequestFactory  # noqa: E402
+from django.utils.encoding import smart_text  # noqa: E402
+
+from inbound_email.backends.sendgrid import _POSTDecoder  # noqa: E402
+from inbound_email.tests.test_files.sendgrid_post import test_inbound_payload  # noqa: E402
+
+ITERATIONS = 20000
+FIELDS = (
+    ('from', None), ('to', None), ('cc', ''), ('bcc', ''),
+    ('subject', None), ('text', ''), ('html', ''),
+)
+
+
+def decode_per_field(request):
+    for field_name, default in FIELDS:
+        value = request.POST.get(field_name, default)
+        charsets = json.loads(request.POST.get('charsets', "{}"))
+        charset = charsets.get(field_name, 'utf-8')
+        charset.lower() != 'utf-8'
+        smart_text(value, encoding=charset)
+
+
+def decode_per_request(request):
+    decoder = _POSTDecoder(request)
+    for field_name, default in FIELDS:
+        decoder.decode(field_name, default=default)
+
+
+def main():
+    request = RequestFactory().post('/inbound/', data=test_inbound_payload)
+    request.POST
+    for func in (decode_per_field, decode_per_request):
+        elapsed = timeit.timeit(lambda: func(request), number=ITERATIONS)
+        print("%-20s %8.3f us/message" % (func.__name__, elapsed / ITERATIONS * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""End-to-end benchmark of receive_inbound_email for each backend.
+
+Replays the test fixtures (tests/test_files) through the view via
+RequestFactory, scaled up by the number of messages per request (Mandrill
+batches only), the attachment size and the number of recipients, and reports
+throughput, p50/p99 latency and peak memory (tracemalloc, measured in a
+separate pass as tracing slows everything down).
+
+    $ python benchmarks/bench_view.py
+    $ python benchmarks/bench_view.py --backend mandrill --messages 1 50 --attachment-size 1024
+    $ python benchmarks/bench_view.py --save before.json
+    $ python benchmarks/bench_view.py --compare before.json
+
+With --compare, the change in p50 latency and peak memory from the saved run
+is shown for each scenario, so regressions are easy to spot.
+"""
+import argparse
+import base64
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.test.client import MULTIPART_CONTENT, RequestFactory, encode_multipart  # noqa: E402
+from django.core.files.uploadedfile import SimpleUploadedFile  # noqa: E402
+
+from inbound_email.signals import email_received  # noqa: E402
+from inbound_email.views import receive_inbound_email  # noqa: E402
+from inbound_email.tests.test_files.mailgun_post import test_inbound_payload as mailgun_post  # noqa: E402
+from inbound_email.tests.test_files.mandrill_post import post_data_json as mandrill_post  # noqa: E402
+from inbound_email.tests.test_files.sendgrid_post import test_inbound_payload as sendgrid_post  # noqa: E402
+from inbound_email.tests.test_files.sendgrid_post_windows_1252 import (  # noqa: E402
+    test_inbound_payload_1252 as sendgrid_1252_post,
+)
+
+URL = '/inbound/'
+BOUNDARY = 'BenchmarkBoundary'
+
+PARSERS = {
+    'mailgun': 'inbound_email.backends.mailgun.MailgunRequestParser',
+    'mandrill': 'inbound_email.backends.mandrill.MandrillRequestParser',
+    'sendgrid': 'inbound_email.backends.sendgrid.SendGridRequestParser',
+    'sendgrid_1252': 'inbound_email.backends.sendgrid.SendGridRequestParser',
+}
+
+
+def _recipients(count):
+    return ['recipient%s@example.com' % i for i in range(count)]
+
+
+def _attachment(size):
+    # random bytes, so the content can't be compressed or interned
+    return os.urandom(size)
+
+
+def _multipart_body(data):
+    return encode_multipart(BOUNDARY, data)
+
+
+def mailgun_body(messages, attachment_size, recipients):
+    data = dict(mailgun_post)
+    data['recipient'] = ','.join(_recipients(recipients))
+    if attachment_size:
+        data['attachment-1'] = SimpleUploadedFile(
+            'attachment.bin', _attachment(attachment_size), 'application/octet-stream'
+        )
+    return _multipart_body(data)
+
+
+def sendgrid_body(messages, attachment_size, recipients, payload=sendgrid_post):
+    data = dict(payload)
+    data['to'] = ', '.join('<%s>' % r for r in _recipients(recipients))
+    if attachment_size:
+        data['attachment1'] = SimpleUploadedFile(
+            'attachment.bin', _attachment(attachment_size), 'application/octet-stream'
+        )
+    return _multipart_body(data)
+
+
+def sendgrid_1252_body(messages, attachment_size, recipients):
+    return sendgrid_body(messages, attachment_size, recipients, payload=sendgrid_1252_post)
+
+
+def mandrill_body(messages, attachment_size, recipients):
+    event = json.loads(json.dumps(mandrill_post[0]))
+    event['msg']['to'] = [[r, 'Recipient'] for r in _recipients(recipients)]
+    event['msg']['attachments'] = {}
+    if attachment_size:
+        event['msg']['attachments']['attachment.bin'] = {
+            'name': 'attachment.bin',
+            'type': 'application/octet-stream',
+            'base64': True,
+            'content': base64.b64encode(_attachment(attachment_size)).decode(),
+        }
+    events = []
+    for i in range(messages):
+        event = dict(event, msg=dict(event['msg'], headers={'Message-Id': '<%s@example.com>' % i}))
+        events.append(event)
+    return _multipart_body({'mandrill_events': json.dumps(events)})
+
+
+BODIES = {
+    'mailgun': mailgun_body,
+    'mandrill': mandrill_body,
+    'sendgrid': sendgrid_body,
+    'sendgrid_1252': sendgrid_1252_body,
+}
+
+
+def _request(factory, body):
+    return factory.generic(
+        'POST', URL, data=body, content_type='%s; boundary=%s' % (MULTIPART_CONTENT, BOUNDARY)
+    )
+
+
+def run_scenario(backend, messages, attachment_size, recipients, iterations):
+    """Time `iterations` requests through the view; return a dict of results."""
+    settings.INBOUND_EMAIL_PARSER = PARSERS[backend]
+    factory = RequestFactory()
+    body = BODIES[backend](messages, attachment_size, recipients)
+    received = []
+
+    def on_email_received(sender, email, **kwargs):
+        # read the attachments, as a receiver would
+        for attachment in email.attachments:
+            attachment[1]
+        received.append(1)
+
+    email_received.connect(on_email_received)
+    try:
+        # warm up (imports, caches) before timing anything
+        receive_inbound_email(_request(factory, body))
+
+        del received[:]
+        timings = []
+        for _ in range(iterations):
+            request = _request(factory, body)
+            start = time.perf_counter()
+            response = receive_inbound_email(request)
+            timings.append(time.perf_counter() - start)
+            assert b"Successfully parsed" in response.content, response.content
+        emails = len(received)
+
+        # peak memory is measured separately, as tracemalloc is slow
+        tracemalloc.start()
+        receive_inbound_email(_request(factory, body))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        email_received.disconnect(on_email_received)
+
+    total = sum(timings)
+    percentiles = statistics.quantiles(timings, n=100, method='inclusive')
+    return {
+        'scenario': '%s messages=%s attachment=%sKB recipients=%s' % (
+            backend, messages, attachment_size // 1024, recipients
+        ),
+        'request_size': len(body),
+        'requests_per_sec': iterations / total,
+        'emails_per_sec': emails / total,
+        'p50_ms': percentiles[49] * 1000,
+        'p99_ms': percentiles[98] * 1000,
+        'peak_mb': peak / 2 ** 20,
+    }
+
+
+def _change(value, baseline):
+    if not baseline:
+        return ''
+    return ' (%+.0f%%)' % ((value - baseline) / baseline * 100)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--backend', nargs='+', choices=sorted(BODIES), default=sorted(BODIES))
+    parser.add_argument('--messages', nargs='+', type=int, default=[1, 20],
+                        help="messages per request (Mandrill only)")
+    parser.add_argument('--attachment-size', nargs='+', type=int, default=[0, 256],
+                        help="attachment size in KB (0 for no attachment)")
+    parser.add_argument('--recipients', nargs='+', type=int, default=[1, 100])
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--save', help="save the results to this JSON file")
+    parser.add_argument('--compare', help="compare the results with this saved JSON file")
+    args = parser.parse_args()
+
+    settings.DATA_UPLOAD_MAX_MEMORY_SIZE = None
+    settings.ALLOWED_HOSTS = ['testserver']
+    settings.INBOUND_EMAIL_LOG_REQUESTS = False
+    settings.INBOUND_EMAIL_ATTACHMENT_SIZE_MAX = 2 ** 40
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {r['scenario']: r for r in json.load(f)}
+
+    print("%-58s %9s %9s %9s %9s %9s" % (
+        'scenario', 'req/s', 'emails/s', 'p50 ms', 'p99 ms', 'peak MB'
+    ))
+    results = []
+    for backend in args.backend:
+        for messages in args.messages if backend == 'mandrill' else [1]:
+            for attachment_size in args.attachment_size:
+                for recipients in args.recipients:
+                    result = run_scenario(
+                        backend, messages, attachment_size * 1024, recipients, args.iterations
+                    )
+                    results.append(result)
+                    previous = baseline.get(result['scenario'], {})
+                    print("%-58s %9.1f %9.1f %9.2f %9.2f %9.2f%s" % (
+                        result['scenario'],
+                        result['requests_per_sec'],
+                        result['emails_per_sec'],
+                        result['p50_ms'],
+                        result['p99_ms'],
+                        result['peak_mb'],
+                        _change(result['p50_ms'], previous.get('p50_ms')) +
+                        _change(result['peak_mb'], previous.get('peak_mb')),
+                    ))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
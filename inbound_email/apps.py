@@ -12,3 +12,7 @@ class InboundEmailAppConfig(AppConfig):
     def ready(self):
         """Validate config and connect signals."""
         super(InboundEmailAppConfig, self).ready()
+        # load the router (if any) now, so that its email_received receiver
+        # is connected in processes that only dispatch emails
+        from .routing import get_router
+        get_router()
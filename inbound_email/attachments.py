@@ -0,0 +1,167 @@
+"""Lazily-loaded email attachments.
+
+EmailMessage.attachments is a list of (filename, content, mimetype) 3-tuples,
+which means that every attachment has to be read into memory up front. The
+classes in this module behave like those 3-tuples, but only read the content
+when it is actually accessed, and can also be streamed in chunks.
+"""
+from collections.abc import Sequence
+
+from django.core.mail.message import DEFAULT_ATTACHMENT_MIME_TYPE
+
+
+def base64_decoded_size(s):
+    """Return the size of the decoded base64 content, without decoding it."""
+    end = len(s)
+    while end and s[end - 1] in '\r\n':
+        end -= 1
+    length = end - s.count('\n', 0, end) - s.count('\r', 0, end)
+    if s.endswith('==', 0, end):
+        padding = 2
+    elif s.endswith('=', 0, end):
+        padding = 1
+    else:
+        padding = 0
+    return max(0, length * 3 // 4 - padding)
+
+
+class LazyAttachment(Sequence):
+    """Abstract base class for an attachment whose content is loaded on demand.
+
+    Instances can be used anywhere that the (filename, content, mimetype)
+    tuple is expected (unpacking, indexing, EmailMessage.message()), and the
+    content is only loaded when index 1 (or `content`) is accessed. Signal
+    receivers that want to avoid loading the whole attachment into memory
+    should use `chunks()` instead.
+
+    As with EmailMessage.attach, text content is decoded to a str, and if it
+    cannot be decoded then the mimetype is changed to the default.
+    """
+
+    chunk_size = 64 * 2 ** 10
+
+    def __init__(self, filename, mimetype, size=None):
+        self.filename = filename
+        self.content_type = mimetype
+        self.size = size
+        self._content = None
+        self._mimetype = None
+
+    def chunks(self, chunk_size=None):
+        """Return an iterator over the raw content, as bytes."""
+        raise NotImplementedError("Must be implemented by inheriting class.")
+
+    def read(self):
+        """Return the raw content as bytes."""
+        return b''.join(self.chunks())
+
+    def _load(self):
+        content = self.read()
+        mimetype = self.content_type or DEFAULT_ATTACHMENT_MIME_TYPE
+        if mimetype.split('/', 1)[0] == 'text':
+            try:
+                content = content.decode('utf-8')
+            except UnicodeDecodeError:
+                mimetype = DEFAULT_ATTACHMENT_MIME_TYPE
+        self._content = content
+        self._mimetype = mimetype
+
+    @property
+    def loaded(self):
+        """True if the content has been read into memory."""
+        return self._content is not None
+
+    @property
+    def content(self):
+        """The attachment content (str for text mimetypes, else bytes)."""
+        if self._content is None:
+            self._load()
+        return self._content
+
+    @property
+    def mimetype(self):
+        """The mimetype, as it would be set by EmailMessage.attach."""
+        if self.content_type and self.content_type.split('/', 1)[0] != 'text':
+            return self.content_type
+        # text content may need decoding before we know the final mimetype
+        if self._mimetype is None:
+            self._load()
+        return self._mimetype
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        if index in (0, -3):
+            return self.filename
+        if index in (1, -2):
+            return self.content
+        if index in (2, -1):
+            return self.mimetype
+        raise IndexError("attachment index out of range")
+
+    def __len__(self):
+        return 3
+
+    def __eq__(self, other):
+        if isinstance(other, (tuple, LazyAttachment)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<%s: %s (%s, %sB)>" % (
+            self.__class__.__name__, self.filename, self.content_type, self.size
+        )
+
+
+class UploadedFileAttachment(LazyAttachment):
+    """Attachment backed by an UploadedFile from request.FILES.
+
+    The content stays in the uploaded file (in memory or in a temporary file on
+    disk, depending on the upload handler) until it is accessed. The file is
+    closed by Django once the response has been returned, so content must be
+    read before then.
+    """
+
+    def __init__(self, file, filename=None):
+        super(UploadedFileAttachment, self).__init__(
+            filename=filename or file.name,
+            mimetype=file.content_type,
+            size=file.size,
+        )
+        self.file = file
+
+    def chunks(self, chunk_size=None):
+        # NB InMemoryUploadedFile.chunks ignores chunk_size, so read it ourselves
+        chunk_size = chunk_size or self.chunk_size
+        self.file.seek(0)
+        while True:
+            data = self.file.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+
+class MIMEPartAttachment(LazyAttachment):
+    """Attachment backed by a part of a parsed MIME message.
+
+    The part's payload is kept in its transfer encoding (e.g. base64) until
+    the content is accessed, when it is decoded.
+    """
+
+    def __init__(self, part):
+        payload = part.get_payload()
+        if part.get('Content-Transfer-Encoding', '').strip().lower() == 'base64':
+            size = base64_decoded_size(payload)
+        else:
+            size = len(payload)
+        super(MIMEPartAttachment, self).__init__(
+            filename=part.get_filename(),
+            mimetype=part.get_content_type(),
+            size=size,
+        )
+        self.part = part
+
+    def chunks(self, chunk_size=None):
+        yield self.part.get_payload(decode=True) or b''
@@ -1,6 +1,37 @@
+import asyncio
+import contextvars
+import functools
+import itertools
+import logging
+import threading
 from importlib import import_module
 
 from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.dispatch import receiver
+from django.utils.encoding import smart_bytes
+
+from .. import dedupe, loops, metrics, ratelimit
+from ..attachments import LazyAttachment
+from ..errors import (
+    AttachmentTooLargeError,
+    LoopDetectedError,
+    MessageTooLargeError,
+    RateLimitedError,
+)
+from ..message import InboundEmail
+from ..routing import get_router
+from ..signals import email_envelope_received, email_received_unacceptable
+from ..uploadhandler import get_rejected_files
+
+logger = logging.getLogger(__name__)
+
+# parser instances are stateless, so we create one per configured
+# INBOUND_EMAIL_PARSER value and share it across requests (and threads).
+_backend_instances = {}
+_backend_lock = threading.Lock()
 
 
 def get_backend_class():
@@ -15,19 +46,375 @@ def get_backend_class():
 
 
 def get_backend_instance():
-    """Dynamically create an instance of the configured backend class."""
-    backend = get_backend_class()
-    return backend()
+    """Return the shared instance of the configured backend class.
+
+    The backend is resolved and instantiated once per INBOUND_EMAIL_PARSER
+    value, and then reused for every subsequent request.
+    """
+    path = getattr(settings, 'INBOUND_EMAIL_PARSER', None)
+    try:
+        return _backend_instances[path]
+    except KeyError:
+        pass
+
+    with _backend_lock:
+        if path not in _backend_instances:
+            _backend_instances[path] = get_backend_class()()
+        return _backend_instances[path]
+
+
+@receiver(setting_changed)
+def _clear_backend_cache(sender, setting, **kwargs):
+    """Drop cached backend instances when the parser setting is changed."""
+    if setting == 'INBOUND_EMAIL_PARSER':
+        with _backend_lock:
+            _backend_instances.clear()
+
+
+def _get_spam_score(value):
+    """Return the spam score as a float, or None if it is missing or invalid."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _get_dedupe_keys(request):
+    """Return the (seen keys, {id(email): key}) of the emails in a request.
+
+    The keys are kept on the request, as the parser is shared by all requests.
+    """
+    try:
+        return request._inbound_email_dedupe_keys
+    except AttributeError:
+        request._inbound_email_dedupe_keys = (set(), {})
+        return request._inbound_email_dedupe_keys
+
+
+def _get_auto_reply_threads(request):
+    """Return the thread keys of the auto-replies in a request that passed loops.check."""
+    try:
+        return request._inbound_email_auto_reply_threads
+    except AttributeError:
+        request._inbound_email_auto_reply_threads = set()
+        return request._inbound_email_auto_reply_threads
 
 
 class RequestParser():
-    """Abstract base class, to be implemented by service-specific classes."""
+    """Abstract base class, to be implemented by service-specific classes.
+
+    A single instance of the configured parser is shared across all requests
+    (and threads), so implementations must not store per-request state on
+    the instance - keep it in local variables, or on the request itself.
+    """
+
+    @property
+    def lightweight(self):
+        """If True, return InboundEmails rather than EmailMultiAlternatives.
+
+        Set by INBOUND_EMAIL_LIGHTWEIGHT (default=False), or override this
+        with a class attribute to select it for a single backend.
+        """
+        return getattr(settings, 'INBOUND_EMAIL_LIGHTWEIGHT', False)
+
+    @property
+    def router(self):
+        """The Router that emails must match to be kept (INBOUND_EMAIL_ROUTER), or None."""
+        return get_router()
+
+    def _is_routed(self, to, cc, bcc):
+        """Return False if there is a router, and none of the recipients has a route."""
+        router = self.router
+        if router is None or router.is_routed(itertools.chain(to, cc, bcc)):
+            return True
+        logger.debug("Discarding inbound email with no route: %s", list(to))
+        metrics.incr('unrouted')
+        return False
 
     @property
     def max_file_size(self):
         """The maximum file size to process as an attachment (default=10MB)."""
         return getattr(settings, 'INBOUND_EMAIL_ATTACHMENT_SIZE_MAX', 10000000)
 
+    @property
+    def max_message_size(self):
+        """The maximum total size of a message's attachments (default=None, no limit)."""
+        return getattr(settings, 'INBOUND_EMAIL_MESSAGE_SIZE_MAX', None)
+
+    def _check_attachment_size(self, email, filename, size, total=0):
+        """Raise an error if an attachment would exceed the size limits.
+
+        Args:
+            email: the email that the attachment belongs to.
+            filename: the attachment filename.
+            size: the size of the attachment, in bytes.
+            total: the total size of the email's attachments so far.
+
+        Returns the new total size of the email's attachments.
+
+        """
+        if size > self.max_file_size:
+            logger.debug("File attachment %s is too large to process (%sB)", filename, size)
+            raise AttachmentTooLargeError(email=email, filename=filename, size=size)
+
+        total += size
+        max_message_size = self.max_message_size
+        if max_message_size is not None and total > max_message_size:
+            logger.debug("Attachments are too large to process (%sB)", total)
+            raise MessageTooLargeError(email=email, filename=filename, size=total)
+
+        return total
+
+    def _new_email(self, subject, from_email, to, cc, bcc, body, html, attachments):
+        if self.lightweight:
+            return InboundEmail(
+                subject=subject,
+                from_email=from_email,
+                to=to,
+                cc=cc,
+                bcc=bcc,
+                body=body,
+                html=html,
+                attachments=attachments,
+            )
+
+        email = EmailMultiAlternatives(
+            subject=subject,
+            body=body() if callable(body) else body,
+            from_email=from_email,
+            to=to,
+            cc=cc,
+            bcc=bcc,
+        )
+        html = html() if callable(html) else html
+        if html is not None and len(html) > 0:
+            email.attach_alternative(html, "text/html")
+        email.attachments.extend(attachments)
+        return email
+
+    def _create_email(self, subject, from_email, to, cc, bcc, body='', html=None,
+                      attachments=(), request=None):
+        """Return the email for the parsed fields, checking the attachment sizes.
+
+        This is an EmailMultiAlternatives, or an InboundEmail if `lightweight`
+        is set, in which case the body and html may be callables that return
+        the content, so that it is only decoded if it is used.
+
+        If there is a router (see inbound_email.routing), and none of the
+        recipients has a route, then None is returned instead, before any of
+        the attachments are processed.
+
+        Args:
+            attachments: an iterable of LazyAttachments or (filename, content,
+                mimetype) tuples, which are checked against the size limits as
+                they are added. If this raises AttachmentTooLargeError then
+                the email (with the attachments so far) is added to the error.
+            request: if given, files that were too large to upload are
+                reported (see _check_rejected_files).
+
+        """
+        if not self._is_routed(to, cc, bcc):
+            return None
+
+        accepted = []
+        total = 0
+        try:
+            for attachment in attachments:
+                if isinstance(attachment, LazyAttachment):
+                    size = attachment.size
+                else:
+                    size = len(smart_bytes(attachment[1]))
+                total = self._check_attachment_size(None, attachment[0], size, total)
+                accepted.append(attachment)
+            if request is not None:
+                self._check_rejected_files(None, request)
+        except AttachmentTooLargeError as ex:
+            ex.email = self._new_email(subject, from_email, to, cc, bcc, body, html, accepted)
+            raise
+
+        return self._new_email(subject, from_email, to, cc, bcc, body, html, accepted)
+
+    def _get_dedupe_key(self, message_id, content=()):
+        """Return the key that identifies the email, or None if dedupe is disabled.
+
+        See INBOUND_EMAIL_DEDUPE_TIMEOUT.
+
+        Args:
+            message_id: the email's Message-ID header, if it has one.
+            content: an iterable of str/bytes - if there is no message_id then
+                a digest of these is used to identify the email instead.
+
+        """
+        if not dedupe.enabled():
+            return None
+        return '%s:%s' % (self.__class__.__name__, message_id or dedupe.digest(content))
+
+    def _is_duplicate(self, request, key):
+        """Return True if the email with this key has already been received.
+
+        Keys are only recorded once their email has been dispatched (see
+        `received`), so that an email that failed is received again when the
+        provider retries it. Emails earlier in the same request (i.e. in a
+        batch) are also checked.
+
+        Args:
+            request: the HttpRequest that contains the email.
+            key: the email's key (from _get_dedupe_key).
+
+        """
+        if key is None:
+            return False
+        seen, _ = _get_dedupe_keys(request)
+        if key in seen or dedupe.is_duplicate(key):
+            logger.info("Discarding duplicate inbound email: %s", key)
+            metrics.incr('duplicates')
+            return True
+        seen.add(key)
+        return False
+
+    def _set_dedupe_key(self, request, email, key):
+        """Keep the email's key, to be recorded once it has been dispatched; return the email."""
+        if email is not None and key is not None:
+            _get_dedupe_keys(request)[1][id(email)] = key
+        return email
+
+    def received(self, request, email):
+        """Record that the email has been dispatched, so that any retries are discarded.
+
+        The view calls this after sending each email with email_received (or
+        queueing it, see inbound_email.dispatch), if it didn't raise an error.
+        The threads of auto-replies are also recorded now (see
+        inbound_email.loops), rather than when they are checked.
+
+        """
+        key = _get_dedupe_keys(request)[1].pop(id(email), None)
+        if key is not None:
+            dedupe.record(key)
+        # NB the email has the same addresses and subject as its envelope
+        threads = _get_auto_reply_threads(request)
+        if threads:
+            thread = loops.get_thread_key(email)
+            if thread in threads:
+                loops.record(thread)
+
+    def _is_vetoed(self, envelope, request):
+        """Return True if the email should be dropped before it is parsed.
+
+        The envelope is checked for mail loops (see inbound_email.loops) and
+        against the rate limits (see inbound_email.ratelimit) - if it fails,
+        then the email is sent with email_received_unacceptable (with a
+        LoopDetectedError or RateLimitedError) - and then sent with
+        email_envelope_received, whose receivers can veto it.
+
+        Args:
+            envelope: the email's Envelope, or a callable that returns it -
+                which is only called if any of these checks are enabled, or
+                the signal has any receivers.
+            request: the HttpRequest that contains the email.
+
+        """
+        detect_loops = loops.enabled()
+        rate_limited = ratelimit.enabled()
+        if not (detect_loops or rate_limited or
+                email_envelope_received.has_listeners(self.__class__)):
+            return False
+
+        with metrics.timer('envelope'):
+            if callable(envelope):
+                envelope = envelope()
+            try:
+                # loops first, so that looping emails don't use up the rate limits
+                if detect_loops:
+                    loops.check(envelope)
+                if rate_limited:
+                    ratelimit.check(envelope)
+            except (LoopDetectedError, RateLimitedError) as ex:
+                error = ex
+            else:
+                error = None
+                responses = email_envelope_received.send(
+                    sender=self.__class__, envelope=envelope, request=request
+                )
+
+        if error is not None:
+            logger.info("Discarding inbound email: %s", error)
+            metrics.record_failure(error)
+            email_received_unacceptable.send(
+                sender=self.__class__, email=None, request=request, exception=error
+            )
+            return True
+
+        for receiver_, response in responses:
+            if response is False:
+                logger.debug("Discarding inbound email vetoed by %r: %s", receiver_, envelope)
+                metrics.incr('vetoed')
+                return True
+        if detect_loops and envelope.auto_reply:
+            # the thread is recorded once the email has been dispatched
+            _get_auto_reply_threads(request).add(loops.get_thread_key(envelope))
+        return False
+
+    def _iter_request_content(self, request):
+        """Yield the POST values and uploaded file details, for use as content in _is_duplicate."""
+        for key, values in sorted(request.POST.lists()):
+            yield key
+            for value in values:
+                yield value
+        for key, f in sorted(request.FILES.items()):
+            yield '%s:%s:%s' % (key, f.name, f.size)
+
+    def _check_rejected_files(self, email, request):
+        """Raise an error if any files were skipped by the upload handler.
+
+        The view installs an AttachmentSizeLimitUploadHandler, which skips
+        oversized files while they are being uploaded, so these never make it
+        into request.FILES. The email is attached to the error, so that the
+        rest of the message is still available to email_received_unacceptable.
+
+        """
+        for rejected in get_rejected_files(request):
+            logger.debug(
+                "File attachment %s is too large to process (%sB)",
+                rejected.file_name,
+                rejected.size
+            )
+            raise AttachmentTooLargeError(
+                email=email,
+                filename=rejected.file_name,
+                size=rejected.size
+            )
+
+    def authenticate(self, request):
+        """Check that the request really comes from the provider.
+
+        The view calls this before anything reads request.POST or
+        request.FILES, so that unauthenticated requests are rejected before
+        the multipart body is parsed - so where possible this should only use
+        the headers, the query string, or read the body itself (Mailgun's
+        signature is in the POST fields, so it has to parse them). Use
+        `spool.is_spooled` to tell whether the request is being replayed
+        from the spool, in which case it was authenticated when it arrived.
+        Raises AuthenticationError if the request is not authenticated. The
+        default does nothing.
+
+        """
+        pass
+
+    def parse_envelope(self, request):
+        """Parse just the headers of the email in a request, returning an Envelope.
+
+        This is the cheap first phase of parsing: the body and attachments
+        are not touched. `parse` sends the envelope with email_envelope_received
+        (if it has any receivers) before it parses the rest of the email, so
+        that receivers can veto unwanted emails (e.g. spam) early. Backends
+        that receive batches of emails return a list of Envelopes.
+
+        Inheriting classes should raise RequestParseError if the inbound request
+        cannot be converted successfully.
+
+        """
+        raise NotImplementedError("Must be implemented by inheriting class.")
+
     def parse(self, request):
         """Parse a request object into an EmailMultiAlternatives instance.
 
@@ -47,3 +434,73 @@ class RequestParser():
 
         """
         raise NotImplementedError("Must be implemented by inheriting class.")
+
+    def iter_parse(self, request):
+        """Parse a request object, yielding each email as soon as it is built.
+
+        The view uses this (rather than `parse`) so that backends that receive
+        batches of emails can dispatch each one before the next is parsed. The
+        default implementation calls `parse`, which may return either a single
+        email or a list of them (or None, if there is nothing to dispatch).
+
+        """
+        emails = self.parse(request)
+        if not emails:
+            return
+        if isinstance(emails, (list, tuple)):
+            for email in emails:
+                if email is not None:
+                    yield email
+        else:
+            yield emails
+
+    def _call_in_executor(self, func, *args):
+        """Call func(*args) from an executor thread (see aparse)."""
+        # parse sends email_envelope_received and email_received_unacceptable,
+        # whose receivers may use the database, and (unlike sync_to_async)
+        # the executor doesn't close the connections they open
+        close_old_connections()
+        try:
+            return func(*args)
+        finally:
+            close_old_connections()
+
+    def _run_in_executor(self, func, *args):
+        """Run func(*args) in the default executor; return the future."""
+        # run in a copy of the current context, so that the request's
+        # metrics are recorded (run_in_executor doesn't do this for us)
+        return asyncio.get_running_loop().run_in_executor(None, functools.partial(
+            contextvars.copy_context().run, self._call_in_executor, func, *args
+        ))
+
+    async def aparse(self, request):
+        """Parse a request object asynchronously (for use in async views).
+
+        Accessing request.POST (parsing the multipart body), decoding base64
+        attachments and checking signatures are all CPU-bound, so `parse` is
+        run in the default executor, leaving the event loop free to handle
+        other requests. NB the ASGI handler has already read the body
+        asynchronously by the time the view is called, and any signals sent
+        by `parse` are sent from the executor's thread, which closes its
+        database connections when it is done.
+
+        This returns every email in the request at once - see `aiter_parse`
+        to dispatch each one as soon as it has been parsed.
+
+        """
+        return await self._run_in_executor(self.parse, request)
+
+    async def aiter_parse(self, request):
+        """Parse a request object asynchronously, yielding each email as soon as it is built.
+
+        This is the async version of `iter_parse`, which the async view uses:
+        each email is parsed in the default executor (as with `aparse`), so
+        that batches are dispatched one email at a time.
+
+        """
+        emails = self.iter_parse(request)
+        while True:
+            email = await self._run_in_executor(next, emails, None)
+            if email is None:
+                return
+            yield email
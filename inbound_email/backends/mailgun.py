@@ -1,18 +1,172 @@
+import hashlib
+import hmac
+import json
 import logging
+import threading
+import time
 
-from django.core.mail import EmailMultiAlternatives
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.http import HttpRequest
 from django.utils.datastructures import MultiValueDictKeyError
+from django.utils.encoding import smart_bytes
 
-from ..backends import RequestParser
-from ..errors import RequestParseError, AttachmentTooLargeError
+from .. import metrics
+from ..attachments import UploadedFileAttachment
+from ..backends import RequestParser, _get_spam_score
+from ..dedupe import RecentKeys
+from .mime import MIMERequestParser
+from ..errors import RequestParseError, AuthenticationError
+from ..loops import is_auto_reply
+from ..message import Envelope
+from ..spool import is_spooled
 
 logger = logging.getLogger(__name__)
 
+# the tokens of recently verified requests (see _check_mailgun_signature)
+_recent_tokens = None
+_recent_tokens_lock = threading.Lock()
 
-class MailgunRequestParser(RequestParser):
+
+class MailgunSignatureMismatchError(AuthenticationError):
+    """Error raised when the request's mailgun signature doesn't match.
+    """
+
+    def __init__(self, request, expected, calculated):
+        super(MailgunSignatureMismatchError, self)
+        self.request = request
+        self.expected_signature = expected
+        self.calculated_signature = calculated
+
+
+def _get_max_age():
+    return getattr(settings, 'INBOUND_MAILGUN_SIGNATURE_MAX_AGE', 300)
+
+
+def _get_recent_tokens():
+    """Return the RecentKeys used to reject replayed tokens."""
+    global _recent_tokens
+    with _recent_tokens_lock:
+        if _recent_tokens is None:
+            _recent_tokens = RecentKeys(
+                prefix='inbound_email:mailgun:',
+                timeout=_get_max_age(),
+                max_size=getattr(settings, 'INBOUND_MAILGUN_TOKEN_CACHE_SIZE', 10000),
+                cache_alias=getattr(settings, 'INBOUND_MAILGUN_TOKEN_CACHE', 'default'),
+            )
+        return _recent_tokens
+
+
+@receiver(setting_changed)
+def _reset_recent_tokens(sender, setting, **kwargs):
+    """Reset the token cache when the mailgun settings are changed."""
+    global _recent_tokens
+    if setting.startswith('INBOUND_MAILGUN_'):
+        with _recent_tokens_lock:
+            _recent_tokens = None
+
+
+def _check_mailgun_signature(request, key, replayed=False):
+    """Verify the request's timestamp, token and signature fields.
+
+    The signature is the HMAC-SHA256 of the timestamp and token, signed with
+    the webhook signing key. Requests older than INBOUND_MAILGUN_SIGNATURE_MAX_AGE
+    seconds (default=300) are rejected, as are tokens that have already been
+    used (within that time) - so a captured request can't be replayed. If
+    `replayed` (the request was checked when it was spooled) only the
+    signature is verified.
+    """
+    timestamp = request.POST.get('timestamp', '')
+    token = request.POST.get('token', '')
+    expected = request.POST.get('signature', '')
+
+    # the cheap checks first, so that forged requests cost as little as possible
+    try:
+        age = abs(time.time() - int(timestamp))
+    except ValueError:
+        raise AuthenticationError("Inbound request has an invalid timestamp: %r." % timestamp)
+    if age > _get_max_age() and not replayed:
+        raise AuthenticationError("Inbound request has expired: %s." % timestamp)
+
+    signature = hmac.new(
+        key.encode('utf-8'),
+        smart_bytes(timestamp + token),
+        hashlib.sha256,
+    ).hexdigest()
+    # NB compare bytes, as compare_digest raises TypeError for non-ASCII str
+    if not hmac.compare_digest(smart_bytes(signature), smart_bytes(expected)):
+        raise MailgunSignatureMismatchError(request, expected, signature)
+
+    # only record the token once the signature is known to be good
+    if not replayed and not _get_recent_tokens().add(token):
+        raise AuthenticationError("Inbound request token has already been used: %s." % token)
+
+
+def _get_headers(request):
+    """Return the (name, value) pairs of the 'message-headers' field."""
+    try:
+        return [tuple(header) for header in json.loads(request.POST.get('message-headers') or '[]')]
+    except (TypeError, ValueError):
+        logger.debug("Unable to decode message-headers: %r", request.POST.get('message-headers'))
+        return []
+
+
+class _MailgunSignatureMixin(object):
+    """Checks the signature of each request, if INBOUND_MAILGUN_SIGNING_KEY is set."""
+
+    def authenticate(self, request):
+        """Check the request's signature.
+
+        The signature is in the POST fields, so this parses request.POST.
+        Requests replayed from the spool were checked when they arrived, so
+        they are not rejected for their age, or for reusing their token.
+        """
+        self._check_signature(request)
+
+    def _check_signature(self, request):
+        key = getattr(settings, 'INBOUND_MAILGUN_SIGNING_KEY', None)
+        # NB parse checks requests that didn't come through the view
+        if key and not getattr(request, '_mailgun_signature_checked', False):
+            with metrics.timer('signature'):
+                _check_mailgun_signature(request=request, key=key, replayed=is_spooled(request))
+            request._mailgun_signature_checked = True
+
+
+class MailgunRequestParser(_MailgunSignatureMixin, RequestParser):
     """Mailgun request parser."""
 
+    def parse_envelope(self, request):
+        """Parse the sender, recipients, subject, Message-ID and spam score.
+
+        The spam score is Mailgun's X-Mailgun-Sscore, which is only posted
+        if spam filtering is enabled for the domain, and whether the email is
+        an auto-reply is taken from the 'message-headers' field.
+
+        Args:
+            request: an HttpRequest object, containing the forwarded email, as
+                per the Mailgun specification for inbound emails.
+
+        Returns:
+            an Envelope instance.
+        """
+        assert isinstance(request, HttpRequest), "Invalid request type: %s" % type(request)
+
+        try:
+            return Envelope(
+                from_email=request.POST.get('sender'),
+                to=request.POST.get('recipient').split(','),
+                cc=request.POST.get('cc', '').split(','),
+                subject=request.POST.get('subject', ''),
+                message_id=request.POST.get('Message-Id'),
+                spam_score=_get_spam_score(request.POST.get('X-Mailgun-Sscore')),
+                auto_reply=is_auto_reply(_get_headers(request)),
+            )
+        except AttributeError as ex:
+            raise RequestParseError(
+                "Inbound request is missing required value: %s." % ex
+            )
+
     def parse(self, request):
         """Parse incoming request and return an email instance.
 
@@ -25,21 +179,19 @@ class MailgunRequestParser(RequestParser):
                 per the SendGrid specification for inbound emails.
 
         Returns:
-            an EmailMultiAlternatives instance, containing the parsed contents
-                of the inbound email.
+            an EmailMultiAlternatives (or InboundEmail, if lightweight) instance,
+                containing the parsed contents of the inbound email (or None if
+                it is a duplicate, or was vetoed by email_envelope_received).
         """
-        assert isinstance(request, HttpRequest), "Invalid request type: %s" % type(request)
+        self._check_signature(request)
+        envelope = self.parse_envelope(request)
 
         try:
-            subject = request.POST.get('subject', '')
             text = "%s\n\n%s" % (
                 request.POST.get('stripped-text', ''),
                 request.POST.get('stripped-signature', '')
             )
             html = request.POST.get('stripped-html')
-            from_email = request.POST.get('sender')
-            to_email = request.POST.get('recipient').split(',')
-            cc = request.POST.get('cc', '').split(',')
             bcc = request.POST.get('bcc', '').split(',')
 
         except MultiValueDictKeyError as ex:
@@ -47,36 +199,41 @@ class MailgunRequestParser(RequestParser):
                 "Inbound request is missing required value: %s." % ex
             )
 
-        except AttributeError as ex:
-            raise RequestParseError(
-                "Inbound request is missing required value: %s." % ex
-            )
+        # duplicates first, so that retries don't use up the rate limits
+        key = self._get_dedupe_key(envelope.message_id, self._iter_request_content(request))
+        if self._is_duplicate(request, key):
+            return None
 
-        email = EmailMultiAlternatives(
-            subject=subject,
-            body=text,
-            from_email=from_email,
-            to=to_email,
-            cc=cc,
+        if self._is_vetoed(envelope, request):
+            return None
+
+        # attachments are left in the uploaded files until they are accessed
+        email = self._create_email(
+            subject=envelope.subject,
+            from_email=envelope.from_email,
+            to=envelope.to,
+            cc=envelope.cc,
             bcc=bcc,
+            body=text,
+            html=html,
+            attachments=[
+                UploadedFileAttachment(f, filename=n) for n, f in request.FILES.items()
+            ],
+            # files that were too large to upload are not in request.FILES
+            request=request,
         )
-        if html is not None and len(html) > 0:
-            email.attach_alternative(html, "text/html")
-
-        # TODO: this won't cope with big files - should really read in in chunks
-        for n, f in list(request.FILES.items()):
-            if f.size > self.max_file_size:
-                logger.debug(
-                    "File attachment %s is too large to process (%sB)",
-                    f.name,
-                    f.size
-                )
-                raise AttachmentTooLargeError(
-                    email=email,
-                    filename=f.name,
-                    size=f.size
-                )
-            else:
-                email.attach(n, f.read(), f.content_type)
-
-        return email
+        return self._set_dedupe_key(request, email, key)
+
+
+class MailgunMIMERequestParser(_MailgunSignatureMixin, MIMERequestParser):
+    """Mailgun request parser, for routes that forward to a "mime" URL.
+
+    The whole message is posted in the 'body-mime' field, rather than the
+    parsed fields (and uploaded files) used by MailgunRequestParser.
+    """
+
+    mime_field = 'body-mime'
+
+    def parse(self, request):
+        self._check_signature(request)
+        return super(MailgunMIMERequestParser, self).parse(request)
@@ -1,24 +1,49 @@
 import re
+import atexit
+import binascii
+import functools
 import hashlib
 import hmac
+import itertools
 import json
 import logging
 import base64
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import django
 
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.core.signals import setting_changed
+from django.core.mail.message import DEFAULT_ATTACHMENT_MIME_TYPE
 from django.http import HttpRequest
+from django.dispatch import receiver
 from django.utils.encoding import smart_bytes
 
-from ..backends import RequestParser
-from ..errors import (
-    RequestParseError,
-    AttachmentTooLargeError,
-    AuthenticationError,
-)
+from .. import metrics
+from ..attachments import base64_decoded_size
+from ..backends import RequestParser, _get_spam_score
+from ..errors import RequestParseError, AuthenticationError
+from ..loops import is_auto_reply
+from ..message import Envelope
 
 logger = logging.getLogger(__name__)
 
+_WHITESPACE = re.compile(r'\s*')
+
+# base64 detection only looks at this many characters at each end of the string
+_BASE64_SAMPLE_SIZE = 256
+_BASE64_BODY = re.compile(r'[A-Za-z0-9+/]+')
+_BASE64_TAIL = re.compile(r'[A-Za-z0-9+/]+[=]{0,2}')
+_json_decoder = json.JSONDecoder()
+
+# number of characters of each POST value to encode at a time when signing
+_SIGNATURE_CHUNK_SIZE = 64 * 2 ** 10
+
+# the process pool used to parse large batches (see INBOUND_MANDRILL_PARSE_WORKERS)
+_pool = None
+_pool_lock = threading.Lock()
+
 
 class MandrillSignatureMismatchError(AuthenticationError):
     """Error raised when the request's mandrill signature doesn't match.
@@ -31,61 +56,181 @@ class MandrillSignatureMismatchError(AuthenticationError):
         self.calculated_signature = calculated
 
 
-def _detect_base64(s):
-    """Quite an ingenuous function to guess if a string is base64 encoded
+def _looks_like_base64(s):
+    """Cheap check to guess if a string is base64 encoded.
+
+    Only the first and last _BASE64_SAMPLE_SIZE characters are checked, so
+    this takes the same time however large the string is.
+    """
+    length = len(s)
+    if length == 0 or length % 4 != 0:
+        return False
+    tail_start = max(0, length - _BASE64_SAMPLE_SIZE)
+    head_end = min(length, _BASE64_SAMPLE_SIZE, tail_start or length)
+    return bool(
+        (tail_start == 0 or _BASE64_BODY.fullmatch(s, 0, head_end)) and
+        _BASE64_TAIL.fullmatch(s, tail_start)
+    )
+
+
+def _decode_base64(s):
+    """Return the decoded content if s is base64 encoded, else s unchanged.
+
+    The string is validated and decoded in a single pass - if it turns out
+    not to be base64 after all then the original content is returned.
     """
-    return (len(s) % 4 == 0) and re.match('^[A-Za-z0-9+/]+[=]{0,2}$', s)
+    if not _looks_like_base64(s):
+        return s
+    try:
+        return base64.b64decode(s, validate=True)
+    except (binascii.Error, ValueError):
+        return s
+
+
+def _get_message_id(msg):
+    """Return the Message-Id header from an inbound event's msg, or None."""
+    if not isinstance(msg, dict):
+        return None
+    return (msg.get('headers') or {}).get('Message-Id')
+
+
+def _iter_headers(msg):
+    """Yield the (name, value) pairs of the msg's headers (which may repeat)."""
+    for name, value in (msg.get('headers') or {}).items():
+        if isinstance(value, list):
+            for item in value:
+                yield name, item
+        else:
+            yield name, value
+
+
+def _iter_message_content(msg):
+    """Yield the content used to identify a msg that has no Message-Id."""
+    if isinstance(msg, dict) and msg.get('raw_msg'):
+        yield msg['raw_msg']
+    else:
+        yield json.dumps(msg, sort_keys=True)
+
+
+def _iter_json_array(s):
+    """Decode a JSON array, yielding its items one at a time.
+
+    This avoids building the whole list (of potentially very large objects)
+    in memory. Anything other than an array is decoded in one go, and yields
+    nothing if it is empty.
+    """
+    end = _WHITESPACE.match(s).end()
+    if not s.startswith('[', end):
+        for item in json.loads(s) or []:
+            yield item
+        return
+
+    end = _WHITESPACE.match(s, end + 1).end()
+    if s.startswith(']', end):
+        return
+
+    while True:
+        item, end = _json_decoder.raw_decode(s, end)
+        yield item
+        end = _WHITESPACE.match(s, end).end()
+        if s.startswith(']', end):
+            return
+        if not s.startswith(',', end):
+            raise ValueError("Expecting ',' delimiter: char %s" % end)
+        end = _WHITESPACE.match(s, end + 1).end()
 
 
 def _check_mandrill_signature(request, key):
     expected = request.META.get('HTTP_X_MANDRILL_SIGNATURE', None)
     url = request.build_absolute_uri()
-    # Mandrill appends the POST params in alphabetical order of the key.
-    params = sorted(request.POST.items(), key=lambda x: x[0])
-    message = url + ''.join(key + value for key, value in params)
     signed_binary = hmac.new(
         key.encode('utf-8'),
-        message.encode('utf-8'),
+        url.encode('utf-8'),
         hashlib.sha1,
     )
-    signature = base64.b64encode(signed_binary.digest()).decode('utf-8')
-    if signature != expected:
+    # Mandrill appends the POST params in alphabetical order of the key. Feed
+    # them into the HMAC one at a time, rather than building (and encoding) a
+    # single string containing the whole request.
+    for name, value in sorted(request.POST.items(), key=lambda x: x[0]):
+        signed_binary.update(name.encode('utf-8'))
+        # encode large values (e.g. mandrill_events) a slice at a time
+        for i in range(0, len(value), _SIGNATURE_CHUNK_SIZE):
+            signed_binary.update(value[i:i + _SIGNATURE_CHUNK_SIZE].encode('utf-8'))
+    signature = base64.b64encode(signed_binary.digest())
+    if not hmac.compare_digest(signature, smart_bytes(expected or '')):
+        signature = signature.decode('utf-8')
         raise MandrillSignatureMismatchError(request, expected, signature)
 
 
+def _get_pool():
+    """Return the shared process pool, or None if it is disabled."""
+    global _pool
+    workers = getattr(settings, 'INBOUND_MANDRILL_PARSE_WORKERS', None)
+    if not workers:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # NB django.setup is a no-op in forked workers, but spawned
+            # workers need it to configure the settings
+            _pool = ProcessPoolExecutor(max_workers=workers, initializer=django.setup)
+        return _pool
+
+
+@atexit.register
+def _shutdown_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+@receiver(setting_changed)
+def _reset_pool(sender, setting, **kwargs):
+    """Shut down the pool when the number of workers is changed."""
+    if setting == 'INBOUND_MANDRILL_PARSE_WORKERS':
+        _shutdown_pool()
+
+
 class MandrillRequestParser(RequestParser):
     """Mandrill request parser. """
 
-    def _process_attachments(self, email, attachments):
+    def _process_attachments(self, attachments):
+        """Decode the attachments, yielding (filename, content, mimetype) tuples.
+
+        The final size checks are done by _create_email, as each attachment
+        is yielded.
+        """
+        total = 0
         for key, attachment in list(attachments.items()):
             is_base64 = attachment.get('base64')
             name = attachment.get('name')
             mimetype = attachment.get('type')
             content = attachment.get('content', "")
 
-            if is_base64:
-                content = base64.b64decode(content)
             # watchout: sometimes attachment contents are base64'd but mandrill doesn't set the flag
-            elif _detect_base64(content):
-                content = base64.b64decode(content)
+            if is_base64 or _looks_like_base64(content):
+                # check the size before decoding, so that oversized
+                # attachments are never decoded into memory
+                self._check_attachment_size(
+                    None, name, base64_decoded_size(content), total
+                )
+                if is_base64:
+                    content = base64.b64decode(content)
+                else:
+                    content = _decode_base64(content)
 
             content = smart_bytes(content, strings_only=True)
-
-            if len(content) > self.max_file_size:
-                logger.debug(
-                    "File attachment %s is too large to process (%sB)",
-                    name,
-                    len(content)
-                )
-                raise AttachmentTooLargeError(
-                    email=email,
-                    filename=name,
-                    size=len(content)
-                )
+            total += len(content)
 
             if name and mimetype and content:
-                email.attach(name, content, mimetype)
-        return email
+                # as EmailMessage.attach does, decode text content if possible
+                if mimetype.split('/', 1)[0] == 'text':
+                    try:
+                        content = content.decode('utf-8')
+                    except UnicodeDecodeError:
+                        mimetype = DEFAULT_ATTACHMENT_MIME_TYPE
+                yield name, content, mimetype
 
     def _get_recipients(self, array):
         """Returns an iterator of objects
@@ -104,73 +249,206 @@ class MandrillRequestParser(RequestParser):
         else:
             return "\"%s\" <%s>" % (from_name, from_email)
 
-    def parse(self, request):
-        """Parse incoming request and return an email instance.
+    def _parse_message(self, msg):
+        """Build the email from a single inbound event's msg."""
+        try:
+            from_email = msg['from_email']
+            to = list(self._get_recipients(msg['to']))
+            cc = list(self._get_recipients(msg['cc'])) if 'cc' in msg else []
+            bcc = list(self._get_recipients(msg['bcc'])) if 'bcc' in msg else []
 
-        Args:
-            request: an HttpRequest object, containing a list of forwarded emails, as
-                per Mandrill specification for inbound emails.
+            subject = msg.get('subject', "")
 
-        Returns:
-            a list of EmailMultiAlternatives instances
-        """
-        assert isinstance(request, HttpRequest), "Invalid request type: %s" % type(request)
+            attachments = msg.get('attachments', {})
+            attachments.update(msg.get('images', {}))
 
-        if settings.INBOUND_MANDRILL_AUTHENTICATION_KEY:
-            _check_mandrill_signature(
-                request=request,
-                key=settings.INBOUND_MANDRILL_AUTHENTICATION_KEY,
+            text = msg.get('text', "")
+            html = msg.get('html', "")
+        except (KeyError, ValueError) as ex:
+            raise RequestParseError(
+                "Inbound request is missing or got an invalid value.: %s." % ex
+            )
+
+        return self._create_email(
+            subject=subject,
+            from_email=self._get_sender(
+                from_email=from_email,
+                from_name=msg.get('from_name'),
+            ),
+            to=to,
+            cc=cc,
+            bcc=bcc,
+            body=text,
+            html=html,
+            attachments=self._process_attachments(attachments),
+        )
+
+    def _get_envelope(self, msg):
+        """Return the Envelope of a single inbound event's msg."""
+        try:
+            return Envelope(
+                from_email=msg['from_email'],
+                to=[address for address, _ in msg['to']],
+                cc=[address for address, _ in msg.get('cc') or []],
+                subject=msg.get('subject', ""),
+                message_id=_get_message_id(msg),
+                spam_score=_get_spam_score((msg.get('spam_report') or {}).get('score')),
+                auto_reply=is_auto_reply(_iter_headers(msg)),
+            )
+        except (KeyError, ValueError) as ex:
+            raise RequestParseError(
+                "Inbound request is missing or got an invalid value.: %s." % ex
+            )
+
+    def _is_routed_message(self, msg):
+        """Return False if the msg would be dropped by the router."""
+        if self.router is None:
+            return True
+        try:
+            return self._is_routed(
+                self._get_recipients(msg.get('to') or []),
+                self._get_recipients(msg.get('cc') or []),
+                self._get_recipients(msg.get('bcc') or []),
             )
+        except ValueError:
+            # leave it to _parse_message to raise the error
+            return True
 
+    def _iter_messages(self, request):
+        """Yield the (msg, dedupe key) of each inbound (and not duplicate) event in the request."""
         try:
-            messages = json.loads(request.POST['mandrill_events'])
-        except (ValueError, KeyError) as ex:
+            messages = _iter_json_array(request.POST['mandrill_events'])
+        except KeyError as ex:
             raise RequestParseError("Request is not a valid json: %s" % ex)
 
-        if not messages:
-            logger.debug("No messages found in mandrill request: %s", request.body)
-            return []
+        found = False
+        while True:
+            try:
+                message = next(messages)
+            except StopIteration:
+                break
+            except ValueError as ex:
+                raise RequestParseError("Request is not a valid json: %s" % ex)
 
-        emails = []
-        for message in messages:
+            found = True
             if message.get('event') != 'inbound':
                 logger.debug("Discarding non-inbound message")
                 continue
 
             msg = message.get('msg')
-            try:
-                from_email = msg['from_email']
-                to = list(self._get_recipients(msg['to']))
-                cc = list(self._get_recipients(msg['cc'])) if 'cc' in msg else []
-                bcc = list(self._get_recipients(msg['bcc'])) if 'bcc' in msg else []
+            # duplicates first, so that retries don't use up the rate limits
+            key = self._get_dedupe_key(_get_message_id(msg), _iter_message_content(msg))
+            if self._is_duplicate(request, key):
+                continue
+            if self._is_vetoed(functools.partial(self._get_envelope, msg), request):
+                continue
+
+            yield msg, key
+
+        if not found:
+            logger.debug("No messages found in mandrill request: %s", request.body)
+
+    def parse_envelope(self, request):
+        """Parse the sender, recipients, subject, Message-ID and spam score of each email.
+
+        Args:
+            request: an HttpRequest object, containing a list of forwarded emails, as
+                per Mandrill specification for inbound emails.
+
+        Returns:
+            a list of Envelope instances, one for each inbound event.
+        """
+        assert isinstance(request, HttpRequest), "Invalid request type: %s" % type(request)
+        try:
+            messages = _iter_json_array(request.POST['mandrill_events'])
+            return [
+                self._get_envelope(message.get('msg'))
+                for message in messages if message.get('event') == 'inbound'
+            ]
+        except (KeyError, ValueError) as ex:
+            raise RequestParseError("Request is not a valid json: %s" % ex)
+
+    def iter_parse(self, request):
+        """Parse incoming request, yielding each email as soon as it is built.
 
-                subject = msg.get('subject', "")
+        The mandrill_events JSON is decoded one event at a time, so only a
+        single message (and its attachments) is held in memory at once,
+        rather than the whole batch.
 
-                attachments = msg.get('attachments', {})
-                attachments.update(msg.get('images', {}))
+        If INBOUND_MANDRILL_PARSE_WORKERS is set, then batches of at least
+        INBOUND_MANDRILL_PARSE_THRESHOLD (default=10) events are parsed in a
+        pool of that many processes instead, as decoding the attachments is
+        CPU bound. The emails are yielded in the same order, but the whole
+        batch is decoded up front.
 
-                text = msg.get('text', "")
-                html = msg.get('html', "")
-            except (KeyError, ValueError) as ex:
-                raise RequestParseError(
-                    "Inbound request is missing or got an invalid value.: %s." % ex
+        Args:
+            request: an HttpRequest object, containing a list of forwarded emails, as
+                per Mandrill specification for inbound emails.
+
+        Returns:
+            a generator of EmailMultiAlternatives (or InboundEmail, if lightweight) instances
+        """
+        assert isinstance(request, HttpRequest), "Invalid request type: %s" % type(request)
+
+        if settings.INBOUND_MANDRILL_AUTHENTICATION_KEY:
+            with metrics.timer('signature'):
+                _check_mandrill_signature(
+                    request=request,
+                    key=settings.INBOUND_MANDRILL_AUTHENTICATION_KEY,
                 )
 
-            email = EmailMultiAlternatives(
-                subject=subject,
-                body=text,
-                from_email=self._get_sender(
-                    from_email=from_email,
-                    from_name=msg.get('from_name'),
-                ),
-                to=to,
-                cc=cc,
-                bcc=bcc,
-            )
-            if html is not None and len(html) > 0:
-                email.attach_alternative(html, "text/html")
+        messages = self._iter_messages(request)
+        pool = _get_pool()
+        if pool is not None:
+            threshold = getattr(settings, 'INBOUND_MANDRILL_PARSE_THRESHOLD', 10)
+            batch = list(itertools.islice(messages, threshold))
+            if len(batch) >= threshold:
+                # the limits are passed explicitly, as the workers may not
+                # see the current settings, and unrouted messages are
+                # dropped here, as the workers have no router
+                parser = _PooledMandrillRequestParser(
+                    self.lightweight, self.max_file_size, self.max_message_size
+                )
+                messages = [
+                    (msg, key) for msg, key in itertools.chain(batch, messages)
+                    if self._is_routed_message(msg)
+                ]
+                # NB map returns the results in order, and raises any error
+                # when its email is reached
+                emails = pool.map(parser._parse_message, [msg for msg, _ in messages])
+                for (_, key), email in zip(messages, emails):
+                    yield self._set_dedupe_key(request, email, key)
+                return
+            messages = batch
+
+        for msg, key in messages:
+            email = self._parse_message(msg)
+            if email is not None:
+                yield self._set_dedupe_key(request, email, key)
+
+    def parse(self, request):
+        """Parse incoming request and return a list of email instances.
+
+        Args:
+            request: an HttpRequest object, containing a list of forwarded emails, as
+                per Mandrill specification for inbound emails.
+
+        Returns:
+            a list of EmailMultiAlternatives (or InboundEmail, if lightweight) instances
+        """
+        return list(self.iter_parse(request))
+
+
+class _PooledMandrillRequestParser(MandrillRequestParser):
+    """Parses messages in the process pool, with the caller's size limits."""
 
-            email = self._process_attachments(email, attachments)
-            emails.append(email)
+    # NB these replace the RequestParser properties, which read the settings
+    lightweight = None
+    max_file_size = None
+    max_message_size = None
+    router = None
 
-        return emails
+    def __init__(self, lightweight, max_file_size, max_message_size):
+        self.lightweight = lightweight
+        self.max_file_size = max_file_size
+        self.max_message_size = max_message_size
@@ -0,0 +1,167 @@
+import logging
+
+from email import policy
+from email.header import decode_header, make_header
+from email.parser import BytesParser
+from email.utils import getaddresses
+
+from django.http import HttpRequest
+from django.utils.encoding import smart_bytes
+
+from ..attachments import MIMEPartAttachment
+from ..backends import RequestParser, _get_spam_score
+from ..errors import RequestParseError
+from ..loops import is_auto_reply
+from ..message import Envelope
+
+logger = logging.getLogger(__name__)
+
+# compat32 skips the (slow) header registry of the newer policies - we only
+# decode the handful of headers that we actually use.
+_parser = BytesParser(policy=policy.compat32)
+
+
+def _decode_header(value):
+    """Decode an RFC 2047 encoded header value into a str."""
+    if value is None:
+        return ''
+    try:
+        return str(make_header(decode_header(value)))
+    except (LookupError, UnicodeDecodeError):
+        return str(value)
+
+
+def _get_addresses(message, name):
+    """Return the list of email addresses in all of the named headers."""
+    values = [_decode_header(v) for v in message.get_all(name, [])]
+    return [address for _, address in getaddresses(values) if "@" in address]
+
+
+def _get_text(part):
+    """Return the decoded text content of a MIME part."""
+    payload = part.get_payload(decode=True) or b''
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        return payload.decode(charset, errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='replace')
+
+
+class MIMERequestParser(RequestParser):
+    """Abstract parser for requests that contain the raw MIME message.
+
+    The message is parsed with the (fast) compat32 policy: the headers are
+    decoded when it is parsed, but the body parts are left in their transfer
+    encoding, and attachments are only decoded when their content is
+    accessed (see MIMEPartAttachment).
+
+    Inheriting classes must set `mime_field`, the name of the POST field that
+    contains the message.
+    """
+
+    mime_field = None
+
+    def parse_mime(self, raw):
+        """Parse a raw MIME message (bytes) into an email."""
+        message = _parser.parsebytes(raw)
+
+        from_addresses = _get_addresses(message, 'from')
+        if not from_addresses:
+            raise RequestParseError(
+                "Could not get a valid from address out of: %s." % message.get('from')
+            )
+
+        text_part = html_part = None
+        attachments = []
+        for part in message.walk():
+            if part.is_multipart():
+                continue
+            content_type = part.get_content_type()
+            is_attachment = part.get_content_disposition() == 'attachment'
+            if content_type == 'text/plain' and text_part is None and not is_attachment:
+                text_part = part
+            elif content_type == 'text/html' and html_part is None and not is_attachment:
+                html_part = part
+            else:
+                attachments.append(MIMEPartAttachment(part))
+
+        # the bodies are only decoded when they are used (see _create_email)
+        return self._create_email(
+            subject=_decode_header(message.get('subject')),
+            from_email=from_addresses[0],
+            to=_get_addresses(message, 'to'),
+            cc=_get_addresses(message, 'cc'),
+            bcc=_get_addresses(message, 'bcc'),
+            body=(lambda: _get_text(text_part)) if text_part is not None else '',
+            html=(lambda: _get_text(html_part)) if html_part is not None else None,
+            attachments=attachments,
+        )
+
+    def _get_raw(self, request):
+        try:
+            return smart_bytes(request.POST[self.mime_field])
+        except KeyError as ex:
+            raise RequestParseError("Inbound request is missing required value: %s." % ex)
+
+    def _get_envelope(self, headers):
+        """Return the Envelope for the (parsed) headers of a message."""
+        return Envelope(
+            from_email=next(iter(_get_addresses(headers, 'from')), None),
+            to=_get_addresses(headers, 'to'),
+            cc=_get_addresses(headers, 'cc'),
+            subject=_decode_header(headers.get('subject')),
+            message_id=headers.get('message-id'),
+            spam_score=_get_spam_score(headers.get('x-spam-score')),
+            auto_reply=is_auto_reply(headers.items()),
+        )
+
+    def parse_envelope(self, request):
+        """Parse the sender, recipients, subject, Message-ID and spam score.
+
+        Only the headers of the message are parsed. The spam score is taken
+        from the X-Spam-Score header (as added by SpamAssassin), if any.
+
+        Args:
+            request: an HttpRequest object, containing the raw MIME message
+                in request.POST[self.mime_field].
+
+        Returns:
+            an Envelope instance.
+        """
+        assert isinstance(request, HttpRequest), "Invalid request type: %s" % type(request)
+        headers = _parser.parsebytes(self._get_raw(request), headersonly=True)
+        return self._get_envelope(headers)
+
+    def parse(self, request):
+        """Parse incoming request and return an email instance.
+
+        Args:
+            request: an HttpRequest object, containing the raw MIME message
+                in request.POST[self.mime_field].
+
+        Returns:
+            an EmailMultiAlternatives (or InboundEmail, if lightweight) instance,
+                containing the parsed contents of the inbound email (or None if
+                it is a duplicate, or was vetoed by email_envelope_received).
+        """
+        assert isinstance(request, HttpRequest), "Invalid request type: %s" % type(request)
+
+        raw = self._get_raw(request)
+
+        # only the headers are parsed at this point
+        headers = _parser.parsebytes(raw, headersonly=True)
+        # duplicates first, so that retries don't use up the rate limits
+        key = self._get_dedupe_key(headers.get('message-id'), [raw])
+        if self._is_duplicate(request, key):
+            return None
+        if self._is_vetoed(lambda: self._get_envelope(headers), request):
+            return None
+        # unrouted emails are dropped before the body is parsed
+        if self.router is not None and not self._is_routed(
+            _get_addresses(headers, 'to'),
+            _get_addresses(headers, 'cc'),
+            _get_addresses(headers, 'bcc'),
+        ):
+            return None
+
+        return self._set_dedupe_key(request, self.parse_mime(raw), key)
@@ -0,0 +1,143 @@
+"""Detection of duplicate inbound emails (e.g. from provider retries).
+
+Providers retry webhooks that time out, or return an error, so the same
+email can be posted more than once. If INBOUND_EMAIL_DEDUPE_TIMEOUT is set,
+the Message-ID (or a digest of the request, if there is no Message-ID) of
+each email is recorded once it has been dispatched, and the parsers discard
+any email that was recorded within that many seconds - before the
+attachments are processed. Emails that fail (e.g. because a receiver raised
+an error) are not recorded, so they are received again when they are retried.
+
+Keys are held in an in-process LRU cache, in front of the Django cache
+named by INBOUND_EMAIL_DEDUPE_CACHE (default='default'; set this to None to
+use the in-process cache only), so that duplicates are detected across
+processes and servers.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+class RecentKeys(object):
+    """Remembers keys for a limited time.
+
+    Args:
+        prefix: prefix added to the keys stored in the Django cache.
+        timeout: the number of seconds to remember each key for.
+        max_size: the max number of keys held in the in-process cache.
+        cache_alias: the Django cache to use, or None for in-process only.
+    """
+
+    def __init__(self, prefix, timeout, max_size=1000, cache_alias='default'):
+        self.prefix = prefix
+        self.timeout = timeout
+        self.max_size = max_size
+        self.cache_alias = cache_alias
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def contains(self, key):
+        """Return True if the key has been added (and has not expired)."""
+        key = self._hash(key)
+        with self._lock:
+            expires = self._local.get(key)
+            if expires is not None and expires > time.monotonic():
+                self._local.move_to_end(key)
+                return True
+
+        if self.cache_alias is None:
+            return False
+        return caches[self.cache_alias].get(self.prefix + key) is not None
+
+    def _hash(self, key):
+        # hash the key, as cache backends restrict key length and characters
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def add(self, key):
+        """Record the key; return False if it has already been seen."""
+        key = self._hash(key)
+        now = time.monotonic()
+
+        with self._lock:
+            expires = self._local.get(key)
+            if expires is not None and expires > now:
+                self._local.move_to_end(key)
+                return False
+            self._local[key] = now + self.timeout
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+        if self.cache_alias is None:
+            return True
+        return caches[self.cache_alias].add(self.prefix + key, 1, self.timeout)
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+
+
+_recent_emails = None
+_recent_emails_lock = threading.Lock()
+
+
+def _get_recent_emails():
+    """Return the RecentKeys for emails, or None if dedupe is disabled."""
+    global _recent_emails
+    timeout = getattr(settings, 'INBOUND_EMAIL_DEDUPE_TIMEOUT', None)
+    if not timeout:
+        return None
+    with _recent_emails_lock:
+        if _recent_emails is None:
+            _recent_emails = RecentKeys(
+                prefix='inbound_email:dedupe:',
+                timeout=timeout,
+                max_size=getattr(settings, 'INBOUND_EMAIL_DEDUPE_MAX_SIZE', 1000),
+                cache_alias=getattr(settings, 'INBOUND_EMAIL_DEDUPE_CACHE', 'default'),
+            )
+        return _recent_emails
+
+
+def enabled():
+    """Return True if dedupe is enabled."""
+    return bool(getattr(settings, 'INBOUND_EMAIL_DEDUPE_TIMEOUT', None))
+
+
+def is_duplicate(key):
+    """Return True if the key has been recorded (see `record`).
+
+    Always returns False if dedupe is disabled.
+    """
+    recent = _get_recent_emails()
+    return recent is not None and recent.contains(key)
+
+
+def record(key):
+    """Record the key of an email that has been dispatched."""
+    recent = _get_recent_emails()
+    if recent is not None:
+        recent.add(key)
+
+
+def digest(values):
+    """Return a hex digest of an iterable of str/bytes values, for use as a key."""
+    h = hashlib.sha256()
+    for value in values:
+        h.update(value.encode('utf-8') if isinstance(value, str) else value)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+@receiver(setting_changed)
+def _reset_recent_emails(sender, setting, **kwargs):
+    """Reset the dedupe cache when the dedupe settings are changed."""
+    global _recent_emails
+    if setting.startswith('INBOUND_EMAIL_DEDUPE_'):
+        with _recent_emails_lock:
+            _recent_emails = None
@@ -0,0 +1,373 @@
+"""Dispatchers that deliver parsed emails to the email_received signal receivers.
+
+By default the signal is sent synchronously, from within the view, which
+means that the response to the provider is delayed until every receiver has
+finished. The thread-pool and file-spool dispatchers hand the email off to
+a queue instead, so that the view can return immediately, and the receivers
+are run in background threads.
+
+The dispatcher is configured with the INBOUND_EMAIL_DISPATCHER setting (the
+dotted path to the class), and INBOUND_EMAIL_DISPATCHER_OPTIONS (a dict of
+kwargs that is passed to the class when it is instantiated).
+
+However they are dispatched, each receiver is timed (email_received is a
+TimedSignal, which wraps each receiver when it is connected), and any that
+take longer than INBOUND_EMAIL_SLOW_RECEIVER_THRESHOLD seconds (default=1.0)
+are logged.
+If INBOUND_EMAIL_ROBUST_RECEIVERS is True, then an error raised by a receiver
+is logged and the remaining receivers are still run (as with Signal.send_robust),
+rather than the error being raised - so that one bad receiver doesn't make the
+provider retry the email, and re-run all of the others.
+"""
+import asyncio
+import atexit
+import logging
+import os
+import pickle
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+
+try:
+    from asgiref.sync import async_to_sync
+except ImportError:  # Django < 3.0
+    async_to_sync = None
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.dispatch import receiver
+from django.http import HttpRequest
+
+from . import metrics
+from .attachments import LazyAttachment
+from .message import InboundEmail
+from .signals import email_received
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DISPATCHER = 'inbound_email.dispatch.SyncDispatcher'
+
+_dispatchers = {}
+_dispatcher_lock = threading.Lock()
+
+
+def _detach_email(email):
+    """Read any lazy attachments into memory, so the email outlives the request.
+
+    Django closes (and deletes) uploaded files once the response has been
+    returned, so the content must be read before the email is queued.
+    """
+    attachments = [
+        tuple(a) if isinstance(a, LazyAttachment) else a
+        for a in email.attachments
+    ]
+    if isinstance(email, InboundEmail):
+        return email.replace(attachments=attachments)
+    email.attachments = attachments
+    return email
+
+
+def _detach_request(request):
+    """Return a picklable copy of the request, without the uploaded files.
+
+    As with the email's attachments, Django closes request.FILES once the
+    response has been returned, so receivers that run after that (in another
+    thread, or process) must not be given the original request.
+    """
+    if request is None:
+        return None
+    copy = HttpRequest()
+    copy.method = request.method
+    copy.path = request.path
+    copy.path_info = request.path_info
+    copy.GET = request.GET
+    copy.POST = request.POST
+    copy.META = {k: v for k, v in request.META.items() if isinstance(v, (str, int))}
+    return copy
+
+
+def _receiver_name(receiver):
+    return '%s.%s' % (
+        getattr(receiver, '__module__', None),
+        getattr(receiver, '__qualname__', receiver.__class__.__name__),
+    )
+
+
+def call_receiver(receiver, signal, sender, **named):
+    """Call a single email_received receiver, timing it.
+
+    email_received is a TimedSignal, which calls each of its receivers via
+    this function. If INBOUND_EMAIL_ROBUST_RECEIVERS is True, then an error
+    is logged and returned as the receiver's response, as Signal.send_robust
+    does, rather than raised.
+    """
+    threshold = getattr(settings, 'INBOUND_EMAIL_SLOW_RECEIVER_THRESHOLD', 1.0)
+    name = _receiver_name(receiver)
+    if async_to_sync is not None and asyncio.iscoroutinefunction(receiver):
+        receiver = async_to_sync(receiver)
+    start = time.perf_counter()
+    try:
+        with metrics.timer('receivers.%s' % name):
+            return receiver(signal=signal, sender=sender, **named)
+    except Exception as ex:
+        if not getattr(settings, 'INBOUND_EMAIL_ROBUST_RECEIVERS', False):
+            raise
+        logger.exception("Error in email_received receiver %s for %r", name, named.get('email'))
+        metrics.record_failure(ex)
+        return ex
+    finally:
+        elapsed = time.perf_counter() - start
+        if threshold is not None and elapsed > threshold:
+            logger.warning("Slow email_received receiver %s took %.3fs", name, elapsed)
+
+
+def send_email_received(sender, email, request):
+    """Send the email_received signal, timing each receiver (see call_receiver).
+
+    Returns a list of (receiver, response) tuples, as Signal.send does - or,
+    if INBOUND_EMAIL_ROBUST_RECEIVERS is True, as Signal.send_robust does.
+    """
+    return email_received.send(sender=sender, email=email, request=request)
+
+
+def _send(sender, email, request):
+    """Send the email_received signal from a background thread."""
+    close_old_connections()
+    try:
+        send_email_received(sender=sender, email=email, request=request)
+    except Exception:
+        logger.exception("Error in email_received receiver for %r", email)
+    finally:
+        close_old_connections()
+
+
+class SyncDispatcher(object):
+    """Sends the email_received signal synchronously (the default)."""
+
+    def dispatch(self, sender, email, request):
+        """Deliver the email to the email_received receivers."""
+        send_email_received(sender=sender, email=email, request=request)
+
+    def drain(self, timeout=None):
+        """Wait for queued emails to be delivered; return True if all were."""
+        return True
+
+    def shutdown(self, timeout=None):
+        """Drain the queue, and then stop any background workers."""
+        return self.drain(timeout=timeout)
+
+
+class ThreadPoolDispatcher(SyncDispatcher):
+    """Sends the email_received signal from an in-process thread pool.
+
+    Args:
+        max_workers: the number of threads running receivers.
+        max_pending: the maximum number of emails waiting in (or being
+            processed by) the pool. Once this is reached, `dispatch` will wait
+            up to `timeout` seconds for space, and then fall back to sending
+            the signal synchronously - slowing down the request is preferable
+            to dropping the email, and it provides natural backpressure.
+        timeout: seconds to wait for space in the queue.
+    """
+
+    def __init__(self, max_workers=4, max_pending=100, timeout=1.0):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='inbound-email',
+        )
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = 0
+        self._idle = threading.Condition()
+
+    def _release(self, future):
+        with self._idle:
+            self._pending -= 1
+            self._idle.notify_all()
+        self._slots.release()
+
+    def dispatch(self, sender, email, request):
+        if not self._slots.acquire(timeout=self.timeout):
+            logger.warning("Inbound email queue is full, dispatching synchronously.")
+            return super(ThreadPoolDispatcher, self).dispatch(sender, email, request)
+
+        with self._idle:
+            self._pending += 1
+        future = self._executor.submit(
+            _send, sender, _detach_email(email), _detach_request(request)
+        )
+        future.add_done_callback(self._release)
+
+    def drain(self, timeout=None):
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout=timeout)
+
+    def shutdown(self, timeout=None):
+        drained = self.drain(timeout=timeout)
+        self._executor.shutdown(wait=drained)
+        return drained
+
+
+class FileSpoolDispatcher(SyncDispatcher):
+    """Spools emails to a local directory, and delivers them from a thread.
+
+    Each email is pickled (with a copy of the request, minus the uploaded
+    files) and written atomically to its own file in `directory`, so that
+    queued emails survive a restart. A background thread in each process
+    claims files (by renaming them, so that several processes can share the
+    same directory) and sends the signal.
+
+    Args:
+        directory: the spool directory (created if it does not exist).
+        max_pending: once this many emails are waiting in the spool,
+            `dispatch` sends the signal synchronously instead.
+        poll_interval: seconds the worker sleeps when the spool is empty.
+    """
+
+    suffix = '.email'
+
+    def __init__(self, directory, max_pending=1000, poll_interval=1.0):
+        self.directory = directory
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+        os.makedirs(directory, exist_ok=True)
+        self._stopping = threading.Event()
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    def _pending_files(self):
+        return sorted(
+            entry.name for entry in os.scandir(self.directory)
+            if entry.name.endswith(self.suffix)
+        )
+
+    def _claimed_files(self):
+        suffix = '.%s.claimed' % os.getpid()
+        return [
+            entry.name for entry in os.scandir(self.directory)
+            if entry.name.endswith(suffix)
+        ]
+
+    def _start_worker(self):
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name='inbound-email-spool', daemon=True
+                )
+                self._worker.start()
+
+    def _write(self, payload):
+        # timestamp prefix so that emails are delivered in (rough) order
+        name = '%.6f-%s' % (time.time(), uuid.uuid4().hex)
+        tmp_path = os.path.join(self.directory, name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.directory, name + self.suffix))
+
+    def dispatch(self, sender, email, request):
+        self._start_worker()
+        if len(self._pending_files()) >= self.max_pending:
+            logger.warning("Inbound email spool is full, dispatching synchronously.")
+            return super(FileSpoolDispatcher, self).dispatch(sender, email, request)
+
+        self._write((sender, _detach_email(email), _detach_request(request)))
+        self._wakeup.set()
+
+    def _process(self, name):
+        path = os.path.join(self.directory, name)
+        claimed = '%s.%s.claimed' % (path, os.getpid())
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            # another process got there first
+            return
+        try:
+            with open(claimed, 'rb') as f:
+                sender, email, request = pickle.load(f)
+        except Exception:
+            logger.exception("Unable to load spooled email %s", claimed)
+            os.rename(claimed, path + '.failed')
+            return
+        _send(sender, email, request)
+        os.remove(claimed)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                names = self._pending_files()
+                for name in names:
+                    self._process(name)
+            except Exception:
+                logger.exception("Error processing inbound email spool.")
+                names = []
+            if not names:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def drain(self, timeout=None):
+        self._start_worker()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._pending_files() or self._claimed_files():
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            self._wakeup.set()
+            time.sleep(0.01)
+        return True
+
+    def shutdown(self, timeout=None):
+        drained = self.drain(timeout=timeout)
+        self._stopping.set()
+        self._wakeup.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+        return drained
+
+
+def get_dispatcher():
+    """Return the shared instance of the configured dispatcher."""
+    path = getattr(settings, 'INBOUND_EMAIL_DISPATCHER', DEFAULT_DISPATCHER)
+    try:
+        return _dispatchers[path]
+    except KeyError:
+        pass
+
+    with _dispatcher_lock:
+        if path not in _dispatchers:
+            package, klass = path.rsplit('.', 1)
+            options = getattr(settings, 'INBOUND_EMAIL_DISPATCHER_OPTIONS', {})
+            _dispatchers[path] = getattr(import_module(package), klass)(**options)
+        return _dispatchers[path]
+
+
+def shutdown_dispatchers(timeout=None):
+    """Drain and stop all dispatchers - this is run at exit.
+
+    Call this from your process manager's shutdown hook (e.g. gunicorn's
+    worker_exit) if the interpreter may be stopped without running atexit.
+    """
+    with _dispatcher_lock:
+        dispatchers = list(_dispatchers.values())
+        _dispatchers.clear()
+    for dispatcher in dispatchers:
+        if not dispatcher.shutdown(timeout=timeout):
+            logger.warning("%r did not drain before shutdown.", dispatcher)
+
+
+@atexit.register
+def _shutdown_at_exit():
+    shutdown_dispatchers(
+        timeout=getattr(settings, 'INBOUND_EMAIL_DISPATCHER_SHUTDOWN_TIMEOUT', 30)
+    )
+
+
+@receiver(setting_changed)
+def _reset_dispatchers(sender, setting, **kwargs):
+    """Shut down the dispatchers when the dispatcher settings are changed."""
+    if setting in ('INBOUND_EMAIL_DISPATCHER', 'INBOUND_EMAIL_DISPATCHER_OPTIONS'):
+        shutdown_dispatchers()
@@ -4,6 +4,19 @@ class RequestParseError(Exception):
     pass
 
 
+class RequestTooLargeError(RequestParseError):
+    """Error raised when a request is too large to spool."""
+
+    def __init__(self, size):
+        super(RequestTooLargeError, self).__init__(
+            "Inbound request is too large to spool (%sB)" % size
+        )
+        self.size = size
+
+    def __reduce__(self):
+        return (self.__class__, (self.size,))
+
+
 class AttachmentTooLargeError(Exception):
     """Error raised when an attachment is too large."""
 
@@ -13,7 +26,49 @@ class AttachmentTooLargeError(Exception):
         self.filename = filename
         self.size = size
 
+    def __reduce__(self):
+        # so that the error can be raised in a worker process (see mandrill)
+        return (self.__class__, (self.email, self.filename, self.size))
+
+
+class MessageTooLargeError(AttachmentTooLargeError):
+    """Error raised when the total size of a message's attachments is too large."""
+    pass
+
 
 class AuthenticationError(Exception):
     """Error raised when the request is not authenticated."""
     pass
+
+
+class RateLimitedError(Exception):
+    """Error raised when an email's sender or recipient has exceeded its rate limit."""
+
+    def __init__(self, envelope, limit, key):
+        super(RateLimitedError, self).__init__(
+            "Inbound email %s rate limit exceeded: %s" % (limit, key)
+        )
+        # NB there is no email, as it is rejected before it is parsed
+        self.email = None
+        self.envelope = envelope
+        self.limit = limit
+        self.key = key
+
+    def __reduce__(self):
+        return (self.__class__, (self.envelope, self.limit, self.key))
+
+
+class LoopDetectedError(Exception):
+    """Error raised when an email is an auto-reply that looks like part of a mail loop."""
+
+    def __init__(self, envelope, reason):
+        super(LoopDetectedError, self).__init__(
+            "Inbound email rejected (%s): %s" % (reason, envelope.subject)
+        )
+        # NB there is no email, as it is rejected before it is parsed
+        self.email = None
+        self.envelope = envelope
+        self.reason = reason
+
+    def __reduce__(self):
+        return (self.__class__, (self.envelope, self.reason))
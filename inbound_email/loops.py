@@ -0,0 +1,143 @@
+"""Detection of auto-replies, and of mail loops between autoresponders.
+
+An out-of-office reply to one of your own notifications can start a loop -
+if your receiver replies to it, and so on. The backends flag auto-replies in
+each email's Envelope (`auto_reply`), from its headers:
+
+* Auto-Submitted - anything other than 'no' (RFC 3834)
+* Precedence - 'bulk', 'junk' or 'auto_reply'
+* X-Autoreply / X-Autorespond - set by some autoresponders
+* Return-Path - '<>', as used by autoresponders and bounces
+
+If INBOUND_EMAIL_LOOP_TIMEOUT is set, then the first auto-reply in each
+thread (the same sender, recipients and subject, ignoring any 'Re:' etc.
+prefixes) is received as normal, but any more within that many seconds of
+it being received (i.e. dispatched, see `record`) are treated as a loop: the email is dropped before it is parsed any further, and
+sent with email_received_unacceptable (with a LoopDetectedError) instead. Set
+INBOUND_EMAIL_REJECT_AUTO_REPLIES to drop every auto-reply in the same way.
+
+The threads are held in an in-process LRU cache (of INBOUND_EMAIL_LOOP_MAX_SIZE
+threads, default=1000), in front of the Django cache named by
+INBOUND_EMAIL_LOOP_CACHE (default='default'; set this to None to use the
+in-process cache only).
+"""
+import re
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .dedupe import RecentKeys, digest
+from .errors import LoopDetectedError
+from .message import normalize_address
+
+AUTO_REPLY_PRECEDENCE = frozenset(['bulk', 'junk', 'auto_reply'])
+
+# 'Re: Fwd: AW: Automatic reply: ...' => '...'
+_SUBJECT_PREFIX = re.compile(
+    r'^(\s*(re|fw|fwd|aw|wg|sv|auto|automatic reply|out of office|autoreply)\s*(\[\d+\])?\s*:)+\s*',
+    re.IGNORECASE
+)
+
+
+def is_auto_reply(headers):
+    """Return True if the headers are those of an auto-reply.
+
+    Args:
+        headers: an iterable of (name, value) header pairs.
+    """
+    for name, value in headers:
+        name = name.lower()
+        value = (value or '').strip().lower()
+        if name == 'auto-submitted':
+            if value and value != 'no':
+                return True
+        elif name == 'precedence':
+            if value in AUTO_REPLY_PRECEDENCE:
+                return True
+        elif name in ('x-autoreply', 'x-autorespond'):
+            if value and value != 'no':
+                return True
+        elif name == 'return-path':
+            if value.replace(' ', '') == '<>':
+                return True
+    return False
+
+
+def normalize_subject(subject):
+    """Return the subject without any reply/forward/auto-reply prefixes."""
+    return _SUBJECT_PREFIX.sub('', subject or '').strip().lower()
+
+
+def get_thread_key(envelope):
+    """Return a key identifying the envelope's (or email's) thread."""
+    recipients = sorted({normalize_address(a) for a in list(envelope.to) + list(envelope.cc) if a})
+    return digest(
+        [normalize_address(envelope.from_email or ''), normalize_subject(envelope.subject)] +
+        recipients
+    )
+
+
+_recent_threads = None
+_recent_threads_lock = threading.Lock()
+
+
+def _get_recent_threads():
+    """Return the RecentKeys for auto-reply threads, or None if detection is disabled."""
+    global _recent_threads
+    timeout = getattr(settings, 'INBOUND_EMAIL_LOOP_TIMEOUT', None)
+    if not timeout:
+        return None
+    with _recent_threads_lock:
+        if _recent_threads is None:
+            _recent_threads = RecentKeys(
+                prefix='inbound_email:loops:',
+                timeout=timeout,
+                max_size=getattr(settings, 'INBOUND_EMAIL_LOOP_MAX_SIZE', 1000),
+                cache_alias=getattr(settings, 'INBOUND_EMAIL_LOOP_CACHE', 'default'),
+            )
+        return _recent_threads
+
+
+def enabled():
+    """Return True if auto-replies are rejected, or loops are detected."""
+    return bool(
+        getattr(settings, 'INBOUND_EMAIL_REJECT_AUTO_REPLIES', False) or
+        getattr(settings, 'INBOUND_EMAIL_LOOP_TIMEOUT', None)
+    )
+
+
+def check(envelope):
+    """Raise LoopDetectedError if the envelope is an auto-reply that should be dropped.
+
+    Threads are only checked, not recorded - see `record`.
+    """
+    if not envelope.auto_reply:
+        return
+    if getattr(settings, 'INBOUND_EMAIL_REJECT_AUTO_REPLIES', False):
+        raise LoopDetectedError(envelope, "auto-reply")
+    recent = _get_recent_threads()
+    if recent is not None and recent.contains(get_thread_key(envelope)):
+        raise LoopDetectedError(envelope, "repeated auto-reply in thread")
+
+
+def record(thread_key):
+    """Record the thread of an auto-reply that has been received.
+
+    The parser calls this once the email has been dispatched (see
+    RequestParser.received), so that an auto-reply that failed isn't
+    dropped as a loop when the provider retries it.
+    """
+    recent = _get_recent_threads()
+    if recent is not None:
+        recent.add(thread_key)
+
+
+@receiver(setting_changed)
+def _reset_recent_threads(sender, setting, **kwargs):
+    """Reset the thread cache when the loop settings are changed."""
+    global _recent_threads
+    if setting.startswith('INBOUND_EMAIL_LOOP_'):
+        with _recent_threads_lock:
+            _recent_threads = None
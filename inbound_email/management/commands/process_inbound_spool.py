@@ -0,0 +1,128 @@
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+
+from ...spool import deserialize_request, get_spool, iter_records
+from ...views import process_inbound_request
+
+logger = logging.getLogger(__name__)
+
+
+def process_segment(spool, path):
+    """Process each request in a claimed segment, and then delete it.
+
+    Requests that raise an error, or get an error response (e.g. a 400, for
+    a RequestParseError with INBOUND_EMAIL_RESPONSE_200=False), are saved
+    with write_failed - the provider was sent a 200 when they were spooled,
+    so it won't retry them. Returns a (processed, failed) tuple of the
+    number of requests.
+    """
+    processed = failed = 0
+    for record in iter_records(path):
+        close_old_connections()
+        try:
+            response = process_inbound_request(deserialize_request(record))
+        except Exception:
+            logger.exception("Error processing spooled request from %s", path)
+            spool.write_failed(path, record)
+            failed += 1
+            continue
+        if response.status_code >= 400:
+            logger.error(
+                "Error response (%s) to spooled request from %s", response.status_code, path
+            )
+            spool.write_failed(path, record)
+            failed += 1
+        else:
+            processed += 1
+    close_old_connections()
+    os.remove(path)
+    return processed, failed
+
+
+def run_worker(once=False, poll_interval=1.0):
+    """Claim and process segments until stopped (or the spool is empty, if once)."""
+    spool = get_spool()
+    stopping = threading.Event()
+
+    def _stop(signum, frame):
+        # finish the current segment, rather than leave it half-processed
+        stopping.set()
+
+    previous = signal.signal(signal.SIGTERM, _stop)
+    try:
+        while not stopping.is_set():
+            path = spool.claim_segment()
+            if path is None:
+                if once:
+                    break
+                stopping.wait(poll_interval)
+                continue
+            processed, failed = process_segment(spool, path)
+            logger.info(
+                "Processed %s spooled requests from %s (%s failed)",
+                processed, os.path.basename(path), failed
+            )
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+
+def _worker_process(**kwargs):
+    # NB a no-op for forked processes, but required if they are spawned
+    django.setup()
+    run_worker(**kwargs)
+
+
+class Command(BaseCommand):
+
+    help = "Process the inbound email requests saved in INBOUND_EMAIL_SPOOL_DIRECTORY."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help="The number of worker processes (default=1, in this process).",
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help="Exit once the spool is empty, rather than waiting for more requests.",
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=1.0,
+            help="Seconds to wait before checking an empty spool again (default=1).",
+        )
+
+    def handle(self, *args, **options):
+        if get_spool() is None:
+            raise CommandError("INBOUND_EMAIL_SPOOL_DIRECTORY is not set.")
+
+        workers = options['workers']
+        if workers < 1:
+            raise CommandError("--workers must be at least 1.")
+
+        kwargs = {'once': options['once'], 'poll_interval': options['poll_interval']}
+        if workers == 1:
+            run_worker(**kwargs)
+            return
+
+        # don't share database connections with the child processes
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(target=_worker_process, kwargs=kwargs, name='inbound-spool-%s' % i)
+            for i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join()
@@ -0,0 +1,148 @@
+"""A lightweight alternative to EmailMultiAlternatives for inbound emails.
+
+Receivers that only look at the addresses and subject (e.g. to route the
+email) don't need the full EmailMultiAlternatives, so backends can be set to
+return an InboundEmail instead (see RequestParser.lightweight). Its body and
+attachments are only decoded when they are accessed, and it can be converted
+into an EmailMultiAlternatives with `to_email_message()` when needed.
+
+The Envelope is the even cheaper summary of an email that is sent with
+email_envelope_received before the email itself is parsed.
+"""
+from collections import namedtuple
+from email.utils import parseaddr
+
+from django.core.mail import EmailMultiAlternatives
+
+
+# the headers of an email, parsed without its body or attachments (see
+# RequestParser.parse_envelope) - to and cc are lists of addresses, message_id
+# and spam_score (a float) are None if the email doesn't have them, and
+# auto_reply is True if the headers are those of an auto-reply (see
+# inbound_email.loops)
+Envelope = namedtuple(
+    'Envelope',
+    ['from_email', 'to', 'cc', 'subject', 'message_id', 'spam_score', 'auto_reply'],
+    defaults=(False,)
+)
+
+
+def normalize_address(address):
+    """Return the address without any display name, lower-cased."""
+    if '<' in address:
+        address = parseaddr(address)[1]
+    return address.strip().lower()
+
+
+class InboundEmail(object):
+    """An immutable inbound email.
+
+    Args:
+        subject: the subject line.
+        from_email: the sender's address.
+        to, cc, bcc: sequences of recipient addresses.
+        body: the text body, or a callable that returns it.
+        html: the HTML body (or None), or a callable that returns it.
+        attachments: a sequence of (filename, content, mimetype) tuples or
+            LazyAttachments, or a callable that returns one.
+
+    The callables are called (once) when the value is first accessed.
+    """
+
+    __slots__ = ('subject', 'from_email', 'to', 'cc', 'bcc', '_body', '_html', '_attachments')
+
+    def __init__(self, subject, from_email, to=(), cc=(), bcc=(), body='', html=None,
+                 attachments=()):
+        _set = super(InboundEmail, self).__setattr__
+        _set('subject', subject)
+        _set('from_email', from_email)
+        _set('to', tuple(to))
+        _set('cc', tuple(cc))
+        _set('bcc', tuple(bcc))
+        _set('_body', body)
+        _set('_html', html)
+        _set('_attachments', attachments if callable(attachments) else tuple(attachments))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("InboundEmail is immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("InboundEmail is immutable.")
+
+    def _resolve(self, name):
+        value = getattr(self, name)
+        if callable(value):
+            value = value()
+            if name == '_attachments':
+                value = tuple(value)
+            super(InboundEmail, self).__setattr__(name, value)
+        return value
+
+    @property
+    def body(self):
+        return self._resolve('_body')
+
+    @property
+    def html(self):
+        return self._resolve('_html')
+
+    @property
+    def attachments(self):
+        return self._resolve('_attachments')
+
+    @property
+    def alternatives(self):
+        """The HTML body as EmailMultiAlternatives.alternatives, for compatibility."""
+        html = self.html
+        return [(html, "text/html")] if html else []
+
+    def recipients(self):
+        """Return a list of all recipients of the email (to, cc and bcc)."""
+        return [email for email in (self.to + self.cc + self.bcc) if email]
+
+    def replace(self, **changes):
+        """Return a copy of the email, with the given fields replaced."""
+        fields = {
+            'subject': self.subject,
+            'from_email': self.from_email,
+            'to': self.to,
+            'cc': self.cc,
+            'bcc': self.bcc,
+            'body': self._body,
+            'html': self._html,
+            'attachments': self._attachments,
+        }
+        fields.update(changes)
+        return InboundEmail(**fields)
+
+    def to_email_message(self):
+        """Return the email as an EmailMultiAlternatives."""
+        email = EmailMultiAlternatives(
+            subject=self.subject,
+            body=self.body,
+            from_email=self.from_email,
+            to=list(self.to),
+            cc=list(self.cc),
+            bcc=list(self.bcc),
+        )
+        if self.html:
+            email.attach_alternative(self.html, "text/html")
+        email.attachments.extend(self.attachments)
+        return email
+
+    def __reduce__(self):
+        # the callables may not be picklable, so they are resolved first
+        return (InboundEmail, (
+            self.subject, self.from_email, self.to, self.cc, self.bcc,
+            self.body, self.html, self.attachments,
+        ))
+
+    def __eq__(self, other):
+        if not isinstance(other, InboundEmail):
+            return NotImplemented
+        return self.__reduce__() == other.__reduce__()
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<InboundEmail: %r from %s to %s>" % (self.subject, self.from_email, list(self.to))
@@ -0,0 +1,255 @@
+"""Per-request timings and counters, for monitoring inbound email processing.
+
+The view collects a RequestMetrics for each request - the time spent in each
+stage, and counters for the emails, attachments and bytes received and the
+failures (by error class) - and sends it with the `metrics_recorded` signal
+once the request has been handled. Connect your own receiver to the signal,
+or list the sinks to send the metrics to in INBOUND_EMAIL_METRICS_SINKS (a
+dict of dotted paths to sink classes, and the kwargs to instantiate them
+with). Two sinks are included - StatsDSink and PrometheusSink.
+
+The stages are:
+
+* multipart - parsing the request body (request.POST and request.FILES)
+* signature - checking the request signature or credentials (if configured)
+* parse - parsing the emails out of the request
+* envelope - sending email_envelope_received (part of parse, and only if it
+  has any receivers)
+* dispatch - handing the emails to the dispatcher (which, by default, runs
+  the email_received receivers)
+* total - the whole request
+
+Backends can time their own stages with `timer(stage)`, and add to the
+counters with `incr(name)`; both do nothing outside of a request.
+"""
+import contextvars
+import logging
+import socket
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from importlib import import_module
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .signals import metrics_recorded
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('inbound_email_metrics', default=None)
+
+
+class RequestMetrics(object):
+    """The timings (in seconds) and counters recorded for a single request."""
+
+    def __init__(self):
+        self.timings = {}
+        self.counters = Counter()
+
+    @contextmanager
+    def timer(self, stage):
+        """Add the time spent in the block to the stage's timing."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0) + time.perf_counter() - start
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def __repr__(self):
+        return "<RequestMetrics: %r %r>" % (self.timings, dict(self.counters))
+
+
+def current():
+    """Return the RequestMetrics for the current request, or None."""
+    return _current.get()
+
+
+@contextmanager
+def timer(stage):
+    """Time the block as `stage` of the current request (if any)."""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+    else:
+        with metrics.timer(stage):
+            yield
+
+
+def incr(name, value=1):
+    """Add to a counter of the current request (if any)."""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.incr(name, value)
+
+
+def record_failure(exception):
+    """Count a failure of the current request, by error class."""
+    incr('failures.%s' % exception.__class__.__name__)
+
+
+@contextmanager
+def collect(sender):
+    """Collect the metrics for a request, and send metrics_recorded at the end.
+
+    Args:
+        sender: the backend class that is handling the request.
+    """
+    metrics = RequestMetrics()
+    token = _current.set(metrics)
+    try:
+        with metrics.timer('total'):
+            yield metrics
+    except Exception as ex:
+        record_failure(ex)
+        raise
+    finally:
+        _current.reset(token)
+        try:
+            metrics_recorded.send(sender=sender, metrics=metrics)
+        except Exception:
+            # metrics must never break the handling of the email
+            logger.exception("Error sending inbound email metrics.")
+
+
+class StatsDSink(object):
+    """Sends the metrics to a StatsD server, as a single UDP packet per request.
+
+    Timings are sent in milliseconds as `<prefix>.<backend>.<stage>:<ms>|ms`
+    and counters as `<prefix>.<backend>.<name>:<value>|c`.
+
+    Args:
+        host: the StatsD host.
+        port: the StatsD port.
+        prefix: the prefix added to each metric name.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='inbound_email'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format(self, sender, metrics):
+        """Return the StatsD lines for the metrics."""
+        prefix = '%s.%s' % (self.prefix, sender.__name__)
+        lines = [
+            '%s.%s:%.3f|ms' % (prefix, stage, seconds * 1000)
+            for stage, seconds in sorted(metrics.timings.items())
+        ]
+        lines += [
+            '%s.%s:%s|c' % (prefix, name, value)
+            for name, value in sorted(metrics.counters.items())
+        ]
+        return '\n'.join(lines)
+
+    def __call__(self, sender, metrics, **kwargs):
+        try:
+            self._socket.sendto(self.format(sender, metrics).encode('utf-8'), self.address)
+        except OSError:
+            logger.debug("Unable to send inbound email metrics to StatsD.", exc_info=True)
+
+
+class PrometheusSink(object):
+    """Aggregates the metrics in memory, to be scraped in the Prometheus text format.
+
+    Expose `render()` from a view to be scraped, e.g.
+
+        def metrics(request):
+            sink = get_sinks()[0]
+            return HttpResponse(sink.render(), content_type=PrometheusSink.content_type)
+
+    The metrics are per-process, so each process must be scraped.
+
+    Args:
+        namespace: the prefix added to each metric name.
+    """
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, namespace='inbound_email'):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._requests = Counter()
+        self._counters = Counter()
+        self._failures = Counter()
+        self._seconds = Counter()
+        self._stages = Counter()
+
+    def __call__(self, sender, metrics, **kwargs):
+        backend = sender.__name__
+        with self._lock:
+            self._requests[backend] += 1
+            for stage, seconds in metrics.timings.items():
+                self._seconds[(backend, stage)] += seconds
+                self._stages[(backend, stage)] += 1
+            for name, value in metrics.counters.items():
+                if name.startswith('failures.'):
+                    self._failures[(backend, name.split('.', 1)[1])] += value
+                else:
+                    self._counters[(name, backend)] += value
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        ns = self.namespace
+        lines = []
+        with self._lock:
+            lines.append('# TYPE %s_requests_total counter' % ns)
+            for backend, value in sorted(self._requests.items()):
+                lines.append('%s_requests_total{backend="%s"} %s' % (ns, backend, value))
+
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append('# TYPE %s_%s_total counter' % (ns, name))
+                for (counter, backend), value in sorted(self._counters.items()):
+                    if counter == name:
+                        lines.append('%s_%s_total{backend="%s"} %s' % (ns, name, backend, value))
+
+            lines.append('# TYPE %s_failures_total counter' % ns)
+            for (backend, error), value in sorted(self._failures.items()):
+                lines.append(
+                    '%s_failures_total{backend="%s",error="%s"} %s' % (ns, backend, error, value)
+                )
+
+            lines.append('# TYPE %s_stage_seconds summary' % ns)
+            for (backend, stage), value in sorted(self._seconds.items()):
+                labels = '{backend="%s",stage="%s"}' % (backend, stage)
+                lines.append('%s_stage_seconds_sum%s %.6f' % (ns, labels, value))
+                lines.append('%s_stage_seconds_count%s %s' % (
+                    ns, labels, self._stages[(backend, stage)]
+                ))
+        return '\n'.join(lines) + '\n'
+
+
+_sinks = None
+_sinks_lock = threading.Lock()
+
+
+def get_sinks():
+    """Return the sinks configured in INBOUND_EMAIL_METRICS_SINKS."""
+    global _sinks
+    with _sinks_lock:
+        if _sinks is None:
+            _sinks = []
+            for path, options in getattr(settings, 'INBOUND_EMAIL_METRICS_SINKS', {}).items():
+                package, klass = path.rsplit('.', 1)
+                _sinks.append(getattr(import_module(package), klass)(**(options or {})))
+        return _sinks
+
+
+@receiver(metrics_recorded)
+def _send_to_sinks(sender, metrics, **kwargs):
+    for sink in get_sinks():
+        sink(sender=sender, metrics=metrics)
+
+
+@receiver(setting_changed)
+def _reset_sinks(sender, setting, **kwargs):
+    """Recreate the sinks when the sinks setting is changed."""
+    global _sinks
+    if setting == 'INBOUND_EMAIL_METRICS_SINKS':
+        with _sinks_lock:
+            _sinks = None
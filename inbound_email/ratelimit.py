@@ -0,0 +1,159 @@
+"""Rate limiting of inbound emails, by sender and by recipient.
+
+A misbehaving sender, or a mail loop, can send thousands of emails a minute.
+If INBOUND_EMAIL_RATE_LIMIT_SENDER and/or INBOUND_EMAIL_RATE_LIMIT_RECIPIENT
+are set (as '<count>/<period>', where the period is 's', 'm', 'h' or 'd', e.g.
+'60/m'), then each sender (and each recipient) has a token bucket that holds
+up to <count> emails, and is refilled at <count> per <period>. As soon as an
+email's envelope has been parsed, a token is taken from the bucket of its
+sender and of each of its recipients, and if any of them is empty the email
+is dropped, and sent with email_received_unacceptable (with a RateLimitedError)
+rather than being parsed any further.
+
+The buckets are held in-process (an LRU of INBOUND_EMAIL_RATE_LIMIT_MAX_SIZE
+keys, default=10000), or in the Django cache named by
+INBOUND_EMAIL_RATE_LIMIT_CACHE, so that they are shared across processes and
+servers. NB the cache is not updated atomically, so concurrent requests may
+let a few more emails through than the limit.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .errors import RateLimitedError
+from .message import normalize_address
+
+PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+def parse_rate(rate):
+    """Return (count, seconds) for a rate such as '60/m'."""
+    try:
+        count, period = rate.split('/')
+        return int(count), PERIODS[period.strip().lower()[:1]]
+    except (AttributeError, KeyError, ValueError):
+        raise ValueError("Invalid rate limit: %r (expected e.g. '60/m')." % rate)
+
+
+class TokenBucketLimiter(object):
+    """A token bucket per key, holding up to `count` tokens, refilled at count/period.
+
+    Args:
+        prefix: prefix added to the keys stored in the Django cache.
+        count: the size of each bucket.
+        period: the number of seconds it takes to refill an empty bucket.
+        max_size: the max number of buckets held in-process.
+        cache_alias: the Django cache to hold the buckets in, or None to hold
+            them in-process.
+    """
+
+    def __init__(self, prefix, count, period, max_size=10000, cache_alias=None):
+        self.prefix = prefix
+        self.count = count
+        self.period = period
+        self.rate = count / period
+        self.max_size = max_size
+        self.cache_alias = cache_alias
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _take(self, bucket, now):
+        """Return (allowed, bucket) after taking a token from the bucket."""
+        if bucket is None:
+            tokens = self.count
+        else:
+            tokens, last = bucket
+            tokens = min(self.count, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            return False, (tokens, now)
+        return True, (tokens - 1, now)
+
+    def allow(self, key):
+        """Take a token for the key; return False if its bucket is empty."""
+        now = time.time()
+
+        if self.cache_alias is not None:
+            # hash the key, as cache backends restrict key length and characters
+            key = self.prefix + hashlib.sha1(key.encode('utf-8')).hexdigest()
+            cache = caches[self.cache_alias]
+            allowed, bucket = self._take(cache.get(key), now)
+            # a bucket that has been left for a whole period is full again
+            cache.set(key, bucket, self.period)
+            return allowed
+
+        with self._lock:
+            allowed, self._local[key] = self._take(self._local.get(key), now)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+        return allowed
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+
+
+_limiters = None
+_limiters_lock = threading.Lock()
+
+
+def _get_limiter(name):
+    rate = getattr(settings, 'INBOUND_EMAIL_RATE_LIMIT_%s' % name.upper(), None)
+    if not rate:
+        return None
+    count, period = parse_rate(rate)
+    return TokenBucketLimiter(
+        prefix='inbound_email:ratelimit:%s:' % name,
+        count=count,
+        period=period,
+        max_size=getattr(settings, 'INBOUND_EMAIL_RATE_LIMIT_MAX_SIZE', 10000),
+        cache_alias=getattr(settings, 'INBOUND_EMAIL_RATE_LIMIT_CACHE', None),
+    )
+
+
+def get_limiters():
+    """Return the (sender, recipient) limiters - either may be None if it is not set."""
+    global _limiters
+    with _limiters_lock:
+        if _limiters is None:
+            _limiters = (_get_limiter('sender'), _get_limiter('recipient'))
+        return _limiters
+
+
+def enabled():
+    """Return True if either rate limit is set."""
+    return any(get_limiters())
+
+
+def check(envelope):
+    """Take a token for the envelope's sender and recipients.
+
+    Raises RateLimitedError if any of them has exceeded its rate limit.
+    """
+    sender_limiter, recipient_limiter = get_limiters()
+    if sender_limiter is not None and envelope.from_email:
+        sender = normalize_address(envelope.from_email)
+        if not sender_limiter.allow(sender):
+            raise RateLimitedError(envelope, 'sender', sender)
+
+    if recipient_limiter is not None:
+        recipients = {normalize_address(a) for a in list(envelope.to) + list(envelope.cc) if a}
+        # sorted, so that the same recipient is reported each time
+        for recipient in sorted(recipients):
+            if not recipient_limiter.allow(recipient):
+                raise RateLimitedError(envelope, 'recipient', recipient)
+
+
+@receiver(setting_changed)
+def _reset_limiters(sender, setting, **kwargs):
+    """Recreate the limiters when the rate limit settings are changed."""
+    global _limiters
+    if setting.startswith('INBOUND_EMAIL_RATE_LIMIT_'):
+        with _limiters_lock:
+            _limiters = None
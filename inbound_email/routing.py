@@ -0,0 +1,207 @@
+"""Route inbound emails to handlers by recipient address.
+
+Rather than each email_received receiver scanning the recipients itself, a
+Router maps address patterns to handlers:
+
+    router = Router()
+
+    @router.register('support@example.com')
+    def on_support_email(sender, email, request, match, **kwargs):
+        ...
+
+The patterns are:
+
+* 'support@example.com' - that exact address ('support@*' for any domain)
+* 'reply+*@example.com' - plus-addresses, e.g. reply+abc123@example.com, with
+  the part after the '+' as `match.tag` ('reply+*@*' for any domain)
+* '*@example.com' - any address at that domain
+* '*@*.example.com' - any address at a subdomain of example.com
+* '*@*' - any address at all
+
+Patterns are compiled into dicts, so each recipient is routed with a handful
+of lookups (the most specific match wins, in the order above), however many
+patterns are registered. Addresses are matched case-insensitively.
+
+Set INBOUND_EMAIL_ROUTER to the dotted path of your Router instance to use
+it. The backends then check the recipients as soon as the addresses have been
+parsed, and drop any email that has no route before its attachments are
+processed. Each routed email is still sent with email_received (so
+background dispatch etc. works as normal), and the router's receiver calls
+the handler once for each matching recipient.
+"""
+import threading
+from collections import namedtuple
+from email.utils import parseaddr
+from importlib import import_module
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .signals import email_received
+
+ANY = '*'
+
+# the recipient that was routed: address is as given (without any display
+# name), local/domain are lower-cased, and tag is the plus-address tag (as
+# given, as tokens may be case-sensitive) or None.
+Match = namedtuple('Match', ['address', 'local', 'domain', 'tag', 'pattern'])
+
+
+def _split_address(address):
+    """Return (address, local, domain) for a recipient, or None if it isn't one."""
+    if '<' in address:
+        address = parseaddr(address)[1]
+    address = address.strip()
+    local, at, domain = address.rpartition('@')
+    if not at or not local or not domain:
+        return None
+    return address, local, domain.lower()
+
+
+class Router(object):
+    """Maps recipient address patterns to handlers (see module docstring).
+
+    Args:
+        separator: the character that separates the plus-address tag.
+    """
+
+    def __init__(self, separator='+'):
+        self.separator = separator
+        self._exact = {}
+        self._plus = {}
+        self._domains = {}
+        self._subdomains = {}
+
+    def register(self, pattern, handler=None):
+        """Route recipients that match the pattern to the handler.
+
+        The handler is called with the sender, email, request and match (a
+        Match) keyword args. Can also be used as a decorator, without the
+        handler. Raises ValueError if the pattern is invalid or has already
+        been registered.
+        """
+        if handler is None:
+            def decorator(func):
+                self.register(pattern, func)
+                return func
+            return decorator
+
+        local, at, domain = pattern.lower().rpartition('@')
+        if not at or not local or not domain:
+            raise ValueError("Invalid route pattern: %r" % pattern)
+
+        if local == ANY:
+            if domain.startswith('*.'):
+                table, key = self._subdomains, domain[2:]
+            else:
+                table, key = self._domains, domain
+        elif local.endswith(self.separator + ANY):
+            table, key = self._plus, (local[:-len(self.separator + ANY)], domain)
+        else:
+            table, key = self._exact, (local, domain)
+
+        if key in table:
+            raise ValueError("Route pattern already registered: %r" % pattern)
+        table[key] = (handler, pattern)
+
+    def _lookup(self, local, domain):
+        lower = local.lower()
+        for key in ((lower, domain), (lower, ANY)):
+            if key in self._exact:
+                return self._exact[key], None
+
+        if self.separator in local:
+            base, tag = local.split(self.separator, 1)
+            base = base.lower()
+            for key in ((base, domain), (base, ANY)):
+                if key in self._plus:
+                    return self._plus[key], tag
+
+        if domain in self._domains:
+            return self._domains[domain], None
+
+        # walk up the parent domains: a.b.example.com, b.example.com, example.com
+        parent = domain
+        while '.' in parent:
+            parent = parent.split('.', 1)[1]
+            if parent in self._subdomains:
+                return self._subdomains[parent], None
+
+        if ANY in self._domains:
+            return self._domains[ANY], None
+        return None, None
+
+    def match(self, address):
+        """Return (handler, Match) for a recipient address, or None."""
+        parts = _split_address(address)
+        if parts is None:
+            return None
+        address, local, domain = parts
+        route, tag = self._lookup(local, domain)
+        if route is None:
+            return None
+        handler, pattern = route
+        return handler, Match(address, local.lower(), domain, tag, pattern)
+
+    def resolve(self, addresses):
+        """Return a list of (handler, Match) for each routed recipient.
+
+        Each address is only routed once, even if it is both in to and cc.
+        """
+        routes = []
+        seen = set()
+        for address in addresses:
+            if not address or address in seen:
+                continue
+            seen.add(address)
+            route = self.match(address)
+            if route is not None:
+                routes.append(route)
+        return routes
+
+    def is_routed(self, addresses):
+        """Return True if any of the addresses has a route."""
+        return any(address and self.match(address) for address in addresses)
+
+    def __call__(self, sender, email, request=None, **kwargs):
+        """Call the handler of each of the email's routed recipients."""
+        for handler, match in self.resolve(email.to + email.cc + email.bcc):
+            handler(sender=sender, email=email, request=request, match=match)
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    """Return the Router set by INBOUND_EMAIL_ROUTER, or None.
+
+    The router's receiver is connected to email_received when it is loaded.
+    """
+    global _router
+    path = getattr(settings, 'INBOUND_EMAIL_ROUTER', None)
+    if path is None:
+        return None
+    with _router_lock:
+        if _router is None:
+            module, name = path.rsplit('.', 1)
+            _router = getattr(import_module(module), name)
+            email_received.connect(_route_email, dispatch_uid=__name__)
+        return _router
+
+
+def _route_email(sender, email, request=None, **kwargs):
+    router = get_router()
+    if router is not None:
+        router(sender=sender, email=email, request=request)
+
+
+@receiver(setting_changed)
+def _reset_router(sender, setting, **kwargs):
+    """Reload the router when the router setting is changed."""
+    global _router
+    if setting == 'INBOUND_EMAIL_ROUTER':
+        with _router_lock:
+            _router = None
+            email_received.disconnect(dispatch_uid=__name__)
@@ -1,13 +1,117 @@
 # Signals definitions for django-inbound-email
+import weakref
+
 from django.dispatch import Signal
 
 
+def _receiver_id(receiver):
+    # as Signal.connect does, so that each receiver is only connected once
+    if hasattr(receiver, '__self__') and hasattr(receiver, '__func__'):
+        return (id(receiver.__self__), id(receiver.__func__))
+    return id(receiver)
+
+
+class _TimedReceiver(object):
+    """Wraps a receiver, to call it via inbound_email.dispatch.call_receiver."""
+
+    def __init__(self, receiver, weak, on_dead):
+        if not weak:
+            self._ref = lambda: receiver
+        elif hasattr(receiver, '__self__') and hasattr(receiver, '__func__'):
+            self._ref = weakref.WeakMethod(receiver, on_dead)
+        else:
+            self._ref = weakref.ref(receiver, on_dead)
+
+    @property
+    def receiver(self):
+        """The wrapped receiver, or None if it has been garbage collected."""
+        return self._ref()
+
+    def __call__(self, signal, sender, **named):
+        receiver = self._ref()
+        if receiver is None:
+            return None
+        # NB imported here, as dispatch imports this module
+        from .dispatch import call_receiver
+        return call_receiver(receiver, signal=signal, sender=sender, **named)
+
+
+class TimedSignal(Signal):
+    """A Signal that times each of its receivers (see inbound_email.dispatch).
+
+    Each receiver is wrapped when it is connected, so that only the public
+    Signal API is needed to time them one at a time. `send` and `send_robust`
+    return the original receivers with their responses.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedSignal, self).__init__(*args, **kwargs)
+        self._dead = []
+
+    def _lookup_uid(self, receiver, dispatch_uid):
+        return (
+            'inbound_email.timed',
+            _receiver_id(receiver) if dispatch_uid is None else dispatch_uid,
+        )
+
+    def _disconnect_dead(self):
+        # NB not done in the weakref callback, which may be called (by the
+        # garbage collector) while the signal's lock is already held
+        while self._dead:
+            sender, uid = self._dead.pop()
+            super(TimedSignal, self).disconnect(sender=sender, dispatch_uid=uid)
+
+    def connect(self, receiver, sender=None, weak=True, dispatch_uid=None):
+        self._disconnect_dead()
+        uid = self._lookup_uid(receiver, dispatch_uid)
+        wrapper = _TimedReceiver(receiver, weak, lambda ref: self._dead.append((sender, uid)))
+        super(TimedSignal, self).connect(wrapper, sender=sender, weak=False, dispatch_uid=uid)
+
+    def disconnect(self, receiver=None, sender=None, dispatch_uid=None):
+        self._disconnect_dead()
+        return super(TimedSignal, self).disconnect(
+            sender=sender, dispatch_uid=self._lookup_uid(receiver, dispatch_uid)
+        )
+
+    def has_listeners(self, sender=None):
+        self._disconnect_dead()
+        return super(TimedSignal, self).has_listeners(sender)
+
+    def _unwrap(self, responses):
+        # NB skip any receivers that were garbage collected during the send
+        return [
+            (receiver, response) for receiver, response in (
+                (wrapper.receiver, response) for wrapper, response in responses
+            )
+            if receiver is not None
+        ]
+
+    def send(self, sender, **named):
+        self._disconnect_dead()
+        return self._unwrap(super(TimedSignal, self).send(sender, **named))
+
+    def send_robust(self, sender, **named):
+        self._disconnect_dead()
+        return self._unwrap(super(TimedSignal, self).send_robust(sender, **named))
+
+
 # this is fired when a new email has been successfully parsed
 # from the inbound view function.
-email_received = Signal(providing_args=['email', 'request'])
+email_received = TimedSignal(providing_args=['email', 'request'])
+
+
+# this is fired with the envelope (see inbound_email.message.Envelope) of
+# each email, before its body and attachments are parsed - if any receiver
+# returns False then the email is dropped.
+email_envelope_received = Signal(providing_args=['envelope', 'request'])
 
 
 # this is fired when a new email has failed validation
 email_received_unacceptable = Signal(
     providing_args=['email', 'request', 'exception']
 )
+
+
+# this is fired with the timings and counters for each inbound request,
+# once it has been handled (see inbound_email.metrics)
+metrics_recorded = Signal(providing_args=['metrics'])
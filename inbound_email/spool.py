@@ -0,0 +1,403 @@
+"""Spool raw inbound requests to disk, to be processed later.
+
+In "store-then-process" mode the view doesn't parse the request at all - it
+appends the raw request (META and body) to a segment file in the spool
+directory, and returns straight away. The `process_inbound_spool` management
+command then replays each spooled request through the configured parser and
+signals, so the provider never waits on parsing (or on the receivers), and
+bursts are absorbed by the spool.
+
+Each record is the request's META (as JSON) followed by the raw body, with
+their lengths in a fixed-size header. The body is streamed into the segment
+a chunk at a time (via a temporary file, so that a slow client doesn't hold
+up the other writers), and requests larger than `max_request_size` bytes are
+rejected rather than spooled.
+
+Each process appends to its own segment file (`<created>-<pid>-<id>.open`),
+which is sealed (renamed to `.spool`) once it is `segment_age` seconds old or
+`segment_size` bytes long, and only sealed segments are processed (or the
+unsealed segments of writers that have died). Appends
+are fsynced before the view returns, but concurrent requests share a single
+fsync (group commit), so the cost is amortised under load.
+
+The spool is enabled by setting INBOUND_EMAIL_SPOOL_DIRECTORY, and can be
+configured with INBOUND_EMAIL_SPOOL_OPTIONS (a dict of kwargs that is passed
+to RequestSpool).
+"""
+import atexit
+import io
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .errors import RequestTooLargeError
+
+logger = logging.getLogger(__name__)
+
+# each record is prefixed with the lengths of its META (JSON) and body
+_HEADER = struct.Struct('>QQ')
+
+# the number of bytes of the body read (and written) at a time
+_CHUNK_SIZE = 64 * 2 ** 10
+
+# the META key that marks a request replayed from the spool (NB the client
+# can't set it, as the names of request headers are prefixed with HTTP_)
+_SPOOLED_KEY = 'inbound_email.spooled'
+
+# unsealed segments older than segment_age plus this many seconds have been
+# abandoned by their writer (e.g. it was killed), and may be processed
+_ABANDONED_GRACE = 60
+
+
+def _get_meta(request):
+    """Return the request's META (just the str values) as JSON."""
+    meta = {k: v for k, v in request.META.items() if isinstance(v, str)}
+    meta['wsgi.url_scheme'] = request.scheme
+    return json.dumps(meta).encode('utf-8')
+
+
+def _read_body(request, max_size):
+    """Read the request body into a temporary file; return (file, length).
+
+    The file is held in memory up to FILE_UPLOAD_MAX_MEMORY_SIZE. This reads
+    the request body, so must be called before anything accesses request.POST
+    or request.FILES - NB not request.body, which is limited to
+    DATA_UPLOAD_MAX_MEMORY_SIZE. Raises RequestTooLargeError if the body is
+    larger than max_size bytes (if not None).
+    """
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        content_length = 0
+    if max_size is not None and content_length > max_size:
+        raise RequestTooLargeError(content_length)
+
+    body = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+    length = 0
+    try:
+        for chunk in iter(lambda: request.read(_CHUNK_SIZE), b''):
+            length += len(chunk)
+            if max_size is not None and length > max_size:
+                raise RequestTooLargeError(length)
+            body.write(chunk)
+    except Exception:
+        body.close()
+        raise
+    body.seek(0)
+    return body, length
+
+
+def _write_record(f, meta, body, length):
+    """Write a record (the META JSON, and a file of `length` bytes of body) to f."""
+    f.write(_HEADER.pack(len(meta), length))
+    f.write(meta)
+    shutil.copyfileobj(body, f, _CHUNK_SIZE)
+
+
+def deserialize_request(record):
+    """Rebuild an HttpRequest from a record returned by iter_records."""
+    environ = dict(record['meta'])
+    environ[_SPOOLED_KEY] = True
+    environ['CONTENT_LENGTH'] = str(len(record['body']))
+    environ['wsgi.input'] = io.BytesIO(record['body'])
+    return WSGIRequest(environ)
+
+
+def is_spooled(request):
+    """Return True if the request has been replayed from the spool."""
+    return request.META.get(_SPOOLED_KEY) is True
+
+
+def iter_records(path):
+    """Yield each record in a spool segment file, as a {'meta', 'body'} dict.
+
+    A truncated record at the end of the file (from a writer that died
+    part way through an append) is logged and skipped.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(_HEADER.size)
+            if not header:
+                return
+            if len(header) == _HEADER.size:
+                meta_length, body_length = _HEADER.unpack(header)
+                meta = f.read(meta_length)
+                body = f.read(body_length)
+            if len(header) < _HEADER.size or len(meta) < meta_length or len(body) < body_length:
+                logger.warning("Discarding truncated record at the end of %s", path)
+                return
+            yield {'meta': json.loads(meta.decode('utf-8')), 'body': body}
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class RequestSpool(object):
+    """An append-only spool of raw inbound requests.
+
+    Args:
+        directory: the spool directory (created if it does not exist).
+        segment_age: seconds after which a segment is sealed, and so can be
+            processed - this is the minimum delay before an email is processed.
+        segment_size: bytes after which a segment is sealed.
+        fsync: if False, don't fsync appends (faster, but requests that have
+            been acknowledged can be lost if the server crashes).
+        max_request_size: the largest request body (in bytes) that will be
+            spooled (default=50MB, or None for no limit).
+    """
+
+    open_suffix = '.open'
+    suffix = '.spool'
+
+    def __init__(self, directory, segment_age=1.0, segment_size=16 * 2 ** 20, fsync=True,
+                 max_request_size=50 * 2 ** 20):
+        self.directory = directory
+        self.segment_age = segment_age
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.max_request_size = max_request_size
+        os.makedirs(directory, exist_ok=True)
+        # _lock serialises appends; _sync_lock lets one writer fsync on
+        # behalf of all of the writers waiting on it (NB lock order is
+        # _sync_lock, then _lock)
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._pid = os.getpid()
+        self._file = None
+        self._path = None
+        self._created = None
+        self._appended = 0
+        self._synced = 0
+
+    # --- writing
+
+    def _open_segment(self):
+        self._created = time.time()
+        # created (in microseconds) first, so that segments sort by age
+        name = '%d-%d-%s%s' % (
+            self._created * 1e6, os.getpid(), uuid.uuid4().hex, self.open_suffix
+        )
+        self._path = os.path.join(self.directory, name)
+        self._file = open(self._path, 'ab')
+        # seal the segment on time even if there are no more requests
+        timer = threading.Timer(self.segment_age, self._seal_expired, args=(self._path,))
+        timer.daemon = True
+        timer.start()
+
+    def _seal_segment(self):
+        """Fsync, close and seal the current segment (must hold _lock)."""
+        if self._file is None:
+            return
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._path, self._path[:-len(self.open_suffix)] + self.suffix)
+        self._file = self._path = self._created = None
+
+    def _seal_expired(self, path):
+        with self._lock:
+            if self._path == path and self._pid == os.getpid():
+                self._seal_segment()
+
+    def _sync(self, seq):
+        """Wait until record `seq` is on disk, fsyncing if nobody else has."""
+        with self._sync_lock:
+            if self._synced >= seq:
+                # another writer's fsync covered this record
+                return
+            with self._lock:
+                target = self._appended
+                # NB sealed segments have already been fsynced
+                fd = os.dup(self._file.fileno()) if self._file is not None else None
+            if fd is not None:
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            self._synced = target
+
+    def append(self, request, body=None):
+        """Append the raw request to the spool, and wait for it to be on disk.
+
+        `body` is the file yielded by `buffer`, if the request's body has
+        already been buffered. Raises RequestTooLargeError if the body is
+        larger than max_request_size.
+        """
+        meta = _get_meta(request)
+        if body is not None:
+            length = body.seek(0, io.SEEK_END)
+            body.seek(0)
+            self._append(meta, body, length)
+            return
+        # read the body before taking the lock, as the client may be slow
+        body, length = _read_body(request, self.max_request_size)
+        try:
+            self._append(meta, body, length)
+        finally:
+            body.close()
+
+    @contextmanager
+    def buffer(self, request):
+        """Read the request body into a temporary file, and yield the file.
+
+        The file replaces the request's stream, so that the request can still
+        be read (e.g. to authenticate it) before it is passed to `append`.
+        Raises RequestTooLargeError if the body is larger than max_request_size.
+        """
+        body, _ = _read_body(request, self.max_request_size)
+        try:
+            request._stream = body
+            request._read_started = False
+            yield body
+        finally:
+            body.close()
+
+    def _append(self, meta, body, length):
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked since the segment was opened - it belongs to the parent
+                self._pid = os.getpid()
+                self._file = self._path = self._created = None
+            if self._file is not None and (
+                time.time() - self._created >= self.segment_age or
+                self._file.tell() >= self.segment_size
+            ):
+                self._seal_segment()
+            if self._file is None:
+                self._open_segment()
+            _write_record(self._file, meta, body, length)
+            self._file.flush()
+            self._appended += 1
+            seq = self._appended
+        if self.fsync:
+            self._sync(seq)
+
+    def seal(self):
+        """Seal the current segment, so that it can be processed."""
+        with self._lock:
+            if self._pid == os.getpid():
+                self._seal_segment()
+
+    # --- processing
+
+    def _is_claimable(self, name):
+        if name.endswith(self.suffix):
+            return True
+        try:
+            if name.endswith(self.open_suffix):
+                created = int(name.split('-', 1)[0]) / 1e6
+                return time.time() - created > self.segment_age + _ABANDONED_GRACE
+            if name.endswith('.claimed'):
+                # claimed by a worker that has since died - NB the records it
+                # had already processed will be processed again
+                return not _pid_exists(int(name.split('.')[1]))
+        except ValueError:
+            pass
+        return False
+
+    def claim_segment(self):
+        """Claim the oldest processable segment; return its path, or None.
+
+        Segments are claimed by renaming them, so several worker processes
+        can share the spool.
+        """
+        names = sorted(entry.name for entry in os.scandir(self.directory))
+        for name in names:
+            if not self._is_claimable(name):
+                continue
+            path = os.path.join(self.directory, name)
+            claimed = os.path.join(
+                self.directory, '%s.%d.claimed' % (name.split('.', 1)[0], os.getpid())
+            )
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                # another worker got there first
+                continue
+            return claimed
+        return None
+
+    def write_failed(self, path, record):
+        """Save a record that could not be processed from the claimed segment.
+
+        Failed records are appended to `<segment>.failed` - rename this to
+        `<segment>.spool` to process them again.
+        """
+        failed = os.path.join(
+            self.directory, os.path.basename(path).split('.', 1)[0] + '.failed'
+        )
+        meta = json.dumps(record['meta']).encode('utf-8')
+        with open(failed, 'ab') as f:
+            _write_record(f, meta, io.BytesIO(record['body']), len(record['body']))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    def pending_count(self):
+        """Return the number of segments waiting to be processed."""
+        return sum(
+            1 for entry in os.scandir(self.directory)
+            if entry.name.endswith(self.suffix)
+        )
+
+
+_spools = {}
+_spool_lock = threading.Lock()
+
+
+def get_spool():
+    """Return the shared RequestSpool, or None if spooling is disabled."""
+    directory = getattr(settings, 'INBOUND_EMAIL_SPOOL_DIRECTORY', None)
+    if not directory:
+        return None
+    try:
+        return _spools[directory]
+    except KeyError:
+        pass
+
+    with _spool_lock:
+        if directory not in _spools:
+            options = getattr(settings, 'INBOUND_EMAIL_SPOOL_OPTIONS', {})
+            _spools[directory] = RequestSpool(directory, **options)
+        return _spools[directory]
+
+
+@atexit.register
+def seal_spools():
+    """Seal the open segments, so that they can be processed straight away."""
+    with _spool_lock:
+        spools = list(_spools.values())
+    for spool in spools:
+        try:
+            spool.seal()
+        except OSError:
+            logger.exception("Unable to seal inbound email spool %s", spool.directory)
+
+
+@receiver(setting_changed)
+def _reset_spools(sender, setting, **kwargs):
+    """Seal and forget the spools when the spool settings are changed."""
+    if setting.startswith('INBOUND_EMAIL_SPOOL_'):
+        seal_spools()
+        with _spool_lock:
+            _spools.clear()
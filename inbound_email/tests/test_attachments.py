@@ -0,0 +1,55 @@
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail import EmailMultiAlternatives
+from django.test import TestCase
+
+from ..attachments import UploadedFileAttachment
+
+
+class UploadedFileAttachmentTests(TestCase):
+    """Tests for the lazily-loaded UploadedFileAttachment."""
+
+    def _attachment(self, content=b'hello world', content_type='text/plain'):
+        return UploadedFileAttachment(
+            SimpleUploadedFile('test.txt', content, content_type)
+        )
+
+    def test_content_is_lazy(self):
+        attachment = self._attachment(content_type='image/jpeg')
+        self.assertFalse(attachment.loaded)
+        self.assertEqual(attachment[0], 'test.txt')
+        self.assertEqual(attachment[2], 'image/jpeg')
+        self.assertEqual(attachment.size, 11)
+        self.assertFalse(attachment.loaded)
+        self.assertEqual(attachment[1], b'hello world')
+        self.assertTrue(attachment.loaded)
+
+    def test_tuple_compatibility(self):
+        attachment = self._attachment()
+        name, content, mimetype = attachment
+        self.assertEqual((name, content, mimetype), ('test.txt', 'hello world', 'text/plain'))
+        self.assertEqual(len(attachment), 3)
+        self.assertEqual(attachment[-1], 'text/plain')
+        self.assertEqual(attachment[:2], ('test.txt', 'hello world'))
+        self.assertEqual(attachment, ('test.txt', 'hello world', 'text/plain'))
+        with self.assertRaises(IndexError):
+            attachment[3]
+
+    def test_chunks(self):
+        attachment = self._attachment(content=b'x' * 100)
+        chunks = list(attachment.chunks(chunk_size=30))
+        self.assertEqual([len(c) for c in chunks], [30, 30, 30, 10])
+        self.assertFalse(attachment.loaded)
+        # can be read more than once
+        self.assertEqual(attachment.read(), b'x' * 100)
+
+    def test_undecodable_text(self):
+        attachment = self._attachment(content=b'\xff\xfe\xfa')
+        self.assertEqual(attachment.content, b'\xff\xfe\xfa')
+        self.assertEqual(attachment.mimetype, 'application/octet-stream')
+
+    def test_email_message(self):
+        email = EmailMultiAlternatives(subject='test', body='body', to=['to@example.com'])
+        email.attachments.append(self._attachment(content_type='image/jpeg'))
+        message = email.message()
+        self.assertTrue(message.is_multipart())
+        self.assertIn('filename="test.txt"', message.as_string())
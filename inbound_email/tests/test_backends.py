@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.test import TestCase, override_settings
+
+from ..backends import get_backend_class, get_backend_instance
+from ..backends.mailgun import MailgunRequestParser
+from ..backends.sendgrid import SendGridRequestParser
+
+SENDGRID_REQUEST_PARSER = "inbound_email.backends.sendgrid.SendGridRequestParser"
+MAILGUN_REQUEST_PARSER = "inbound_email.backends.mailgun.MailgunRequestParser"
+
+
+class BackendLoadingTests(TestCase):
+    """Tests for resolving and caching the configured backend."""
+
+    @override_settings(INBOUND_EMAIL_PARSER=SENDGRID_REQUEST_PARSER)
+    def test_get_backend_class(self):
+        self.assertEqual(get_backend_class(), SendGridRequestParser)
+
+    @override_settings(INBOUND_EMAIL_PARSER=SENDGRID_REQUEST_PARSER)
+    def test_get_backend_instance_is_shared(self):
+        backend = get_backend_instance()
+        self.assertIsInstance(backend, SendGridRequestParser)
+        self.assertIs(get_backend_instance(), backend)
+
+    def test_get_backend_instance_follows_setting(self):
+        with override_settings(INBOUND_EMAIL_PARSER=SENDGRID_REQUEST_PARSER):
+            sendgrid = get_backend_instance()
+        with override_settings(INBOUND_EMAIL_PARSER=MAILGUN_REQUEST_PARSER):
+            self.assertIsInstance(get_backend_instance(), MailgunRequestParser)
+        with override_settings(INBOUND_EMAIL_PARSER=SENDGRID_REQUEST_PARSER):
+            # the cache is cleared on setting_changed, so this is a new instance
+            self.assertIsNot(get_backend_instance(), sendgrid)
+
+    def test_get_backend_instance_direct_assignment(self):
+        # the view tests assign the setting directly (no setting_changed signal)
+        original = settings.INBOUND_EMAIL_PARSER
+        try:
+            settings.INBOUND_EMAIL_PARSER = MAILGUN_REQUEST_PARSER
+            self.assertIsInstance(get_backend_instance(), MailgunRequestParser)
+            settings.INBOUND_EMAIL_PARSER = SENDGRID_REQUEST_PARSER
+            self.assertIsInstance(get_backend_instance(), SendGridRequestParser)
+        finally:
+            settings.INBOUND_EMAIL_PARSER = original
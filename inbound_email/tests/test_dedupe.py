@@ -0,0 +1,148 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+
+from ..backends.mailgun import MailgunRequestParser
+from ..backends.mandrill import MandrillRequestParser
+from ..backends.sendgrid import SendGridRequestParser
+from ..dedupe import RecentKeys, _get_recent_emails, is_duplicate
+from ..signals import email_received
+from ..views import receive_inbound_email
+
+from .test_files.mailgun_post import test_inbound_payload as mailgun_payload
+from .test_files.mandrill_post import post_data as mandrill_payload
+from .test_files.sendgrid_post import test_inbound_payload as sendgrid_payload
+
+SENDGRID_REQUEST_PARSER = "inbound_email.backends.sendgrid.SendGridRequestParser"
+
+
+class RecentKeysTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_add(self):
+        recent = RecentKeys('test:', timeout=60)
+        self.assertTrue(recent.add('a'))
+        self.assertFalse(recent.add('a'))
+        self.assertTrue(recent.add('b'))
+
+    def test_contains(self):
+        recent = RecentKeys('test:', timeout=60)
+        self.assertFalse(recent.contains('a'))
+        recent.add('a')
+        self.assertTrue(recent.contains('a'))
+        # ...and from the Django cache, e.g. if it was added by another process
+        recent.clear()
+        self.assertTrue(recent.contains('a'))
+        self.assertFalse(recent.contains('b'))
+
+    def test_shared_cache(self):
+        """Test keys are found in the Django cache if not in the local cache."""
+        recent = RecentKeys('test:', timeout=60)
+        self.assertTrue(recent.add('a'))
+        recent.clear()
+        self.assertFalse(recent.add('a'))
+        # ...but not without the Django cache
+        recent = RecentKeys('test:', timeout=60, cache_alias=None)
+        self.assertTrue(recent.add('a'))
+
+    def test_timeout(self):
+        recent = RecentKeys('test:', timeout=60, cache_alias=None)
+        with mock.patch('inbound_email.dedupe.time.monotonic', return_value=1000):
+            self.assertTrue(recent.add('a'))
+        with mock.patch('inbound_email.dedupe.time.monotonic', return_value=1059):
+            self.assertFalse(recent.add('a'))
+        with mock.patch('inbound_email.dedupe.time.monotonic', return_value=1061):
+            self.assertTrue(recent.add('a'))
+
+    def test_max_size(self):
+        recent = RecentKeys('test:', timeout=60, max_size=2, cache_alias=None)
+        for key in 'abc':
+            self.assertTrue(recent.add(key))
+        # 'a' has been evicted
+        self.assertTrue(recent.add('a'))
+        self.assertFalse(recent.add('c'))
+
+
+@override_settings(INBOUND_EMAIL_DEDUPE_TIMEOUT=60)
+class DedupeParserTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        # the in-process cache outlives each test
+        _get_recent_emails().clear()
+        self.factory = RequestFactory()
+
+    @override_settings(INBOUND_EMAIL_DEDUPE_TIMEOUT=None)
+    def test_disabled(self):
+        self.assertFalse(is_duplicate('a'))
+        self.assertFalse(is_duplicate('a'))
+        parser = SendGridRequestParser()
+        self.assertIsNotNone(parser.parse(self.factory.post('/', data=sendgrid_payload)))
+        self.assertIsNotNone(parser.parse(self.factory.post('/', data=sendgrid_payload)))
+
+    def _receive(self, parser, data):
+        """Parse the request, and record its emails as dispatched, as the view does."""
+        request = self.factory.post('/', data=data)
+        emails = list(parser.iter_parse(request))
+        for email in emails:
+            parser.received(request, email)
+        return emails
+
+    def test_sendgrid(self):
+        parser = SendGridRequestParser()
+        self.assertEqual(len(self._receive(parser, sendgrid_payload)), 1)
+        self.assertEqual(len(self._receive(parser, sendgrid_payload)), 0)
+
+    def test_sendgrid_without_message_id(self):
+        parser = SendGridRequestParser()
+        data = sendgrid_payload.copy()
+        data['headers'] = ''
+        self.assertEqual(len(self._receive(parser, data)), 1)
+        self.assertEqual(len(self._receive(parser, data)), 0)
+        data['subject'] = 'A different email'
+        self.assertEqual(len(self._receive(parser, data)), 1)
+
+    def test_mailgun(self):
+        parser = MailgunRequestParser()
+        self.assertEqual(len(self._receive(parser, mailgun_payload)), 1)
+        self.assertEqual(len(self._receive(parser, mailgun_payload)), 0)
+
+    def test_mandrill(self):
+        parser = MandrillRequestParser()
+        # NB the two events in the payload have the same Message-Id
+        self.assertEqual(len(self._receive(parser, mandrill_payload)), 1)
+        self.assertEqual(len(self._receive(parser, mandrill_payload)), 0)
+
+    def test_not_received(self):
+        """Test that emails are only recorded once they have been dispatched."""
+        parser = SendGridRequestParser()
+        self.assertIsNotNone(parser.parse(self.factory.post('/', data=sendgrid_payload)))
+        self.assertIsNotNone(parser.parse(self.factory.post('/', data=sendgrid_payload)))
+
+    @override_settings(INBOUND_EMAIL_PARSER=SENDGRID_REQUEST_PARSER)
+    def test_view_retry_after_error(self):
+        """Test that an email is received again if the provider retries it after an error."""
+        received = []
+
+        def on_email_received(sender, email, **kwargs):
+            received.append(email)
+            if len(received) == 1:
+                raise ValueError("Receiver error")
+
+        email_received.connect(on_email_received)
+        try:
+            with self.assertRaises(ValueError):
+                receive_inbound_email(self.factory.post('/', data=sendgrid_payload))
+            # the provider retries the email, as the view returned a 500
+            response = receive_inbound_email(self.factory.post('/', data=sendgrid_payload))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(received), 2)
+            # ...but once it has been received, any more retries are discarded
+            receive_inbound_email(self.factory.post('/', data=sendgrid_payload))
+            self.assertEqual(len(received), 2)
+        finally:
+            email_received.disconnect(on_email_received)
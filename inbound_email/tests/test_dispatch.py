@@ -0,0 +1,264 @@
+import gc
+import shutil
+import tempfile
+import threading
+from unittest import skipIf
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail import EmailMultiAlternatives
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+
+from ..attachments import UploadedFileAttachment
+from ..dispatch import (
+    FileSpoolDispatcher,
+    SyncDispatcher,
+    ThreadPoolDispatcher,
+    get_dispatcher,
+    send_email_received,
+)
+from ..signals import TimedSignal, email_received
+from ..views import receive_inbound_email
+
+try:
+    from asgiref.sync import async_to_sync
+except ImportError:  # Django < 3.0
+    async_to_sync = None
+
+from .test_files.sendgrid_post import test_inbound_payload as sendgrid_payload
+
+SENDGRID_REQUEST_PARSER = "inbound_email.backends.sendgrid.SendGridRequestParser"
+
+
+class DispatcherTests(TestCase):
+    """Tests for delivering emails to the email_received receivers."""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.received = []
+        self.threads = []
+        email_received.connect(self.on_email_received)
+
+    def tearDown(self):
+        email_received.disconnect(self.on_email_received)
+
+    def on_email_received(self, sender, email, request, **kwargs):
+        self.threads.append(threading.current_thread())
+        self.received.append((sender, email, request))
+
+    def _email(self):
+        email = EmailMultiAlternatives(subject='test', body='body', to=['to@example.com'])
+        email.attachments.append(UploadedFileAttachment(
+            SimpleUploadedFile('test.jpg', b'content', 'image/jpeg')
+        ))
+        return email
+
+    def test_get_dispatcher_default(self):
+        self.assertIsInstance(get_dispatcher(), SyncDispatcher)
+        self.assertIs(get_dispatcher(), get_dispatcher())
+
+    @override_settings(
+        INBOUND_EMAIL_PARSER=SENDGRID_REQUEST_PARSER,
+        INBOUND_EMAIL_DISPATCHER='inbound_email.dispatch.ThreadPoolDispatcher',
+        INBOUND_EMAIL_DISPATCHER_OPTIONS={'max_workers': 2},
+    )
+    def test_view_thread_pool(self):
+        request = self.factory.post('/', data=sendgrid_payload)
+        response = receive_inbound_email(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(get_dispatcher().drain(timeout=5))
+        self.assertEqual(len(self.received), 1)
+        self.assertIsNot(self.threads[0], threading.current_thread())
+
+    def test_thread_pool_detaches_attachments(self):
+        dispatcher = ThreadPoolDispatcher(max_workers=1)
+        dispatcher.dispatch(sender=None, email=self._email(), request=None)
+        self.assertTrue(dispatcher.shutdown(timeout=5))
+        email = self.received[0][1]
+        self.assertEqual(email.attachments, [('test.jpg', b'content', 'image/jpeg')])
+        self.assertIsInstance(email.attachments[0], tuple)
+
+    def test_thread_pool_detaches_request(self):
+        request = self.factory.post('/', data={
+            'subject': 'test',
+            'attachment1': SimpleUploadedFile('test.jpg', b'content', 'image/jpeg'),
+        })
+        request.FILES
+        dispatcher = ThreadPoolDispatcher(max_workers=1)
+        dispatcher.dispatch(sender=None, email=self._email(), request=request)
+        self.assertTrue(dispatcher.shutdown(timeout=5))
+        detached = self.received[0][2]
+        self.assertIsNot(detached, request)
+        self.assertEqual(detached.POST['subject'], 'test')
+        self.assertEqual(len(detached.FILES), 0)
+
+    def test_thread_pool_backpressure(self):
+        release = threading.Event()
+        caller = threading.current_thread()
+
+        def block(**kwargs):
+            # only block the pool's worker thread
+            if threading.current_thread() is not caller:
+                release.wait(5)
+        email_received.connect(block, weak=False, dispatch_uid='block')
+        try:
+            dispatcher = ThreadPoolDispatcher(max_workers=1, max_pending=1, timeout=0.01)
+            dispatcher.dispatch(sender=None, email=self._email(), request=None)
+            # the pool is full, so this is delivered synchronously
+            dispatcher.dispatch(sender=None, email=self._email(), request=None)
+            self.assertIs(self.threads[-1], threading.current_thread())
+        finally:
+            release.set()
+            email_received.disconnect(dispatch_uid='block')
+        self.assertTrue(dispatcher.shutdown(timeout=5))
+        self.assertEqual(len(self.received), 2)
+
+    def test_file_spool(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        dispatcher = FileSpoolDispatcher(directory, poll_interval=0.01)
+        request = self.factory.post('/', data={'subject': 'test'})
+        dispatcher.dispatch(sender=SyncDispatcher, email=self._email(), request=request)
+        self.assertTrue(dispatcher.shutdown(timeout=5))
+
+        sender, email, spooled_request = self.received[0]
+        self.assertEqual(sender, SyncDispatcher)
+        self.assertEqual(email.subject, 'test')
+        self.assertEqual(email.attachments, [('test.jpg', b'content', 'image/jpeg')])
+        self.assertEqual(spooled_request.POST['subject'], 'test')
+        self.assertEqual(spooled_request.method, 'POST')
+
+    def test_file_spool_backpressure(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        dispatcher = FileSpoolDispatcher(directory, max_pending=0)
+        dispatcher.dispatch(sender=None, email=self._email(), request=None)
+        self.assertIs(self.threads[0], threading.current_thread())
+        self.assertTrue(dispatcher.shutdown(timeout=5))
+
+
+def _failing_receiver(sender, **kwargs):
+    raise ValueError("Receiver error")
+
+
+class SendEmailReceivedTests(TestCase):
+    """Tests for timing and isolating the email_received receivers."""
+
+    def setUp(self):
+        self.received = []
+        # connected first, so that it runs before on_email_received
+        email_received.connect(_failing_receiver, dispatch_uid='failing')
+        email_received.connect(self.on_email_received)
+
+    def tearDown(self):
+        email_received.disconnect(dispatch_uid='failing')
+        email_received.disconnect(self.on_email_received)
+
+    def on_email_received(self, sender, email, **kwargs):
+        self.received.append(email)
+        return 'OK'
+
+    def test_error_is_raised(self):
+        self.assertRaises(ValueError, send_email_received, None, 'email', None)
+        self.assertEqual(self.received, [])
+
+    @override_settings(INBOUND_EMAIL_ROBUST_RECEIVERS=True)
+    def test_robust(self):
+        with self.assertLogs('inbound_email.dispatch', 'ERROR'):
+            responses = send_email_received(None, 'email', None)
+        self.assertEqual(self.received, ['email'])
+        self.assertIsInstance(responses[0][1], ValueError)
+        self.assertEqual(responses[1][1], 'OK')
+
+    @override_settings(INBOUND_EMAIL_ROBUST_RECEIVERS=True, INBOUND_EMAIL_SLOW_RECEIVER_THRESHOLD=0)
+    def test_slow_receiver(self):
+        with self.assertLogs('inbound_email.dispatch', 'WARNING') as logs:
+            send_email_received(None, 'email', None)
+        slow = [r for r in logs.output if 'Slow email_received receiver' in r]
+        self.assertEqual(len(slow), 2)
+        self.assertIn('SendEmailReceivedTests.on_email_received', slow[1])
+
+    @override_settings(
+        INBOUND_EMAIL_ROBUST_RECEIVERS=True,
+        INBOUND_EMAIL_PARSER=SENDGRID_REQUEST_PARSER,
+    )
+    def test_view(self):
+        """Test that a failing receiver doesn't make the provider retry."""
+        request = RequestFactory().post('/', data=sendgrid_payload)
+        with self.assertLogs('inbound_email.dispatch', 'ERROR'):
+            response = receive_inbound_email(request)
+        self.assertContains(response, "Successfully parsed", status_code=200)
+        self.assertEqual(len(self.received), 1)
+
+
+class TimedSignalTests(TestCase):
+    """Tests for wrapping each receiver when it is connected."""
+
+    def setUp(self):
+        self.signal = TimedSignal()
+        self.received = []
+
+    def on_signal(self, sender, **kwargs):
+        self.received.append(sender)
+        return 'OK'
+
+    def test_send(self):
+        self.signal.connect(self.on_signal)
+        # connecting the same receiver again is ignored
+        self.signal.connect(self.on_signal)
+        self.assertTrue(self.signal.has_listeners())
+        responses = self.signal.send(sender='a')
+        # the responses are from the original receivers, not the wrappers
+        self.assertEqual(responses, [(self.on_signal, 'OK')])
+        self.assertEqual(self.signal.send_robust(sender='b'), [(self.on_signal, 'OK')])
+        self.assertEqual(self.received, ['a', 'b'])
+
+        self.assertTrue(self.signal.disconnect(self.on_signal))
+        self.assertFalse(self.signal.has_listeners())
+
+    def test_sender_and_dispatch_uid(self):
+        self.signal.connect(self.on_signal, sender='a', dispatch_uid='uid')
+        self.signal.send(sender='a')
+        self.signal.send(sender='b')
+        self.assertEqual(self.received, ['a'])
+        self.assertTrue(self.signal.disconnect(sender='a', dispatch_uid='uid'))
+        self.assertFalse(self.signal.has_listeners())
+
+    def test_weak(self):
+        def on_signal(sender, **kwargs):
+            self.received.append(sender)
+
+        self.signal.connect(on_signal)
+        self.signal.send(sender='a')
+        del on_signal
+        gc.collect()
+        # the dead receiver is disconnected, as it is by Signal
+        self.assertFalse(self.signal.has_listeners())
+        self.assertEqual(self.signal.send(sender='b'), [])
+        self.assertEqual(self.signal.send_robust(sender='c'), [])
+        self.assertEqual(self.received, ['a'])
+
+    def test_strong(self):
+        received = self.received
+        self.signal.connect(lambda sender, **kwargs: received.append(sender), weak=False)
+        gc.collect()
+        self.signal.send(sender='a')
+        self.assertEqual(received, ['a'])
+
+    @skipIf(async_to_sync is None, "requires asgiref")
+    def test_async_receiver(self):
+        async def on_signal(sender, **kwargs):
+            self.received.append(sender)
+            return 'OK'
+
+        self.signal.connect(on_signal)
+        self.assertEqual(self.signal.send(sender='a'), [(on_signal, 'OK')])
+        self.assertEqual(self.received, ['a'])
+
+    @override_settings(INBOUND_EMAIL_ROBUST_RECEIVERS=True)
+    def test_robust(self):
+        self.signal.connect(_failing_receiver)
+        with self.assertLogs('inbound_email.dispatch', 'ERROR'):
+            responses = self.signal.send(sender='a')
+        self.assertIsInstance(responses[0][1], ValueError)
+        self.signal.disconnect(_failing_receiver)
@@ -0,0 +1,133 @@
+import json
+from unittest import mock
+
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from ..backends.mailgun import MailgunRequestParser
+from ..backends.mandrill import MandrillRequestParser
+from ..backends.sendgrid import SendGridRawRequestParser, SendGridRequestParser
+from ..message import Envelope
+from ..metrics import collect
+from ..signals import email_envelope_received
+
+from .test_files.mailgun_post import test_inbound_payload as mailgun_payload
+from .test_files.mandrill_post import post_data as mandrill_payload
+from .test_files.sendgrid_post import test_inbound_payload as sendgrid_payload
+from .test_mime import _get_raw_message
+
+
+class ParseEnvelopeTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_sendgrid(self):
+        request = self.factory.post('/', data=sendgrid_payload.copy())
+        envelope = SendGridRequestParser().parse_envelope(request)
+        self.assertIsInstance(envelope, Envelope)
+        self.assertEqual(envelope.from_email, 'from@example.com')
+        self.assertEqual(envelope.to, ['to@example.com'])
+        self.assertEqual(envelope.cc, ['b@example.com', 'c@example.com'])
+        self.assertEqual(envelope.subject, 'test')
+        self.assertEqual(envelope.spam_score, 0.266)
+
+    def test_mailgun(self):
+        payload = mailgun_payload.copy()
+        payload['X-Mailgun-Sscore'] = '12.5'
+        envelope = MailgunRequestParser().parse_envelope(self.factory.post('/', data=payload))
+        self.assertEqual(envelope.from_email, mailgun_payload['sender'])
+        self.assertEqual(envelope.to, [mailgun_payload['recipient']])
+        self.assertEqual(envelope.subject, mailgun_payload['subject'])
+        self.assertEqual(envelope.message_id, mailgun_payload['Message-Id'])
+        self.assertEqual(envelope.spam_score, 12.5)
+
+        del payload['X-Mailgun-Sscore']
+        envelope = MailgunRequestParser().parse_envelope(self.factory.post('/', data=payload))
+        self.assertIsNone(envelope.spam_score)
+
+    def test_mandrill(self):
+        request = self.factory.post('/', data=mandrill_payload)
+        envelopes = MandrillRequestParser().parse_envelope(request)
+        msg = json.loads(mandrill_payload['mandrill_events'])[0]['msg']
+        self.assertEqual(len(envelopes), 2)
+        self.assertEqual(envelopes[0].from_email, msg['from_email'])
+        self.assertEqual(envelopes[0].to, [address for address, _ in msg['to']])
+        self.assertEqual(envelopes[0].message_id, msg['headers']['Message-Id'])
+        self.assertEqual(envelopes[0].spam_score, msg['spam_report']['score'])
+
+    def test_mime(self):
+        raw = _get_raw_message().replace('Subject:', 'X-Spam-Score: 3.1\nSubject:', 1)
+        request = self.factory.post('/', data={'email': raw})
+        envelope = SendGridRawRequestParser().parse_envelope(request)
+        self.assertEqual(envelope, Envelope(
+            from_email='fred@example.com',
+            to=['barney@example.com', 'wilma@example.com'],
+            cc=['betty@example.com'],
+            subject='Über test',
+            message_id='<12345@example.com>',
+            spam_score=3.1,
+        ))
+
+
+class EnvelopeVetoTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.envelopes = []
+
+    def _veto_spam(self, sender, envelope, **kwargs):
+        self.envelopes.append(envelope)
+        if envelope.spam_score is not None and envelope.spam_score > 0:
+            return False
+
+    def _parse(self, parser, data):
+        email_envelope_received.connect(self._veto_spam)
+        try:
+            with collect(parser.__class__) as metrics:
+                return parser.parse(self.factory.post('/', data=data)), metrics
+        finally:
+            email_envelope_received.disconnect(self._veto_spam)
+
+    def test_veto(self):
+        email, metrics = self._parse(SendGridRequestParser(), sendgrid_payload.copy())
+        self.assertIsNone(email)
+        self.assertEqual(self.envelopes[0].spam_score, 0.266)
+        self.assertEqual(metrics.counters['vetoed'], 1)
+        self.assertIn('envelope', metrics.timings)
+
+    def test_no_veto(self):
+        payload = sendgrid_payload.copy()
+        payload['spam_score'] = '-1'
+        email, metrics = self._parse(SendGridRequestParser(), payload)
+        self.assertEqual(email.subject, 'test')
+        self.assertEqual(len(self.envelopes), 1)
+        self.assertNotIn('vetoed', metrics.counters)
+
+    def test_mime_veto(self):
+        raw = _get_raw_message().replace('Subject:', 'X-Spam-Score: 3.1\nSubject:', 1)
+        parser = SendGridRawRequestParser()
+        with mock.patch.object(parser, 'parse_mime') as parse_mime:
+            email, _ = self._parse(parser, {'email': raw})
+        self.assertIsNone(email)
+        parse_mime.assert_not_called()
+
+    def test_mandrill_veto(self):
+        events = json.loads(mandrill_payload['mandrill_events'])[:1]
+        events.append(json.loads(json.dumps(events[0])))
+        events[1]['msg']['subject'] = 'Spam'
+        events[1]['msg']['spam_report']['score'] = 9.9
+        parser = MandrillRequestParser()
+        with mock.patch.object(parser, '_parse_message', wraps=parser._parse_message) as parse:
+            emails, _ = self._parse(parser, {'mandrill_events': json.dumps(events)})
+        self.assertEqual(len(emails), 1)
+        self.assertEqual(parse.call_count, 1)
+        self.assertEqual([e.subject for e in self.envelopes], [events[0]['msg']['subject'], 'Spam'])
+
+    def test_no_receivers(self):
+        """Test that the envelope is not built if there are no receivers."""
+        parser = SendGridRawRequestParser()
+        with mock.patch.object(parser, '_get_envelope') as get_envelope:
+            email = parser.parse(self.factory.post('/', data={'email': _get_raw_message()}))
+        self.assertIsNotNone(email)
+        get_envelope.assert_not_called()
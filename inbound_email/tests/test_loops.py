@@ -0,0 +1,186 @@
+import json
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+
+from ..backends.mailgun import MailgunRequestParser
+from ..backends.mandrill import MandrillRequestParser
+from ..backends.sendgrid import SendGridRawRequestParser, SendGridRequestParser
+from ..errors import LoopDetectedError
+from ..loops import check, get_thread_key, is_auto_reply, normalize_subject, record
+from ..message import Envelope
+from ..signals import email_received, email_received_unacceptable
+from ..views import receive_inbound_email
+
+from .test_files.mailgun_post import test_inbound_payload as mailgun_payload
+from .test_files.mandrill_post import post_data as mandrill_payload
+from .test_files.sendgrid_post import test_inbound_payload as sendgrid_payload
+from .test_mime import _get_raw_message
+
+SENDGRID_REQUEST_PARSER = "inbound_email.backends.sendgrid.SendGridRequestParser"
+
+
+def _envelope(subject='Out of office', auto_reply=True, **kwargs):
+    fields = dict(
+        from_email='from@example.com',
+        to=['to@example.com'],
+        cc=[],
+        subject=subject,
+        message_id=None,
+        spam_score=None,
+        auto_reply=auto_reply,
+    )
+    fields.update(kwargs)
+    return Envelope(**fields)
+
+
+class AutoReplyTests(TestCase):
+
+    def test_is_auto_reply(self):
+        for headers in (
+            [('Auto-Submitted', 'auto-replied')],
+            [('auto-submitted', 'auto-generated')],
+            [('Precedence', 'bulk')],
+            [('Precedence', ' Auto_Reply ')],
+            [('X-Autoreply', 'yes')],
+            [('X-Autorespond', 'Out of office')],
+            [('Return-Path', '< >')],
+        ):
+            self.assertTrue(is_auto_reply(headers), headers)
+        for headers in (
+            [],
+            [('Auto-Submitted', 'no')],
+            [('Precedence', 'list')],
+            [('Return-Path', '<bounces@example.com>')],
+            [('Subject', 'Auto-Submitted: yes')],
+        ):
+            self.assertFalse(is_auto_reply(headers), headers)
+
+    def test_normalize_subject(self):
+        self.assertEqual(normalize_subject('Re: Fwd: Your order'), 'your order')
+        self.assertEqual(normalize_subject('Automatic reply: RE: Your order'), 'your order')
+        self.assertEqual(normalize_subject('Re[2]: Your order'), 'your order')
+        self.assertEqual(normalize_subject('Regarding your order'), 'regarding your order')
+        self.assertEqual(normalize_subject(None), '')
+
+    def test_thread_key(self):
+        key = get_thread_key(_envelope(subject='Re: Hello', to=['A@example.com', 'b@example.com']))
+        self.assertEqual(key, get_thread_key(
+            _envelope(subject='Auto: hello', to=['b@example.com', '"A" <a@example.com>'])
+        ))
+        self.assertNotEqual(key, get_thread_key(_envelope(subject='Goodbye')))
+
+    def test_check_disabled(self):
+        for _ in range(3):
+            check(_envelope())
+
+    @override_settings(INBOUND_EMAIL_LOOP_TIMEOUT=60, INBOUND_EMAIL_LOOP_CACHE=None)
+    def test_check_loop(self):
+        check(_envelope(subject='Loop'))
+        # threads are only checked, until they are recorded
+        check(_envelope(subject='Loop'))
+        record(get_thread_key(_envelope(subject='Loop')))
+        with self.assertRaises(LoopDetectedError) as context:
+            check(_envelope(subject='Re: Loop'))
+        self.assertEqual(context.exception.envelope.subject, 'Re: Loop')
+        self.assertIsNone(context.exception.email)
+        # other threads, and emails that aren't auto-replies, are unaffected
+        check(_envelope(subject='Another loop'))
+        check(_envelope(subject='Loop', auto_reply=False))
+        check(_envelope(subject='Loop', auto_reply=False))
+
+    @override_settings(INBOUND_EMAIL_REJECT_AUTO_REPLIES=True)
+    def test_reject_auto_replies(self):
+        with self.assertRaises(LoopDetectedError):
+            check(_envelope())
+        check(_envelope(auto_reply=False))
+
+
+class ParserAutoReplyTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_sendgrid(self):
+        parser = SendGridRequestParser()
+        payload = sendgrid_payload.copy()
+        self.assertFalse(parser.parse_envelope(self.factory.post('/', data=payload)).auto_reply)
+        payload['headers'] = 'Auto-Submitted: auto-replied\r\n' + payload['headers']
+        self.assertTrue(parser.parse_envelope(self.factory.post('/', data=payload)).auto_reply)
+
+    def test_mailgun(self):
+        parser = MailgunRequestParser()
+        payload = mailgun_payload.copy()
+        self.assertFalse(parser.parse_envelope(self.factory.post('/', data=payload)).auto_reply)
+        headers = [['Message-Id', payload['Message-Id']], ['Subject', payload['subject']]]
+        payload['message-headers'] = json.dumps(headers)
+        self.assertFalse(parser.parse_envelope(self.factory.post('/', data=payload)).auto_reply)
+        payload['message-headers'] = json.dumps(headers + [['Precedence', 'junk']])
+        self.assertTrue(parser.parse_envelope(self.factory.post('/', data=payload)).auto_reply)
+        payload['message-headers'] = 'not json'
+        self.assertFalse(parser.parse_envelope(self.factory.post('/', data=payload)).auto_reply)
+
+    def test_mandrill(self):
+        events = json.loads(mandrill_payload['mandrill_events'])
+        events[1]['msg']['headers']['X-Autoreply'] = 'yes'
+        request = self.factory.post('/', data={'mandrill_events': json.dumps(events)})
+        envelopes = MandrillRequestParser().parse_envelope(request)
+        self.assertEqual([e.auto_reply for e in envelopes], [False, True])
+
+    def test_mime(self):
+        raw = _get_raw_message(attach=False)
+        parser = SendGridRawRequestParser()
+        self.assertFalse(parser.parse_envelope(self.factory.post('/', data={'email': raw})).auto_reply)
+        raw = raw.replace('Subject:', 'Return-Path: <>\nSubject:', 1)
+        self.assertTrue(parser.parse_envelope(self.factory.post('/', data={'email': raw})).auto_reply)
+
+    @override_settings(INBOUND_EMAIL_LOOP_TIMEOUT=60, INBOUND_EMAIL_LOOP_CACHE=None)
+    def test_loop_rejected(self):
+        """Test that repeated auto-replies are dropped before they are parsed."""
+        payload = sendgrid_payload.copy()
+        payload['headers'] = 'Auto-Submitted: auto-replied\r\n' + payload['headers']
+        parser = SendGridRequestParser()
+        unacceptable = mock.Mock()
+        email_received_unacceptable.connect(unacceptable)
+        try:
+            request = self.factory.post('/', data=payload)
+            parser.received(request, parser.parse(request))
+            unacceptable.assert_not_called()
+            with mock.patch.object(parser, '_create_email') as create_email:
+                self.assertIsNone(parser.parse(self.factory.post('/', data=payload)))
+            create_email.assert_not_called()
+        finally:
+            email_received_unacceptable.disconnect(unacceptable)
+        self.assertIsInstance(unacceptable.call_args[1]['exception'], LoopDetectedError)
+
+    @override_settings(
+        INBOUND_EMAIL_LOOP_TIMEOUT=60,
+        INBOUND_EMAIL_LOOP_CACHE=None,
+        INBOUND_EMAIL_PARSER=SENDGRID_REQUEST_PARSER,
+    )
+    def test_retry_after_error(self):
+        """Test that an auto-reply that failed isn't dropped as a loop when it is retried."""
+        payload = sendgrid_payload.copy()
+        payload['headers'] = 'Auto-Submitted: auto-replied\r\n' + payload['headers']
+        received = []
+
+        def on_email_received(sender, email, **kwargs):
+            if not received:
+                received.append(None)
+                raise ValueError("Receiver error")
+            received.append(email)
+
+        email_received.connect(on_email_received)
+        try:
+            with self.assertRaises(ValueError):
+                receive_inbound_email(self.factory.post('/', data=payload))
+            receive_inbound_email(self.factory.post('/', data=payload))
+            # the retry was received, so the next is a loop
+            with mock.patch.object(SendGridRequestParser, '_create_email') as create_email:
+                receive_inbound_email(self.factory.post('/', data=payload))
+            create_email.assert_not_called()
+        finally:
+            email_received.disconnect(on_email_received)
+        self.assertEqual(len(received), 2)
+        self.assertEqual(received[1].subject, sendgrid_payload['subject'])
@@ -1,13 +1,33 @@
-from os import path
+import hashlib
+import hmac
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from os import path, stat
+from unittest import mock
 
 from django.core.mail import EmailMultiAlternatives
+from django.core.management import call_command
 from django.test import TestCase, override_settings
 from django.test.client import RequestFactory
 from django.urls import reverse
 from django.utils.encoding import smart_bytes
 
-from ..backends.mailgun import MailgunRequestParser
-from ..errors import RequestParseError, AttachmentTooLargeError
+from ..backends.mailgun import (
+    MailgunMIMERequestParser,
+    MailgunRequestParser,
+    MailgunSignatureMismatchError,
+)
+from ..errors import (
+    RequestParseError,
+    AttachmentTooLargeError,
+    AuthenticationError,
+    MessageTooLargeError,
+)
+from ..signals import email_received, email_received_unacceptable
+from ..spool import seal_spools
 
 from .test_files.mailgun_post import test_inbound_payload as mailgun_payload
 
@@ -103,3 +123,139 @@ class MailgunRequestParserTests(TestCase):
         # should except
         with self.assertRaises(AttachmentTooLargeError):
             self.parser.parse(request),
+
+    def test_message_max_size(self):
+        """Test the limit on the total size of a message's attachments."""
+        data = mailgun_payload.copy()
+        data['attachment-1'] = open(self.test_upload_txt, 'rb')
+        data['attachment-2'] = open(self.test_upload_png, 'rb')
+        total = stat(self.test_upload_txt).st_size + stat(self.test_upload_png).st_size
+        request = self.factory.post(self.url, data=data)
+
+        with override_settings(INBOUND_EMAIL_MESSAGE_SIZE_MAX=total - 1):
+            with self.assertRaises(MessageTooLargeError) as context:
+                self.parser.parse(request)
+            self.assertEqual(context.exception.size, total)
+
+
+@override_settings(INBOUND_MAILGUN_SIGNING_KEY='mailgun_key')
+class MailgunSignatureTests(TestCase):
+
+    def setUp(self):
+        self.url = reverse('receive_inbound_email')
+        self.factory = RequestFactory()
+        self.parser = MailgunRequestParser()
+
+    def _signed_payload(self, key='mailgun_key', timestamp=None, token=None):
+        data = mailgun_payload.copy()
+        data['timestamp'] = str(int(time.time()) if timestamp is None else timestamp)
+        data['token'] = token or uuid.uuid4().hex
+        data['signature'] = hmac.new(
+            key.encode('utf-8'),
+            (data['timestamp'] + data['token']).encode('utf-8'),
+            hashlib.sha256,
+        ).hexdigest()
+        return data
+
+    def test_valid_signature(self):
+        email = self.parser.parse(self.factory.post(self.url, data=self._signed_payload()))
+        self.assertEqual(email.subject, mailgun_payload['subject'])
+
+    def test_invalid_signature(self):
+        data = self._signed_payload(key='wrong_key')
+        with self.assertRaises(MailgunSignatureMismatchError) as context:
+            self.parser.parse(self.factory.post(self.url, data=data))
+        self.assertEqual(context.exception.expected_signature, data['signature'])
+
+    def test_non_ascii_signature(self):
+        data = dict(self._signed_payload(), signature='é')
+        with self.assertRaises(MailgunSignatureMismatchError):
+            self.parser.parse(self.factory.post(self.url, data=data))
+
+    def test_missing_signature(self):
+        with self.assertRaises(AuthenticationError):
+            self.parser.parse(self.factory.post(self.url, data=mailgun_payload))
+
+    def test_expired(self):
+        data = self._signed_payload(timestamp=int(time.time()) - 301)
+        with self.assertRaises(AuthenticationError):
+            self.parser.parse(self.factory.post(self.url, data=data))
+        with override_settings(INBOUND_MAILGUN_SIGNATURE_MAX_AGE=600):
+            self.assertIsNotNone(self.parser.parse(self.factory.post(self.url, data=data)))
+
+    def test_replayed_token(self):
+        data = self._signed_payload()
+        self.parser.parse(self.factory.post(self.url, data=data))
+        with self.assertRaises(AuthenticationError):
+            self.parser.parse(self.factory.post(self.url, data=data))
+
+    @override_settings(INBOUND_MAILGUN_TOKEN_CACHE=None)
+    def test_replayed_token__local_cache(self):
+        data = self._signed_payload()
+        self.parser.parse(self.factory.post(self.url, data=data))
+        with self.assertRaises(AuthenticationError):
+            self.parser.parse(self.factory.post(self.url, data=data))
+
+    def test_forged_token_not_recorded(self):
+        """Test that tokens are only recorded once the signature has been checked."""
+        data = self._signed_payload()
+        forged = dict(data, signature='0' * 64)
+        with self.assertRaises(MailgunSignatureMismatchError):
+            self.parser.parse(self.factory.post(self.url, data=forged))
+        self.assertIsNotNone(self.parser.parse(self.factory.post(self.url, data=data)))
+
+    def test_authenticate(self):
+        """Test that parse doesn't check the signature again after authenticate."""
+        request = self.factory.post(self.url, data=self._signed_payload())
+        self.parser.authenticate(request)
+        self.assertIsNotNone(self.parser.parse(request))
+        with self.assertRaises(AuthenticationError):
+            self.parser.authenticate(self.factory.post(self.url, data=mailgun_payload))
+
+    def test_mime_parser(self):
+        parser = MailgunMIMERequestParser()
+        data = {'body-mime': 'From: a@example.com\nTo: b@example.com\n\nHello'}
+        with self.assertRaises(AuthenticationError):
+            parser.parse(self.factory.post(self.url, data=data))
+        data.update(self._signed_payload())
+        self.assertEqual(parser.parse(self.factory.post(self.url, data=data)).body, 'Hello')
+
+    def test_view(self):
+        """Test that the view sends email_received_unacceptable for a bad signature."""
+        data = self._signed_payload(key='wrong_key')
+        receiver = mock.Mock()
+        email_received_unacceptable.connect(receiver)
+        try:
+            with override_settings(
+                INBOUND_EMAIL_PARSER='inbound_email.backends.mailgun.MailgunRequestParser'
+            ):
+                response = self.client.post(self.url, data=data)
+        finally:
+            email_received_unacceptable.disconnect(receiver)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsInstance(receiver.call_args[1]['exception'], MailgunSignatureMismatchError)
+
+    @override_settings(INBOUND_EMAIL_PARSER='inbound_email.backends.mailgun.MailgunRequestParser')
+    def test_spool(self):
+        """Test that spooled requests are checked on arrival, and not expired on replay."""
+        received = mock.Mock()
+        directory = tempfile.mkdtemp()
+        email_received.connect(received)
+        try:
+            with override_settings(INBOUND_EMAIL_SPOOL_DIRECTORY=directory):
+                response = self.client.post(self.url, data=self._signed_payload(key='wrong_key'))
+                self.assertEqual(response.status_code, 200)
+                seal_spools()
+                self.assertEqual(os.listdir(directory), [])
+
+                response = self.client.post(self.url, data=self._signed_payload())
+                self.assertContains(response, "Successfully spooled", status_code=200)
+                seal_spools()
+                with mock.patch('inbound_email.backends.mailgun.time') as mock_time:
+                    mock_time.time.return_value = time.time() + 600
+                    call_command('process_inbound_spool', once=True)
+        finally:
+            email_received.disconnect(received)
+            shutil.rmtree(directory)
+        self.assertEqual(received.call_count, 1)
+        self.assertEqual(received.call_args[1]['email'].subject, mailgun_payload['subject'])
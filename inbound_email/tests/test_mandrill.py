@@ -2,17 +2,24 @@ import hashlib
 import hmac
 import json
 import base64
+import os
+from unittest import mock
 
 from django.test import TestCase, override_settings
 from django.test.client import RequestFactory
 from django.urls import reverse
 from django.utils.encoding import smart_bytes
 
+from ..attachments import base64_decoded_size
 from ..backends.mandrill import (
     MandrillRequestParser,
     MandrillSignatureMismatchError,
+    _decode_base64,
+    _get_pool,
+    _iter_json_array,
+    _looks_like_base64,
 )
-from ..errors import RequestParseError, AttachmentTooLargeError
+from ..errors import RequestParseError, AttachmentTooLargeError, MessageTooLargeError
 
 from .test_files.mandrill_post import (
     post_data as mandrill_payload,
@@ -160,6 +167,65 @@ class MandrillRequestParserTests(TestCase):
             request,
         )
 
+    @override_settings(INBOUND_MANDRILL_AUTHENTICATION_KEY='mandrill_key')
+    def test_parse_valid_request__with_missing_signature(self):
+        request = self.factory.post(self.url, data=mandrill_payload)
+        with self.assertRaises(MandrillSignatureMismatchError) as context:
+            self.parser.parse(request)
+        self.assertIsNone(context.exception.expected_signature)
+        self.assertEqual(
+            context.exception.calculated_signature,
+            self._calculate_signature(
+                url='http://testserver' + self.url,
+                data=mandrill_payload.items(),
+                key='mandrill_key',
+            )
+        )
+
+    def test_looks_like_base64(self):
+        encoded = base64.b64encode(b'x' * 1000).decode()
+        self.assertTrue(_looks_like_base64(encoded))
+        self.assertTrue(_looks_like_base64('YQ=='))
+        self.assertFalse(_looks_like_base64(''))
+        self.assertFalse(_looks_like_base64('abc'))
+        self.assertFalse(_looks_like_base64('===='))
+        self.assertFalse(_looks_like_base64('a b='))
+        self.assertFalse(_looks_like_base64(' ' + encoded[1:]))
+        self.assertFalse(_looks_like_base64(encoded[:-1] + '!'))
+
+    def test_decode_base64(self):
+        content = b'\x00\x01' * 1000
+        encoded = base64.b64encode(content).decode()
+        self.assertEqual(_decode_base64(encoded), content)
+        self.assertEqual(_decode_base64('plain text'), 'plain text')
+        # passes the sampled check, but isn't valid base64 in the middle
+        invalid = encoded[:1000] + '!!!!' + encoded[1004:]
+        self.assertEqual(_decode_base64(invalid), invalid)
+        # incorrect padding
+        self.assertEqual(_decode_base64('abc='), b'i\xb7')
+        self.assertEqual(_decode_base64('ab=='), b'i')
+        self.assertEqual(_decode_base64('a==='), 'a===')
+
+    def test_iter_json_array(self):
+        self.assertEqual(list(_iter_json_array(' [ {"a": 1} ,\n{"b": [2]}] ')), [{'a': 1}, {'b': [2]}])
+        self.assertEqual(list(_iter_json_array('[]')), [])
+        self.assertEqual(list(_iter_json_array(' [ ] ')), [])
+        self.assertEqual(list(_iter_json_array('null')), [])
+        items = _iter_json_array('[{"a": 1} {"b": 2}]')
+        self.assertEqual(next(items), {'a': 1})
+        self.assertRaises(ValueError, next, items)
+
+    def test_iter_parse_yields_each_email(self):
+        """Test that emails are yielded before the rest of the batch is parsed."""
+        # break the JSON after the first event
+        first = json.loads(self.payload['mandrill_events'])[0]
+        events = '[%s, this is not json]' % json.dumps(first)
+        request = self.factory.post(self.url, data={'mandrill_events': events})
+        emails = self.parser.iter_parse(request)
+        email = next(emails)
+        self._assertEmailParsedCorrectly([email], self.payload)
+        self.assertRaises(RequestParseError, next, emails)
+
     def _process_dump(self, foo):
         dump = json.loads(self.payload['mandrill_events'])
         foo(dump)
@@ -191,6 +257,87 @@ class MandrillRequestParserTests(TestCase):
         with self.assertRaises(AttachmentTooLargeError):
             self.parser.parse(request)
 
+    def testbase64_decoded_size(self):
+        for size in (0, 1, 2, 3, 4, 100, 1000):
+            encoded = base64.b64encode(os.urandom(size)).decode()
+            self.assertEqual(base64_decoded_size(encoded), size)
+            encoded = base64.encodebytes(os.urandom(size)).decode()
+            self.assertEqual(base64_decoded_size(encoded), size)
+            self.assertEqual(base64_decoded_size(encoded.replace('\n', '\r\n')), size)
+
+    @override_settings(INBOUND_EMAIL_ATTACHMENT_SIZE_MAX=0)
+    def test_attachments_max_size_not_decoded(self):
+        """Test that oversized attachments are rejected before they are decoded."""
+        request = self.factory.post(self.url, data=mandrill_payload_with_attachments_mailbox)
+        with mock.patch('inbound_email.backends.mandrill.base64.b64decode') as b64decode:
+            with self.assertRaises(AttachmentTooLargeError) as context:
+                self.parser.parse(request)
+            b64decode.assert_not_called()
+        payload = json.loads(mandrill_payload_with_attachments_mailbox['mandrill_events'])
+        image = list(payload[0]['msg']['images'].values())[0]
+        self.assertEqual(context.exception.size, len(base64.b64decode(image['content'])))
+
+    def test_message_max_size(self):
+        """Test the limit on the total size of a message's attachments."""
+        request = self.factory.post(self.url, data=self.payload_with_attachments)
+        emails = self.parser.parse(request)
+        sizes = [len(smart_bytes(a[1])) for a in emails[0].attachments]
+        self.assertGreater(len(sizes), 1)
+
+        with override_settings(INBOUND_EMAIL_MESSAGE_SIZE_MAX=sum(sizes)):
+            request = self.factory.post(self.url, data=self.payload_with_attachments)
+            self.parser.parse(request)
+
+        with override_settings(INBOUND_EMAIL_MESSAGE_SIZE_MAX=sum(sizes) - 1):
+            request = self.factory.post(self.url, data=self.payload_with_attachments)
+            with self.assertRaises(MessageTooLargeError) as context:
+                self.parser.parse(request)
+            self.assertEqual(context.exception.size, sum(sizes))
+
+    def _get_batch(self, size):
+        """Return a payload containing `size` events, each with a unique subject."""
+        event = json.loads(self.payload_with_attachments['mandrill_events'])[0]
+        events = []
+        for i in range(size):
+            event = json.loads(json.dumps(event))
+            event['msg']['subject'] = 'Email %s' % i
+            events.append(event)
+        return {'mandrill_events': json.dumps(events)}
+
+    @override_settings(INBOUND_MANDRILL_PARSE_WORKERS=2, INBOUND_MANDRILL_PARSE_THRESHOLD=3)
+    def test_parse_in_pool(self):
+        """Test that large batches are parsed in the pool, in order."""
+        payload = self._get_batch(5)
+        with override_settings(INBOUND_MANDRILL_PARSE_WORKERS=None):
+            expected = self.parser.parse(self.factory.post(self.url, data=payload))
+
+        pool = _get_pool()
+        with mock.patch.object(pool, 'map', wraps=pool.map) as pool_map:
+            emails = self.parser.parse(self.factory.post(self.url, data=payload))
+        pool_map.assert_called_once()
+        self.assertEqual([e.subject for e in emails], ['Email %s' % i for i in range(5)])
+        for email, expected_email in zip(emails, expected):
+            self.assertEqual(email.to, expected_email.to)
+            self.assertEqual(email.body, expected_email.body)
+            self.assertEqual(email.attachments, expected_email.attachments)
+
+    @override_settings(INBOUND_MANDRILL_PARSE_WORKERS=2, INBOUND_MANDRILL_PARSE_THRESHOLD=3)
+    def test_parse_in_pool__small_batch(self):
+        """Test that batches below the threshold are parsed in-process."""
+        with mock.patch.object(_get_pool(), 'map') as pool_map:
+            emails = self.parser.parse(self.factory.post(self.url, data=self._get_batch(2)))
+        pool_map.assert_not_called()
+        self.assertEqual(len(emails), 2)
+
+    @override_settings(INBOUND_MANDRILL_PARSE_WORKERS=2, INBOUND_MANDRILL_PARSE_THRESHOLD=3)
+    def test_parse_in_pool__too_large(self):
+        """Test that errors raised in the pool are raised by parse."""
+        payload = self._get_batch(3)
+        with override_settings(INBOUND_EMAIL_ATTACHMENT_SIZE_MAX=0):
+            with self.assertRaises(AttachmentTooLargeError) as context:
+                self.parser.parse(self.factory.post(self.url, data=payload))
+        self.assertEqual(context.exception.email.subject, 'Email 0')
+
     def test_correspondent_field_parsing(self):
         """Test the speific address parsing of the Mandrill backend"""
         # Addresses https://github.com/yunojuno/django-inbound-email/issues/20
@@ -0,0 +1,136 @@
+import pickle
+from unittest import mock
+
+from django.core.mail import EmailMultiAlternatives
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+
+from ..backends.mailgun import MailgunRequestParser
+from ..backends.mandrill import MandrillRequestParser
+from ..backends.sendgrid import SendGridRequestParser
+from ..dispatch import _detach_email
+from ..errors import AttachmentTooLargeError
+from ..message import InboundEmail, normalize_address
+
+from .test_files.mailgun_post import test_inbound_payload as mailgun_payload
+from .test_files.mandrill_post import post_data_with_attachments as mandrill_payload
+from .test_files.sendgrid_post import test_inbound_payload as sendgrid_payload
+
+
+def _get_email(**kwargs):
+    fields = dict(
+        subject='Test',
+        from_email='from@example.com',
+        to=['to@example.com'],
+        cc=['cc@example.com'],
+        body='Text body',
+        html='<p>HTML body</p>',
+        attachments=[('test.txt', 'content', 'text/plain')],
+    )
+    fields.update(kwargs)
+    return InboundEmail(**fields)
+
+
+class NormalizeAddressTests(TestCase):
+
+    def test_normalize_address(self):
+        self.assertEqual(normalize_address('Fred <Fred@Example.com>'), 'fred@example.com')
+        self.assertEqual(normalize_address(' Fred@Example.com '), 'fred@example.com')
+
+
+class InboundEmailTests(TestCase):
+
+    def test_immutable(self):
+        email = _get_email()
+        self.assertEqual(email.to, ('to@example.com',))
+        with self.assertRaises(AttributeError):
+            email.subject = 'Changed'
+        with self.assertRaises(AttributeError):
+            email.extra = 'value'
+        with self.assertRaises(AttributeError):
+            del email.subject
+        self.assertEqual(email.replace(subject='Changed').subject, 'Changed')
+        self.assertEqual(email.subject, 'Test')
+
+    def test_lazy(self):
+        body = mock.Mock(return_value='Text body')
+        email = _get_email(body=body)
+        self.assertEqual(email.subject, 'Test')
+        body.assert_not_called()
+        self.assertEqual(email.body, 'Text body')
+        self.assertEqual(email.body, 'Text body')
+        body.assert_called_once_with()
+
+    def test_to_email_message(self):
+        message = _get_email().to_email_message()
+        self.assertIsInstance(message, EmailMultiAlternatives)
+        self.assertEqual(message.subject, 'Test')
+        self.assertEqual(message.to, ['to@example.com'])
+        self.assertEqual(message.cc, ['cc@example.com'])
+        self.assertEqual(message.body, 'Text body')
+        self.assertEqual(message.alternatives, [('<p>HTML body</p>', 'text/html')])
+        self.assertEqual(message.attachments, [('test.txt', 'content', 'text/plain')])
+        # it can be sent
+        message.message()
+
+    def test_recipients(self):
+        self.assertEqual(_get_email(bcc=['bcc@example.com']).recipients(), [
+            'to@example.com', 'cc@example.com', 'bcc@example.com'
+        ])
+
+    def test_pickle(self):
+        email = _get_email(body=lambda: 'Text body')
+        self.assertEqual(pickle.loads(pickle.dumps(email)), _get_email())
+
+    def test_detach(self):
+        email = _get_email()
+        self.assertEqual(_detach_email(email), email)
+
+
+@override_settings(INBOUND_EMAIL_LIGHTWEIGHT=True)
+class LightweightParserTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_sendgrid(self):
+        request = self.factory.post('/', data=sendgrid_payload)
+        email = SendGridRequestParser().parse(request)
+        self.assertIsInstance(email, InboundEmail)
+        self.assertEqual(email.subject, sendgrid_payload['subject'])
+        self.assertEqual(email.body, sendgrid_payload['text'])
+        self.assertEqual(email.html, sendgrid_payload['html'])
+
+    def test_mailgun(self):
+        request = self.factory.post('/', data=mailgun_payload)
+        email = MailgunRequestParser().parse(request)
+        self.assertIsInstance(email, InboundEmail)
+        self.assertEqual(email.subject, mailgun_payload['subject'])
+
+    def test_mandrill(self):
+        request = self.factory.post('/', data=mandrill_payload)
+        emails = MandrillRequestParser().parse(request)
+        with override_settings(INBOUND_EMAIL_LIGHTWEIGHT=False):
+            expected = MandrillRequestParser().parse(self.factory.post('/', data=mandrill_payload))
+        self.assertIsInstance(emails[0], InboundEmail)
+        self.assertEqual(list(emails[0].attachments), expected[0].attachments)
+
+    @override_settings(INBOUND_EMAIL_ATTACHMENT_SIZE_MAX=0)
+    def test_attachment_too_large(self):
+        request = self.factory.post('/', data=mandrill_payload)
+        with self.assertRaises(AttachmentTooLargeError) as context:
+            MandrillRequestParser().parse(request)
+        self.assertIsInstance(context.exception.email, InboundEmail)
+        self.assertEqual(context.exception.email.attachments, ())
+
+    def test_per_backend(self):
+        class LightweightSendGridRequestParser(SendGridRequestParser):
+            lightweight = True
+
+        with override_settings(INBOUND_EMAIL_LIGHTWEIGHT=False):
+            request = self.factory.post('/', data=sendgrid_payload)
+            self.assertIsInstance(SendGridRequestParser().parse(request), EmailMultiAlternatives)
+            request = self.factory.post('/', data=sendgrid_payload)
+            self.assertIsInstance(
+                LightweightSendGridRequestParser().parse(request), InboundEmail
+            )
@@ -0,0 +1,160 @@
+import socket
+from unittest import skipUnless
+
+import django
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+
+try:
+    from asgiref.sync import async_to_sync
+except ImportError:  # Django < 3.0
+    async_to_sync = None
+
+from ..backends.mandrill import MandrillRequestParser
+from ..backends.sendgrid import SendGridRequestParser
+from ..metrics import (
+    PrometheusSink,
+    RequestMetrics,
+    StatsDSink,
+    get_sinks,
+    incr,
+    timer,
+)
+from ..signals import email_received, metrics_recorded
+from ..views import receive_inbound_email, receive_inbound_email_async
+
+from .test_files.mandrill_post import post_data as mandrill_payload
+from .test_files.sendgrid_post import test_inbound_payload as sendgrid_payload
+
+SENDGRID_REQUEST_PARSER = "inbound_email.backends.sendgrid.SendGridRequestParser"
+MANDRILL_REQUEST_PARSER = "inbound_email.backends.mandrill.MandrillRequestParser"
+
+
+def _get_metrics(**counters):
+    metrics = RequestMetrics()
+    metrics.timings['parse'] = 0.25
+    metrics.counters.update(counters)
+    return metrics
+
+
+@override_settings(INBOUND_EMAIL_PARSER=SENDGRID_REQUEST_PARSER)
+class MetricsViewTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.recorded = []
+        metrics_recorded.connect(self.on_metrics_recorded)
+
+    def tearDown(self):
+        metrics_recorded.disconnect(self.on_metrics_recorded)
+
+    def on_metrics_recorded(self, sender, metrics, **kwargs):
+        self.recorded.append((sender, metrics))
+
+    def test_metrics(self):
+        request = self.factory.post('/', data=sendgrid_payload)
+        receive_inbound_email(request)
+        self.assertEqual(len(self.recorded), 1)
+        sender, metrics = self.recorded[0]
+        self.assertEqual(sender, SendGridRequestParser)
+        self.assertEqual(
+            set(metrics.timings), {'multipart', 'parse', 'dispatch', 'total'}
+        )
+        self.assertEqual(metrics.counters['emails'], 1)
+        self.assertEqual(metrics.counters['attachments'], 0)
+        self.assertEqual(metrics.counters['bytes'], int(request.META['CONTENT_LENGTH']))
+
+    @override_settings(
+        INBOUND_EMAIL_PARSER=MANDRILL_REQUEST_PARSER,
+        INBOUND_MANDRILL_AUTHENTICATION_KEY='mandrill_key',
+    )
+    def test_signature(self):
+        receive_inbound_email(self.factory.post('/', data=mandrill_payload))
+        sender, metrics = self.recorded[0]
+        self.assertEqual(sender, MandrillRequestParser)
+        self.assertIn('signature', metrics.timings)
+        self.assertEqual(metrics.counters['failures.MandrillSignatureMismatchError'], 1)
+
+    def test_parse_failure(self):
+        receive_inbound_email(self.factory.post('/', data={}))
+        _, metrics = self.recorded[0]
+        self.assertEqual(metrics.counters['failures.RequestParseError'], 1)
+        self.assertEqual(metrics.counters['emails'], 0)
+
+    def test_receiver_failure(self):
+        def on_email_received(sender, **kwargs):
+            raise ValueError("Receiver error")
+
+        email_received.connect(on_email_received)
+        try:
+            request = self.factory.post('/', data=sendgrid_payload)
+            self.assertRaises(ValueError, receive_inbound_email, request)
+        finally:
+            email_received.disconnect(on_email_received)
+        _, metrics = self.recorded[0]
+        self.assertEqual(metrics.counters['failures.ValueError'], 1)
+
+    @skipUnless(django.VERSION >= (3, 1), "async views require Django 3.1")
+    def test_async(self):
+        request = self.factory.post('/', data=sendgrid_payload)
+        async_to_sync(receive_inbound_email_async)(request)
+        _, metrics = self.recorded[0]
+        self.assertIn('multipart', metrics.timings)
+        self.assertIn('parse', metrics.timings)
+        self.assertEqual(metrics.counters['emails'], 1)
+
+    def test_outside_request(self):
+        # these do nothing if there is no current request
+        with timer('parse'):
+            incr('emails')
+
+
+class MetricsSinkTests(TestCase):
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        try:
+            sink = StatsDSink(host='127.0.0.1', port=server.getsockname()[1])
+            sink(sender=SendGridRequestParser, metrics=_get_metrics(emails=2))
+            packet = server.recv(4096).decode('utf-8')
+        finally:
+            server.close()
+        self.assertEqual(packet.split('\n'), [
+            'inbound_email.SendGridRequestParser.parse:250.000|ms',
+            'inbound_email.SendGridRequestParser.emails:2|c',
+        ])
+
+    def test_prometheus(self):
+        sink = PrometheusSink()
+        sink(sender=SendGridRequestParser, metrics=_get_metrics(emails=2))
+        sink(sender=SendGridRequestParser, metrics=_get_metrics(**{'failures.RequestParseError': 1}))
+        lines = sink.render().splitlines()
+        self.assertIn('inbound_email_requests_total{backend="SendGridRequestParser"} 2', lines)
+        self.assertIn('inbound_email_emails_total{backend="SendGridRequestParser"} 2', lines)
+        self.assertIn(
+            'inbound_email_failures_total{backend="SendGridRequestParser",'
+            'error="RequestParseError"} 1',
+            lines
+        )
+        self.assertIn(
+            'inbound_email_stage_seconds_sum{backend="SendGridRequestParser",'
+            'stage="parse"} 0.500000',
+            lines
+        )
+        self.assertIn(
+            'inbound_email_stage_seconds_count{backend="SendGridRequestParser",'
+            'stage="parse"} 2',
+            lines
+        )
+
+    @override_settings(
+        INBOUND_EMAIL_PARSER=SENDGRID_REQUEST_PARSER,
+        INBOUND_EMAIL_METRICS_SINKS={'inbound_email.metrics.PrometheusSink': {'namespace': 'test'}},
+    )
+    def test_configured_sinks(self):
+        receive_inbound_email(RequestFactory().post('/', data=sendgrid_payload))
+        sinks = get_sinks()
+        self.assertEqual(len(sinks), 1)
+        self.assertIn('test_emails_total{backend="SendGridRequestParser"} 1', sinks[0].render())
@@ -0,0 +1,81 @@
+from os import path
+
+from django.core.mail import EmailMultiAlternatives
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+
+from ..attachments import MIMEPartAttachment
+from ..backends.mailgun import MailgunMIMERequestParser
+from ..backends.sendgrid import SendGridRawRequestParser
+from ..errors import RequestParseError, AttachmentTooLargeError
+
+
+def _get_raw_message(attach=True):
+    """Build a raw MIME message, as it would be posted by the provider."""
+    email = EmailMultiAlternatives(
+        subject="Über test",
+        body="Plain text body",
+        from_email="Fred Flintstone <fred@example.com>",
+        to=["barney@example.com", "Wilma <wilma@example.com>"],
+        cc=["betty@example.com"],
+        headers={'Message-ID': '<12345@example.com>'},
+    )
+    email.attach_alternative("<p>HTML body</p>", "text/html")
+    if attach:
+        with open(path.join(path.dirname(__file__), 'test_files', 'test_upload_file.jpg'), 'rb') as f:
+            email.attach('test_upload_file.jpg', f.read(), 'image/jpeg')
+    return email.message().as_string()
+
+
+class MIMERequestParserTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.parser = SendGridRawRequestParser()
+
+    def _parse(self, raw, field='email'):
+        return self.parser.parse(self.factory.post('/', data={field: raw}))
+
+    def test_parse(self):
+        email = self._parse(_get_raw_message())
+        self.assertIsInstance(email, EmailMultiAlternatives)
+        self.assertEqual(email.subject, "Über test")
+        self.assertEqual(email.from_email, "fred@example.com")
+        self.assertEqual(email.to, ["barney@example.com", "wilma@example.com"])
+        self.assertEqual(email.cc, ["betty@example.com"])
+        self.assertEqual(email.body, "Plain text body")
+        self.assertEqual(email.alternatives, [("<p>HTML body</p>", "text/html")])
+
+    def test_attachments_are_lazy(self):
+        email = self._parse(_get_raw_message())
+        self.assertEqual(len(email.attachments), 1)
+        attachment = email.attachments[0]
+        self.assertIsInstance(attachment, MIMEPartAttachment)
+        self.assertFalse(attachment.loaded)
+        self.assertEqual(attachment.filename, 'test_upload_file.jpg')
+        self.assertEqual(attachment.mimetype, 'image/jpeg')
+        with open(path.join(path.dirname(__file__), 'test_files', 'test_upload_file.jpg'), 'rb') as f:
+            content = f.read()
+        # the size is known before the content is decoded
+        self.assertEqual(attachment.size, len(content))
+        self.assertFalse(attachment.loaded)
+        self.assertEqual(attachment.content, content)
+
+    def test_attachment_too_large(self):
+        with override_settings(INBOUND_EMAIL_ATTACHMENT_SIZE_MAX=100):
+            self.assertRaises(AttachmentTooLargeError, self._parse, _get_raw_message())
+
+    def test_missing_field(self):
+        self.assertRaises(RequestParseError, self._parse, _get_raw_message(), field='text')
+
+    def test_missing_from_address(self):
+        raw = _get_raw_message(attach=False).replace(
+            "From: Fred Flintstone <fred@example.com>", "From: nobody"
+        )
+        self.assertRaises(RequestParseError, self._parse, raw)
+
+    def test_mailgun(self):
+        self.parser = MailgunMIMERequestParser()
+        email = self._parse(_get_raw_message(attach=False), field='body-mime')
+        self.assertEqual(email.subject, "Über test")
+        self.assertEqual(email.attachments, [])
@@ -0,0 +1,167 @@
+import json
+import pickle
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+
+from ..backends.mandrill import MandrillRequestParser
+from ..backends.sendgrid import SendGridRequestParser
+from ..dedupe import _get_recent_emails
+from ..errors import RateLimitedError
+from ..message import Envelope
+from ..metrics import collect
+from ..ratelimit import TokenBucketLimiter, check, enabled, get_limiters, parse_rate
+from ..signals import email_received_unacceptable
+
+from .test_files.mandrill_post import post_data as mandrill_payload
+from .test_files.sendgrid_post import test_inbound_payload as sendgrid_payload
+
+
+def _envelope(from_email='from@example.com', to=('to@example.com',), cc=()):
+    return Envelope(from_email, list(to), list(cc), 'Subject', None, None)
+
+
+class TokenBucketLimiterTests(TestCase):
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('60/m'), (60, 60))
+        self.assertEqual(parse_rate('10/s'), (10, 1))
+        self.assertEqual(parse_rate('1000/hour'), (1000, 3600))
+        for rate in ('60', '60/x', 'a/m', None):
+            with self.assertRaises(ValueError):
+                parse_rate(rate)
+
+    @mock.patch('inbound_email.ratelimit.time')
+    def test_allow(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        limiter = TokenBucketLimiter('test:', count=2, period=60)
+        self.assertTrue(limiter.allow('a'))
+        self.assertTrue(limiter.allow('a'))
+        self.assertFalse(limiter.allow('a'))
+        # each key has its own bucket
+        self.assertTrue(limiter.allow('b'))
+        # a token is added every 30 seconds
+        mock_time.time.return_value = 1029.0
+        self.assertFalse(limiter.allow('a'))
+        mock_time.time.return_value = 1031.0
+        self.assertTrue(limiter.allow('a'))
+        self.assertFalse(limiter.allow('a'))
+        # and the bucket never holds more than count
+        mock_time.time.return_value = 5000.0
+        self.assertTrue(limiter.allow('a'))
+        self.assertTrue(limiter.allow('a'))
+        self.assertFalse(limiter.allow('a'))
+
+    def test_max_size(self):
+        limiter = TokenBucketLimiter('test:', count=1, period=60, max_size=2)
+        for key in ('a', 'b', 'c'):
+            self.assertTrue(limiter.allow(key))
+        self.assertEqual(list(limiter._local), ['b', 'c'])
+
+    def test_cache(self):
+        limiter = TokenBucketLimiter(
+            'test:ratelimit:', count=1, period=60, cache_alias='default'
+        )
+        self.assertTrue(limiter.allow('cached@example.com'))
+        # the bucket is shared with other limiters (e.g. in other processes)
+        other = TokenBucketLimiter(
+            'test:ratelimit:', count=1, period=60, cache_alias='default'
+        )
+        self.assertFalse(other.allow('cached@example.com'))
+        self.assertEqual(len(limiter._local), 0)
+
+
+class RateLimitTests(TestCase):
+
+    def test_disabled(self):
+        self.assertFalse(enabled())
+        self.assertEqual(get_limiters(), (None, None))
+        for _ in range(10):
+            check(_envelope())
+
+    @override_settings(INBOUND_EMAIL_RATE_LIMIT_SENDER='2/m')
+    def test_sender(self):
+        self.assertTrue(enabled())
+        check(_envelope())
+        check(_envelope(from_email='"From" <FROM@example.com>'))
+        with self.assertRaises(RateLimitedError) as context:
+            check(_envelope())
+        self.assertEqual(context.exception.limit, 'sender')
+        self.assertEqual(context.exception.key, 'from@example.com')
+        check(_envelope(from_email='other@example.com'))
+
+    @override_settings(INBOUND_EMAIL_RATE_LIMIT_RECIPIENT='1/m')
+    def test_recipient(self):
+        check(_envelope(to=['a@example.com'], cc=['b@example.com']))
+        check(_envelope(to=['c@example.com']))
+        with self.assertRaises(RateLimitedError) as context:
+            check(_envelope(to=['c@example.com', 'd@example.com']))
+        self.assertEqual(context.exception.limit, 'recipient')
+        self.assertEqual(context.exception.key, 'c@example.com')
+
+    def test_error_pickle(self):
+        error = RateLimitedError(_envelope(), 'sender', 'from@example.com')
+        copy = pickle.loads(pickle.dumps(error))
+        self.assertEqual(copy.envelope, error.envelope)
+        self.assertEqual(str(copy), str(error))
+        self.assertIsNone(copy.email)
+
+
+class ParserRateLimitTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.unacceptable = mock.Mock()
+        email_received_unacceptable.connect(self.unacceptable)
+
+    def tearDown(self):
+        email_received_unacceptable.disconnect(self.unacceptable)
+
+    @override_settings(INBOUND_EMAIL_RATE_LIMIT_SENDER='1/m')
+    def test_sendgrid(self):
+        parser = SendGridRequestParser()
+        self.assertIsNotNone(parser.parse(self.factory.post('/', data=sendgrid_payload)))
+        self.unacceptable.assert_not_called()
+
+        with collect(SendGridRequestParser) as metrics:
+            self.assertIsNone(parser.parse(self.factory.post('/', data=sendgrid_payload)))
+        self.assertEqual(metrics.counters['failures.RateLimitedError'], 1)
+        kwargs = self.unacceptable.call_args[1]
+        self.assertIsNone(kwargs['email'])
+        self.assertIsInstance(kwargs['exception'], RateLimitedError)
+        self.assertEqual(kwargs['exception'].envelope.subject, sendgrid_payload['subject'])
+
+    @override_settings(INBOUND_EMAIL_RATE_LIMIT_SENDER='1/m', INBOUND_EMAIL_DEDUPE_TIMEOUT=60)
+    def test_duplicates(self):
+        """Test that retries are dropped as duplicates, without using up the rate limits."""
+        cache.clear()
+        _get_recent_emails().clear()
+        parser = SendGridRequestParser()
+        request = self.factory.post('/', data=sendgrid_payload)
+        parser.received(request, parser.parse(request))
+
+        with collect(SendGridRequestParser) as metrics:
+            self.assertIsNone(parser.parse(self.factory.post('/', data=sendgrid_payload)))
+        self.assertEqual(metrics.counters['duplicates'], 1)
+        self.unacceptable.assert_not_called()
+
+    @override_settings(INBOUND_EMAIL_RATE_LIMIT_RECIPIENT='2/m')
+    def test_mandrill_batch(self):
+        """Test that only the rate limited emails in a batch are dropped."""
+        event = json.loads(mandrill_payload['mandrill_events'])[0]
+        events = []
+        for i in range(3):
+            event = json.loads(json.dumps(event))
+            event['msg']['subject'] = 'Email %s' % i
+            event['msg']['headers']['Message-Id'] = '<%s@example.com>' % i
+            events.append(event)
+        parser = MandrillRequestParser()
+        with mock.patch.object(parser, '_parse_message', wraps=parser._parse_message) as parse:
+            emails = parser.parse(
+                self.factory.post('/', data={'mandrill_events': json.dumps(events)})
+            )
+        self.assertEqual([e.subject for e in emails], ['Email 0', 'Email 1'])
+        self.assertEqual(parse.call_count, 2)
+        self.unacceptable.assert_called_once()
@@ -0,0 +1,204 @@
+import json
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+from django.urls import reverse
+
+from ..backends.mailgun import MailgunRequestParser
+from ..backends.mandrill import MandrillRequestParser
+from ..backends.sendgrid import SendGridRawRequestParser
+from ..routing import Router, get_router
+from ..signals import email_received
+
+from .test_files.mailgun_post import test_inbound_payload as mailgun_payload
+from .test_files.mandrill_post import post_data_with_attachments as mandrill_payload
+from .test_mime import _get_raw_message
+
+# the router used by the INBOUND_EMAIL_ROUTER tests
+test_router = Router()
+test_handler = mock.Mock()
+test_router.register('alice@*', test_handler)
+
+
+def _handler(name):
+    handler = mock.Mock()
+    handler.name = name
+    return handler
+
+
+class RouterTests(TestCase):
+
+    def setUp(self):
+        self.router = Router()
+        self.handlers = {}
+        for pattern in (
+            'support@example.com',
+            'help@*',
+            'reply+*@example.com',
+            'bounce+*@*',
+            '*@tenant.com',
+            '*@*.example.com',
+        ):
+            self.handlers[pattern] = _handler(pattern)
+            self.router.register(pattern, self.handlers[pattern])
+
+    def _match(self, address):
+        route = self.router.match(address)
+        if route is None:
+            return None
+        handler, match = route
+        self.assertEqual(handler.name, match.pattern)
+        return match
+
+    def test_exact(self):
+        match = self._match('Support@Example.com')
+        self.assertEqual(match.pattern, 'support@example.com')
+        self.assertEqual(match.address, 'Support@Example.com')
+        self.assertEqual((match.local, match.domain, match.tag), ('support', 'example.com', None))
+        self.assertEqual(self._match('help@anywhere.org').pattern, 'help@*')
+        self.assertIsNone(self._match('other@example.com'))
+
+    def test_plus_address(self):
+        match = self._match('reply+AbC123@example.com')
+        self.assertEqual(match.pattern, 'reply+*@example.com')
+        self.assertEqual(match.tag, 'AbC123')
+        self.assertEqual(self._match('bounce+x@other.org').tag, 'x')
+        self.assertIsNone(self._match('reply+abc@other.org'))
+        self.assertIsNone(self._match('reply@example.com'))
+
+    def test_domains(self):
+        self.assertEqual(self._match('anyone@TENANT.com').pattern, '*@tenant.com')
+        self.assertIsNone(self._match('anyone@sub.tenant.com'))
+        self.assertEqual(self._match('anyone@a.b.example.com').pattern, '*@*.example.com')
+        self.assertIsNone(self._match('anyone@example.com'))
+
+    def test_catch_all(self):
+        self.assertIsNone(self._match('anyone@nowhere.org'))
+        self.router.register('*@*', _handler('*@*'))
+        self.assertEqual(self._match('anyone@nowhere.org').pattern, '*@*')
+        self.assertEqual(self._match('support@example.com').pattern, 'support@example.com')
+
+    def test_precedence(self):
+        self.router.register('support@tenant.com', _handler('support@tenant.com'))
+        self.assertEqual(self._match('support@tenant.com').pattern, 'support@tenant.com')
+        self.router.register('*@example.com', _handler('*@example.com'))
+        self.assertEqual(self._match('reply+1@example.com').pattern, 'reply+*@example.com')
+
+    def test_display_name(self):
+        self.assertEqual(self._match('"Support" <support@example.com>').address, 'support@example.com')
+        self.assertEqual(self._match(' support@example.com').address, 'support@example.com')
+        self.assertIsNone(self._match('undisclosed-recipients:;'))
+        self.assertIsNone(self._match(''))
+
+    def test_invalid_pattern(self):
+        for pattern in ('support', '@example.com', 'support@'):
+            with self.assertRaises(ValueError):
+                self.router.register(pattern, _handler(pattern))
+        with self.assertRaises(ValueError):
+            self.router.register('SUPPORT@example.com', _handler('support@example.com'))
+
+    def test_register_decorator(self):
+        @self.router.register('sales@example.com')
+        def on_sales(**kwargs):
+            pass
+        self.assertEqual(self.router.match('sales@example.com')[0], on_sales)
+
+    def test_resolve(self):
+        routes = self.router.resolve([
+            'support@example.com', 'nobody@nowhere.org', 'support@example.com',
+            'reply+1@example.com', 'reply+2@example.com',
+        ])
+        self.assertEqual(
+            [(match.pattern, match.tag) for _, match in routes],
+            [('support@example.com', None), ('reply+*@example.com', '1'),
+             ('reply+*@example.com', '2')]
+        )
+        self.assertTrue(self.router.is_routed(['', 'nobody@nowhere.org', 'help@x.com']))
+        self.assertFalse(self.router.is_routed(['', 'nobody@nowhere.org']))
+
+    def test_call(self):
+        email = mock.Mock(to=['support@example.com'], cc=['reply+1@example.com'], bcc=[])
+        self.router(sender=None, email=email, request='request')
+        _, match = self.router.match('support@example.com')
+        self.handlers['support@example.com'].assert_called_once_with(
+            sender=None, email=email, request='request', match=match
+        )
+        self.assertEqual(
+            self.handlers['reply+*@example.com'].call_args[1]['match'].tag, '1'
+        )
+        self.handlers['*@tenant.com'].assert_not_called()
+
+
+@override_settings(
+    INBOUND_EMAIL_ROUTER='inbound_email.tests.test_routing.test_router',
+    INBOUND_EMAIL_PARSER='inbound_email.backends.mailgun.MailgunRequestParser',
+)
+class RoutingTests(TestCase):
+
+    def setUp(self):
+        self.url = reverse('receive_inbound_email')
+        self.factory = RequestFactory()
+        test_handler.reset_mock()
+
+    def test_get_router(self):
+        self.assertIs(get_router(), test_router)
+        with override_settings(INBOUND_EMAIL_ROUTER=None):
+            self.assertIsNone(get_router())
+
+    def test_routed(self):
+        """Test that routed emails are sent with email_received, and to the handler."""
+        receiver = mock.Mock()
+        email_received.connect(receiver)
+        try:
+            response = self.client.post(self.url, data=mailgun_payload.copy())
+        finally:
+            email_received.disconnect(receiver)
+        self.assertEqual(response.status_code, 200)
+        receiver.assert_called_once()
+        test_handler.assert_called_once()
+        match = test_handler.call_args[1]['match']
+        self.assertEqual(match.local, 'alice')
+        self.assertEqual(test_handler.call_args[1]['email'], receiver.call_args[1]['email'])
+
+    def test_unrouted(self):
+        """Test that unrouted emails are dropped before the attachments are processed."""
+        payload = mailgun_payload.copy()
+        payload['recipient'] = 'bob@example.com'
+        request = self.factory.post(self.url, data=payload)
+        self.assertIsNone(MailgunRequestParser().parse(request))
+
+        receiver = mock.Mock()
+        email_received.connect(receiver)
+        try:
+            response = self.client.post(self.url, data=payload)
+        finally:
+            email_received.disconnect(receiver)
+        self.assertEqual(response.status_code, 200)
+        receiver.assert_not_called()
+        test_handler.assert_not_called()
+
+    def test_unrouted_mime(self):
+        """Test that unrouted raw messages are dropped before the body is parsed."""
+        parser = SendGridRawRequestParser()
+        raw = _get_raw_message(attach=False)
+        with mock.patch.object(parser, 'parse_mime', wraps=parser.parse_mime) as parse_mime:
+            self.assertIsNone(parser.parse(self.factory.post(self.url, data={'email': raw})))
+            parse_mime.assert_not_called()
+            raw = raw.replace('barney@example.com', 'alice@example.com', 1)
+            email = parser.parse(self.factory.post(self.url, data={'email': raw}))
+        self.assertIn('alice@example.com', email.to)
+
+    def test_unrouted_mandrill(self):
+        events = json.loads(mandrill_payload['mandrill_events'])
+        events[0]['msg']['to'] = [['alice@example.com', 'Alice']]
+        events.append(json.loads(json.dumps(events[0])))
+        events[1]['msg']['to'] = [['bob@example.com', None]]
+        request = self.factory.post(self.url, data={'mandrill_events': json.dumps(events)})
+
+        with mock.patch('inbound_email.backends.mandrill.base64_decoded_size') as decoded_size:
+            decoded_size.return_value = 0
+            emails = MandrillRequestParser().parse(request)
+        self.assertEqual([e.to for e in emails], [['"Alice" <alice@example.com>']])
+        # only the routed email's attachment is decoded
+        decoded_size.assert_called_once()
@@ -1,13 +1,27 @@
+import base64
+import hashlib
+import time
 from os import path
+from unittest import mock, skipIf
 
 from django.core.mail import EmailMultiAlternatives
 from django.test import TestCase, override_settings
 from django.test.client import RequestFactory
 from django.urls import reverse
+from django.utils.datastructures import MultiValueDictKeyError
 from django.utils.encoding import smart_text, smart_bytes
 
-from ..backends.sendgrid import SendGridRequestParser
-from ..errors import RequestParseError, AttachmentTooLargeError
+from ..backends.sendgrid import (
+    SIGNATURE_HEADER,
+    TIMESTAMP_HEADER,
+    SendGridRequestParser,
+    _POSTDecoder,
+    _digest_body,
+    _is_utf8,
+    ec,
+)
+from ..errors import RequestParseError, AttachmentTooLargeError, AuthenticationError
+from ..signals import email_received, email_received_unacceptable
 
 from .test_files.sendgrid_post import test_inbound_payload as sendgrid_payload
 from .test_files.sendgrid_post_windows_1252 import test_inbound_payload_1252
@@ -283,3 +297,163 @@ class SendGridRequestParserTests(TestCase):
         request = self.factory.post(self.url, data=data)
         email = self.parser.parse(request)
         self.assertEqual(email.body, smart_text(data['text']))
+
+    def test_decoder_parses_charsets_once(self):
+        """Test the POST decoder reads the charsets field once per request."""
+        request = self.factory.post(self.url, data=test_inbound_payload_1252)
+        decoder = _POSTDecoder(request)
+        self.assertEqual(decoder.charsets['text'], 'windows-1252')
+        with mock.patch('inbound_email.backends.sendgrid.json.loads') as loads:
+            self.assertEqual(decoder.decode('subject'), test_inbound_payload_1252['subject'])
+            self.assertEqual(decoder.decode('html', default='x'), 'x')
+            loads.assert_not_called()
+        with self.assertRaises(MultiValueDictKeyError):
+            decoder.decode('bcc')
+
+    def test_is_utf8(self):
+        self.assertTrue(_is_utf8('UTF-8'))
+        self.assertTrue(_is_utf8('utf8'))
+        self.assertFalse(_is_utf8('windows-1252'))
+        self.assertFalse(_is_utf8('not-a-charset'))
+
+
+@override_settings(INBOUND_EMAIL_PARSER='inbound_email.backends.sendgrid.SendGridRequestParser')
+class SendGridAuthenticationTests(TestCase):
+
+    def setUp(self):
+        self.url = reverse('receive_inbound_email')
+        self.factory = RequestFactory()
+        self.parser = SendGridRequestParser()
+
+    def _auth_header(self, credentials):
+        return 'Basic %s' % base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+
+    def test_not_configured(self):
+        request = self.factory.post(self.url, data=sendgrid_payload)
+        self.parser.authenticate(request)
+
+    @override_settings(INBOUND_SENDGRID_BASIC_AUTH='user:password')
+    def test_basic_auth(self):
+        request = self.factory.post(
+            self.url, data=sendgrid_payload, HTTP_AUTHORIZATION=self._auth_header('user:password')
+        )
+        self.parser.authenticate(request)
+        for header in (self._auth_header('user:wrong'), 'garbage', None):
+            extra = {'HTTP_AUTHORIZATION': header} if header else {}
+            request = self.factory.post(self.url, data=sendgrid_payload, **extra)
+            with self.assertRaises(AuthenticationError):
+                self.parser.authenticate(request)
+
+    @override_settings(INBOUND_SENDGRID_SECRET='s3cret')
+    def test_secret(self):
+        self.parser.authenticate(self.factory.post(self.url + '?secret=s3cret', data={}))
+        for url in (self.url + '?secret=wrong', self.url):
+            with self.assertRaises(AuthenticationError):
+                self.parser.authenticate(self.factory.post(url, data={}))
+
+    @override_settings(INBOUND_SENDGRID_SECRET='s3cret')
+    def test_view_rejects_before_parsing(self):
+        """Test that unauthenticated requests are rejected before request.POST is parsed."""
+        received = mock.Mock()
+        unacceptable = mock.Mock()
+        email_received.connect(received)
+        email_received_unacceptable.connect(unacceptable)
+        try:
+            with mock.patch(
+                'django.core.handlers.wsgi.WSGIRequest._load_post_and_files'
+            ) as load_post:
+                response = self.client.post(self.url + '?secret=wrong', data=sendgrid_payload)
+            load_post.assert_not_called()
+            self.assertEqual(response.status_code, 200)
+            received.assert_not_called()
+            self.assertIsInstance(
+                unacceptable.call_args[1]['exception'], AuthenticationError
+            )
+
+            response = self.client.post(self.url + '?secret=s3cret', data=sendgrid_payload)
+            received.assert_called_once()
+        finally:
+            email_received.disconnect(received)
+            email_received_unacceptable.disconnect(unacceptable)
+
+    def test_digest_body(self):
+        """Test that the body can still be parsed once it has been digested."""
+        data = sendgrid_payload.copy()
+        data['attachment1'] = open(
+            path.join(path.dirname(__file__), 'test_files/test_upload_file.jpg'), 'rb'
+        )
+        request = self.factory.post(self.url, data=data)
+        expected = hashlib.sha256(request.body).hexdigest()
+
+        data['attachment1'].seek(0)
+        request = self.factory.post(self.url, data=data)
+        digest = hashlib.sha256()
+        with override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=1024):
+            _digest_body(request, digest)
+        self.assertEqual(digest.hexdigest(), expected)
+        self.assertEqual(request.POST['subject'], sendgrid_payload['subject'])
+        self.assertEqual(request.FILES['attachment1'].name, 'test_upload_file.jpg')
+
+    def test_digest_body_too_large(self):
+        """Test that unverified bodies larger than max_size are rejected before they are buffered."""
+        request = self.factory.post(self.url, data=sendgrid_payload)
+        size = len(request.body)
+        request = self.factory.post(self.url, data=sendgrid_payload)
+        with mock.patch('tempfile.SpooledTemporaryFile') as temporary_file:
+            with self.assertRaises(AuthenticationError):
+                _digest_body(request, hashlib.sha256(), max_size=size - 1)
+        temporary_file.assert_not_called()
+
+        # without a Content-Length, the body is limited as it is read
+        request = self.factory.post(self.url, data=sendgrid_payload)
+        del request.META['CONTENT_LENGTH']
+        with self.assertRaises(AuthenticationError):
+            _digest_body(request, hashlib.sha256(), max_size=size - 1)
+
+        request = self.factory.post(self.url, data=sendgrid_payload)
+        _digest_body(request, hashlib.sha256(), max_size=size)
+        self.assertEqual(request.POST['subject'], sendgrid_payload['subject'])
+
+    @skipIf(ec is None, "requires the cryptography package")
+    def test_signature(self):
+        from cryptography.hazmat.primitives import hashes, serialization
+
+        private_key = ec.generate_private_key(ec.SECP256R1())
+        public_key = base64.b64encode(private_key.public_key().public_bytes(
+            serialization.Encoding.DER,
+            serialization.PublicFormat.SubjectPublicKeyInfo,
+        )).decode('ascii')
+
+        def _request(timestamp, signed_timestamp=None):
+            request = self.factory.post(self.url, data=sendgrid_payload)
+            payload = (signed_timestamp or timestamp).encode('utf-8') + request.body
+            signature = private_key.sign(payload, ec.ECDSA(hashes.SHA256()))
+            request = self.factory.post(self.url, data=sendgrid_payload, **{
+                SIGNATURE_HEADER: base64.b64encode(signature).decode('ascii'),
+                TIMESTAMP_HEADER: timestamp,
+            })
+            return request
+
+        now = int(time.time())
+        with override_settings(INBOUND_SENDGRID_VERIFICATION_KEY=public_key):
+            request = _request(str(now))
+            self.parser.authenticate(request)
+            self.assertEqual(self.parser.parse(request).subject, sendgrid_payload['subject'])
+
+            with self.assertRaises(AuthenticationError):
+                self.parser.authenticate(_request(str(now + 1), signed_timestamp=str(now)))
+            # requests that are too old are rejected before the body is read
+            request = _request(str(now - 301))
+            with mock.patch('inbound_email.backends.sendgrid._digest_body') as digest_body:
+                with self.assertRaises(AuthenticationError):
+                    self.parser.authenticate(request)
+            digest_body.assert_not_called()
+            with override_settings(INBOUND_SENDGRID_SIGNATURE_MAX_AGE=600):
+                self.parser.authenticate(_request(str(now - 301)))
+            # requests replayed from the spool were checked when they arrived
+            with mock.patch('inbound_email.backends.sendgrid.is_spooled', return_value=True):
+                self.parser.authenticate(_request(str(now - 3600)))
+            with self.assertRaises(AuthenticationError):
+                self.parser.authenticate(_request('not a timestamp'))
+            with self.assertRaises(AuthenticationError):
+                self.parser.authenticate(self.factory.post(self.url, data=sendgrid_payload))
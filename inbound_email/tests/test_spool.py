@@ -0,0 +1,213 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.mail import EmailMultiAlternatives
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+
+from ..errors import RequestTooLargeError
+from ..signals import email_received
+from ..spool import RequestSpool, deserialize_request, get_spool, iter_records, seal_spools
+from ..views import receive_inbound_email
+
+from .test_files.sendgrid_post import test_inbound_payload as sendgrid_payload
+
+SENDGRID_REQUEST_PARSER = "inbound_email.backends.sendgrid.SendGridRequestParser"
+
+
+class RequestSpoolTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.directory = tempfile.mkdtemp()
+        self.spool = RequestSpool(self.directory)
+
+    def tearDown(self):
+        self.spool.seal()
+        shutil.rmtree(self.directory)
+
+    def _read_all(self):
+        records = []
+        while True:
+            path = self.spool.claim_segment()
+            if path is None:
+                return records
+            records.extend(iter_records(path))
+            os.remove(path)
+
+    def test_append(self):
+        request = self.factory.post('/inbound/?a=1', data=sendgrid_payload)
+        self.spool.append(request)
+        # the segment isn't processed until it has been sealed
+        self.assertIsNone(self.spool.claim_segment())
+        self.spool.seal()
+        records = self._read_all()
+        self.assertEqual(len(records), 1)
+
+        replayed = deserialize_request(records[0])
+        self.assertEqual(replayed.method, 'POST')
+        self.assertEqual(replayed.path, '/inbound/')
+        self.assertEqual(replayed.GET['a'], '1')
+        self.assertEqual(replayed.POST['subject'], sendgrid_payload['subject'])
+        self.assertEqual(replayed.build_absolute_uri(), request.build_absolute_uri())
+
+    def test_max_request_size(self):
+        request = self.factory.post('/', data=sendgrid_payload)
+        size = len(request.body)
+        spool = RequestSpool(self.directory, max_request_size=size - 1)
+        # rejected by the Content-Length...
+        self.assertRaises(RequestTooLargeError, spool.append, request)
+        # ...or as the body is read
+        request = self.factory.post('/', data=sendgrid_payload)
+        request.META['CONTENT_LENGTH'] = '1'
+        with self.assertRaises(RequestTooLargeError) as context:
+            spool.append(request)
+        self.assertEqual(context.exception.size, size)
+        spool.seal()
+        self.assertEqual(self._read_all(), [])
+
+        spool.max_request_size = size
+        spool.append(self.factory.post('/', data=sendgrid_payload))
+        spool.seal()
+        self.assertEqual(len(self._read_all()), 1)
+
+    def test_large_body(self):
+        """Test that the body is streamed into the segment, rather than held in memory."""
+        content = b'x' * 3 * 2 ** 20
+        data = {'subject': 'test', 'attachment1': SimpleUploadedFile('a.txt', content)}
+        with override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=2 ** 20):
+            self.spool.append(self.factory.post('/', data=data))
+        self.spool.seal()
+        records = self._read_all()
+        self.assertEqual(deserialize_request(records[0]).FILES['attachment1'].read(), content)
+
+    def test_concurrent_appends(self):
+        def append():
+            for _ in range(5):
+                self.spool.append(self.factory.post('/', data={'subject': 'test'}))
+
+        threads = [threading.Thread(target=append) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.spool.seal()
+        self.assertEqual(len(self._read_all()), 20)
+
+    def test_segment_size(self):
+        self.spool.segment_size = 1
+        for _ in range(3):
+            self.spool.append(self.factory.post('/', data={'subject': 'test'}))
+        # each append seals the previous segment
+        self.assertEqual(self.spool.pending_count(), 2)
+
+    def test_segment_age(self):
+        spool = RequestSpool(self.directory, segment_age=0.01)
+        spool.append(self.factory.post('/', data={'subject': 'test'}))
+        # sealed by the timer, without another append
+        for _ in range(100):
+            if spool.pending_count():
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(spool.pending_count(), 1)
+
+    def test_truncated_record(self):
+        for _ in range(2):
+            self.spool.append(self.factory.post('/', data={'subject': 'test'}))
+        path = self.spool._path
+        self.spool.seal()
+        sealed = path[:-len('.open')] + '.spool'
+        with open(sealed, 'r+b') as f:
+            f.truncate(os.path.getsize(sealed) - 10)
+        self.assertEqual(len(self._read_all()), 1)
+
+    def test_abandoned_claim(self):
+        self.spool.append(self.factory.post('/', data={'subject': 'test'}))
+        self.spool.seal()
+        path = self.spool.claim_segment()
+        # a claim by a live process is left alone...
+        self.assertIsNone(self.spool.claim_segment())
+        # ...but not one by a process that has died
+        os.rename(path, path.replace('.%s.' % os.getpid(), '.999999999.'))
+        self.assertEqual(len(self._read_all()), 1)
+
+
+class SpoolViewTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.directory = tempfile.mkdtemp()
+        self.received = []
+        email_received.connect(self.on_email_received)
+        self.overrides = override_settings(
+            INBOUND_EMAIL_PARSER=SENDGRID_REQUEST_PARSER,
+            INBOUND_EMAIL_SPOOL_DIRECTORY=self.directory,
+        )
+        self.overrides.enable()
+
+    def tearDown(self):
+        self.overrides.disable()
+        email_received.disconnect(self.on_email_received)
+        shutil.rmtree(self.directory)
+
+    def on_email_received(self, sender, email, request, **kwargs):
+        self.received.append(email)
+
+    def _post(self):
+        response = receive_inbound_email(self.factory.post('/inbound/', data=sendgrid_payload))
+        self.assertContains(response, "Successfully spooled", status_code=200)
+
+    def test_spool_and_process(self):
+        self._post()
+        self._post()
+        self.assertEqual(self.received, [])
+
+        seal_spools()
+        call_command('process_inbound_spool', once=True)
+        self.assertEqual(len(self.received), 2)
+        self.assertIsInstance(self.received[0], EmailMultiAlternatives)
+        self.assertEqual(self.received[0].subject, sendgrid_payload['subject'])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_failed_requests_are_kept(self):
+        def on_email_received(sender, **kwargs):
+            raise ValueError("Receiver error")
+
+        self._post()
+        seal_spools()
+        email_received.connect(on_email_received)
+        try:
+            call_command('process_inbound_spool', once=True)
+        finally:
+            email_received.disconnect(on_email_received)
+
+        failed = os.listdir(self.directory)
+        self.assertEqual(len(failed), 1)
+        self.assertTrue(failed[0].endswith('.failed'))
+        records = list(iter_records(os.path.join(self.directory, failed[0])))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(deserialize_request(records[0]).POST['subject'], sendgrid_payload['subject'])
+
+    @override_settings(INBOUND_EMAIL_RESPONSE_200=False)
+    def test_error_responses_are_kept(self):
+        response = receive_inbound_email(self.factory.post('/inbound/', data={'subject': 'Hello'}))
+        self.assertContains(response, "Successfully spooled", status_code=200)
+        seal_spools()
+        call_command('process_inbound_spool', once=True)
+
+        failed = os.listdir(self.directory)
+        self.assertEqual(len(failed), 1)
+        self.assertTrue(failed[0].endswith('.failed'))
+        records = list(iter_records(os.path.join(self.directory, failed[0])))
+        self.assertEqual(deserialize_request(records[0]).POST['subject'], 'Hello')
+
+    def test_request_too_large(self):
+        get_spool().max_request_size = 10
+        response = receive_inbound_email(self.factory.post('/inbound/', data=sendgrid_payload))
+        self.assertContains(response, "too large to spool", status_code=200)
+        seal_spools()
+        self.assertEqual(os.listdir(self.directory), [])
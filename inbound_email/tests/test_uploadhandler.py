@@ -0,0 +1,105 @@
+from os import path, stat
+
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+
+from ..errors import AttachmentTooLargeError
+from ..signals import email_received_unacceptable
+from ..uploadhandler import (
+    AttachmentSizeLimitUploadHandler,
+    get_rejected_files,
+    install_upload_handler,
+)
+from ..views import receive_inbound_email
+
+from .test_files.sendgrid_post import test_inbound_payload as sendgrid_payload
+
+SENDGRID_REQUEST_PARSER = "inbound_email.backends.sendgrid.SendGridRequestParser"
+
+
+class AttachmentSizeLimitUploadHandlerTests(TestCase):
+    """Tests for skipping oversized files during the upload."""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.test_upload_txt = path.join(path.dirname(__file__), 'test_files/test_upload_file.txt')
+        self.test_upload_png = path.join(path.dirname(__file__), 'test_files/test_upload_file.jpg')
+        self.txt_size = stat(self.test_upload_txt).st_size
+        self.png_size = stat(self.test_upload_png).st_size
+
+    def _post(self):
+        data = sendgrid_payload.copy()
+        data['attachment1'] = open(self.test_upload_txt, 'rb')
+        data['attachment2'] = open(self.test_upload_png, 'rb')
+        request = self.factory.post('/', data=data)
+        data['attachment1'].close()
+        data['attachment2'].close()
+        return request
+
+    def test_oversized_files_are_skipped(self):
+        request = self._post()
+        handler = install_upload_handler(request, max_size=self.txt_size)
+        self.assertIsInstance(handler, AttachmentSizeLimitUploadHandler)
+        self.assertEqual(list(request.FILES.keys()), ['attachment1'])
+        self.assertEqual(request.POST['subject'], sendgrid_payload['subject'])
+
+        rejected = get_rejected_files(request)
+        self.assertEqual(len(rejected), 1)
+        self.assertEqual(rejected[0].field_name, 'attachment2')
+        self.assertEqual(rejected[0].file_name, 'test_upload_file.jpg')
+        self.assertEqual(rejected[0].content_type, 'image/jpeg')
+        self.assertGreater(rejected[0].size, self.txt_size)
+
+    def test_content_length(self):
+        """Test that a file is skipped if its part's Content-Length is too large."""
+        body = (
+            b'--BoUnDaRy\r\n'
+            b'Content-Disposition: form-data; name="a1"; filename="a1.txt"\r\n'
+            b'Content-Type: text/plain\r\n'
+            b'\r\n'
+            b'first\r\n'
+            b'--BoUnDaRy\r\n'
+            b'Content-Disposition: form-data; name="a2"; filename="a2.txt"\r\n'
+            b'Content-Type: text/plain\r\n'
+            b'Content-Length: 1000\r\n'
+            b'\r\n'
+            b'second\r\n'
+            b'--BoUnDaRy--\r\n'
+        )
+        request = self.factory.generic(
+            'POST', '/', data=body, content_type='multipart/form-data; boundary=BoUnDaRy'
+        )
+        install_upload_handler(request, max_size=100)
+        self.assertEqual(list(request.FILES.keys()), ['a1'])
+        # the file before the skipped one is still open
+        self.assertFalse(request.FILES['a1'].closed)
+        self.assertEqual(request.FILES['a1'].read(), b'first')
+        rejected = get_rejected_files(request)
+        self.assertEqual([(r.field_name, r.size) for r in rejected], [('a2', 1000)])
+
+    def test_no_handler(self):
+        request = self._post()
+        self.assertEqual(len(request.FILES), 2)
+        self.assertEqual(get_rejected_files(request), [])
+
+    def test_view_email_received_unacceptable(self):
+        """Test the rest of the email is sent with email_received_unacceptable."""
+        received = []
+
+        def on_email_received_unacceptable(sender, **kwargs):
+            received.append((kwargs['email'], kwargs['exception']))
+
+        email_received_unacceptable.connect(on_email_received_unacceptable)
+        with override_settings(
+            INBOUND_EMAIL_PARSER=SENDGRID_REQUEST_PARSER,
+            INBOUND_EMAIL_ATTACHMENT_SIZE_MAX=self.txt_size,
+        ):
+            response = receive_inbound_email(self._post())
+        email_received_unacceptable.disconnect(on_email_received_unacceptable)
+
+        self.assertEqual(response.status_code, 200)
+        email, exception = received[0]
+        self.assertIsInstance(exception, AttachmentTooLargeError)
+        self.assertEqual(exception.filename, 'test_upload_file.jpg')
+        self.assertEqual(email.subject, sendgrid_payload['subject'])
+        self.assertEqual([a[0] for a in email.attachments], ['test_upload_file.txt'])
@@ -1,17 +1,26 @@
+import json
+import threading
 from os import path
+from unittest import mock, skipUnless
 
+import django
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
 from django.test import TestCase, override_settings
 from django.test.client import RequestFactory
 from django.urls import reverse
 
+try:
+    from asgiref.sync import async_to_sync
+except ImportError:  # Django < 3.0
+    async_to_sync = None
+
 from ..errors import (
     AttachmentTooLargeError,
     AuthenticationError,
 )
-from ..signals import email_received, email_received_unacceptable
-from ..views import receive_inbound_email, _log_request
+from ..signals import email_envelope_received, email_received, email_received_unacceptable
+from ..views import receive_inbound_email, receive_inbound_email_async, _log_request
 
 from .test_files.sendgrid_post import test_inbound_payload as sendgrid_payload
 from .test_files.mailgun_post import test_inbound_payload as mailgun_payload
@@ -62,6 +71,31 @@ class ViewFunctionTests(TestCase):
             request = self.factory.post(self.url, data=payload)
             _log_request(request)
 
+    def test_log_inbound_requests_truncated(self):
+        """Test that long POST values are truncated in the log."""
+        request = self.factory.post(self.url, data={'html': 'x' * 100, 'to': 'a@b.com'})
+        with override_settings(INBOUND_EMAIL_LOG_REQUESTS_MAX_FIELD_SIZE=10):
+            with self.assertLogs('inbound_email.views', 'DEBUG') as logs:
+                _log_request(request)
+        self.assertEqual(len(logs.records), 1)
+        summary = logs.records[0].inbound_email_request.as_dict()
+        self.assertIn(('html', 'xxxxxxxxxx... (100 chars)'), summary['post'])
+        self.assertIn(('to', 'a@b.com'), summary['post'])
+        self.assertIn("- POST['html']='xxxxxxxxxx... (100 chars)'", logs.output[0])
+
+    def test_log_inbound_requests_sampled(self):
+        """Test that only the sampled requests are logged."""
+        request = self.factory.post(self.url, data=sendgrid_payload)
+        with mock.patch('inbound_email.views.logger') as logger:
+            logger.isEnabledFor.return_value = True
+            with override_settings(INBOUND_EMAIL_LOG_REQUESTS_SAMPLE_RATE=0):
+                _log_request(request)
+            logger.debug.assert_not_called()
+            # ...and nothing is logged if debug logging is disabled
+            logger.isEnabledFor.return_value = False
+            _log_request(request)
+            logger.debug.assert_not_called()
+
     def test_inbound_request_HEAD_200(self):
         """Return 200 OK to a HEAD request."""
         request = self.factory.head(self.url)
@@ -92,6 +126,48 @@ class ViewFunctionTests(TestCase):
         response = receive_inbound_email(request)
         self.assertContains(response, "Unable to parse", status_code=400)
 
+    @override_settings(
+        INBOUND_EMAIL_PARSER='inbound_email.backends.sendgrid.SendGridRawRequestParser',
+        DATA_UPLOAD_MAX_MEMORY_SIZE=1000,
+    )
+    def test_raw_message_too_large(self):
+        """Test that a raw message larger than DATA_UPLOAD_MAX_MEMORY_SIZE is a parse error."""
+        with override_settings(INBOUND_EMAIL_RESPONSE_200=True):
+            request = self.factory.post(self.url, data={'email': 'x' * 1001})
+            response = receive_inbound_email(request)
+        self.assertContains(response, "too large to parse", status_code=200)
+        with override_settings(INBOUND_EMAIL_RESPONSE_200=False):
+            request = self.factory.post(self.url, data={'email': 'x' * 1001})
+            response = receive_inbound_email(request)
+        self.assertContains(response, "too large to parse", status_code=400)
+
+    @override_settings(INBOUND_EMAIL_PARSER=MANDRILL_REQUEST_PARSER)
+    def test_parse_error_after_dispatch_response_200(self):
+        """Test that a batch isn't retried once any of its emails have been dispatched."""
+        settings.INBOUND_EMAIL_RESPONSE_200 = False
+        received = []
+
+        def on_email_received(sender, **kwargs):
+            received.append(kwargs['email'])
+
+        first = json.loads(mandrill_payload['mandrill_events'])[0]
+        email_received.connect(on_email_received)
+        try:
+            # the batch is valid until after the first event
+            request = self.factory.post(self.url, data={
+                'mandrill_events': '[%s, this is not json]' % json.dumps(first)
+            })
+            response = receive_inbound_email(request)
+            self.assertContains(response, "Unable to parse", status_code=200)
+            self.assertEqual(len(received), 1)
+
+            # but if none were dispatched, the provider should retry it
+            request = self.factory.post(self.url, data={'mandrill_events': '[this is not json]'})
+            response = receive_inbound_email(request)
+            self.assertContains(response, "Unable to parse", status_code=400)
+        finally:
+            email_received.disconnect(on_email_received)
+
     def test_email_received_signal(self):
         """Test that a valid POST fires the email_received signal."""
         # define handler
@@ -180,3 +256,122 @@ class ViewFunctionTests(TestCase):
         receive_inbound_email(request)
         self.assertTrue(self.on_email_received_fired, parser)
         email_received_unacceptable.disconnect(on_email_received)
+
+
+@skipUnless(django.VERSION >= (3, 1), "async views require Django 3.1")
+class AsyncViewFunctionTests(TestCase):
+    """Tests for the async view function receive_inbound_email_async."""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.url = reverse('receive_inbound_email')
+        self.view = async_to_sync(receive_inbound_email_async)
+
+    def test_inbound_request_HEAD_200(self):
+        response = self.view(self.factory.head(self.url))
+        self.assertEqual(response.status_code, 200)
+
+    def test_inbound_request_GET_405(self):
+        response = self.view(self.factory.get(self.url))
+        self.assertEqual(response.status_code, 405)
+
+    def test_email_received_signal(self):
+        for klass, payload in (
+            (MANDRILL_REQUEST_PARSER, mandrill_payload),
+            (SENDGRID_REQUEST_PARSER, sendgrid_payload),
+            (MAILGUN_REQUEST_PARSER, mailgun_payload),
+        ):
+            received = []
+
+            def on_email_received(sender, **kwargs):
+                received.append(kwargs['email'])
+
+            email_received.connect(on_email_received)
+            with override_settings(INBOUND_EMAIL_PARSER=klass):
+                response = self.view(self.factory.post(self.url, data=payload))
+            email_received.disconnect(on_email_received)
+            self.assertContains(response, "Successfully parsed", status_code=200)
+            self.assertTrue(received, klass)
+            for email in received:
+                self.assertIsInstance(email, EmailMultiAlternatives)
+
+    @override_settings(INBOUND_EMAIL_PARSER=SENDGRID_REQUEST_PARSER)
+    def test_parse_closes_connections(self):
+        """Test that the executor thread closes any connections opened by the parser's signals."""
+        threads = []
+
+        def on_envelope_received(sender, **kwargs):
+            threads.append(threading.current_thread())
+
+        def on_close_old_connections():
+            threads.append(threading.current_thread())
+
+        email_envelope_received.connect(on_envelope_received)
+        try:
+            with mock.patch(
+                'inbound_email.backends.close_old_connections',
+                side_effect=on_close_old_connections
+            ):
+                response = self.view(self.factory.post(self.url, data=sendgrid_payload))
+        finally:
+            email_envelope_received.disconnect(on_envelope_received)
+        self.assertContains(response, "Successfully parsed", status_code=200)
+        # closed before and after the receiver, in the same thread
+        self.assertEqual(len(threads), 5)
+        self.assertEqual(len(set(threads[:3])), 1)
+
+    @override_settings(INBOUND_EMAIL_PARSER=MANDRILL_REQUEST_PARSER, INBOUND_EMAIL_RESPONSE_200=False)
+    def test_batch_is_dispatched_as_it_is_parsed(self):
+        """Test that each email in a batch is dispatched before the next is parsed."""
+        received = []
+
+        def on_email_received(sender, **kwargs):
+            received.append(kwargs['email'])
+
+        first = json.loads(mandrill_payload['mandrill_events'])[0]
+        email_received.connect(on_email_received)
+        try:
+            request = self.factory.post(self.url, data={
+                'mandrill_events': '[%s, this is not json]' % json.dumps(first)
+            })
+            response = self.view(request)
+        finally:
+            email_received.disconnect(on_email_received)
+        # the first email was dispatched, so the batch mustn't be retried
+        self.assertContains(response, "Unable to parse", status_code=200)
+        self.assertEqual(len(received), 1)
+
+    @override_settings(INBOUND_EMAIL_PARSER=SENDGRID_REQUEST_PARSER, INBOUND_EMAIL_RESPONSE_200=False)
+    def test_parse_error_response_400(self):
+        response = self.view(self.factory.post(self.url, data={}))
+        self.assertContains(response, "Unable to parse", status_code=400)
+
+    @override_settings(
+        INBOUND_EMAIL_PARSER='inbound_email.backends.sendgrid.SendGridRawRequestParser',
+        DATA_UPLOAD_MAX_MEMORY_SIZE=1000,
+        INBOUND_EMAIL_RESPONSE_200=True,
+    )
+    def test_raw_message_too_large(self):
+        response = self.view(self.factory.post(self.url, data={'email': 'x' * 1001}))
+        self.assertContains(response, "too large to parse", status_code=200)
+
+    @override_settings(
+        INBOUND_EMAIL_PARSER=MANDRILL_REQUEST_PARSER,
+        INBOUND_MANDRILL_AUTHENTICATION_KEY='mandrill_key',
+    )
+    def test_email_received_unacceptable_signal(self):
+        exceptions = []
+
+        def on_email_received_unacceptable(sender, **kwargs):
+            exceptions.append(kwargs['exception'])
+
+        email_received_unacceptable.connect(on_email_received_unacceptable)
+        request = self.factory.post(
+            self.url,
+            data=mandrill_payload,
+            HTTP_X_MANDRILL_SIGNATURE='invalid_signature',
+        )
+        response = self.view(request)
+        email_received_unacceptable.disconnect(on_email_received_unacceptable)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsInstance(exceptions[0], AuthenticationError)
@@ -0,0 +1,79 @@
+"""Upload handler that enforces the attachment size limit during the upload.
+
+Without this, Django's multipart parser writes each uploaded file to memory
+(or a temporary file) in full, before the backend parser ever gets the chance
+to check the size of it.
+"""
+from collections import namedtuple
+
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+
+# details of a file that was skipped because it was too large
+RejectedFile = namedtuple('RejectedFile', 'field_name file_name content_type size')
+
+
+class AttachmentSizeLimitUploadHandler(FileUploadHandler):
+    """Skips any uploaded file that is larger than max_size as it arrives.
+
+    This must be the first upload handler, so that the rest of an oversized
+    file is discarded before it reaches the handlers that store it. Details
+    of the skipped files are kept in `rejected`, and the rest of the request
+    is parsed as normal.
+    """
+
+    def __init__(self, request=None, max_size=None):
+        super(AttachmentSizeLimitUploadHandler, self).__init__(request)
+        self.max_size = max_size
+        self.rejected = []
+        self._declared_size = None
+
+    def _reject(self, size):
+        self.rejected.append(
+            RejectedFile(self.field_name, self.file_name, self.content_type, size)
+        )
+        raise SkipFile()
+
+    def new_file(self, field_name, file_name, content_type, content_length, *args, **kwargs):
+        super(AttachmentSizeLimitUploadHandler, self).new_file(
+            field_name, file_name, content_type, content_length, *args, **kwargs
+        )
+        # NB SkipFile can't be raised here, as the multipart parser would
+        # then close the previous file, before the next handlers' new_file
+        # has been called - so it's raised on the first chunk instead
+        if content_length is not None and content_length > self.max_size:
+            self._declared_size = content_length
+        else:
+            self._declared_size = None
+
+    def receive_data_chunk(self, raw_data, start):
+        if self._declared_size is not None:
+            self._reject(self._declared_size)
+        size = start + len(raw_data)
+        if size > self.max_size:
+            # NB this is the number of bytes received so far, not the file size
+            self._reject(size)
+        return raw_data
+
+    def file_complete(self, file_size):
+        # the file is stored by the next handler
+        return None
+
+
+def install_upload_handler(request, max_size):
+    """Add an AttachmentSizeLimitUploadHandler to the request.
+
+    This must be called before request.POST or request.FILES are accessed.
+    """
+    handler = AttachmentSizeLimitUploadHandler(request, max_size=max_size)
+    request.upload_handlers.insert(0, handler)
+    return handler
+
+
+def get_rejected_files(request):
+    """Return the list of RejectedFiles that were skipped during the upload."""
+    return [
+        rejected
+        for handler in request.upload_handlers
+        if isinstance(handler, AttachmentSizeLimitUploadHandler)
+        for rejected in handler.rejected
+    ]
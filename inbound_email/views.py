@@ -1,91 +1,177 @@
 # -*- coding: utf-8 -*-
 import logging
+import random
 
 from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
 from django.core.mail import EmailMultiAlternatives
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotAllowed
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:  # Django < 3.0
+    sync_to_async = None
+
+from . import metrics
 from .backends import get_backend_instance
+from .dispatch import get_dispatcher
 from .errors import (
     RequestParseError,
+    RequestTooLargeError,
     AttachmentTooLargeError,
     AuthenticationError,
 )
-from .signals import email_received, email_received_unacceptable
+from .message import InboundEmail
+from .signals import email_received_unacceptable
+from .spool import get_spool
+from .uploadhandler import install_upload_handler
 
 
 logger = logging.getLogger(__name__)
 log_requests = getattr(settings, 'INBOUND_EMAIL_LOG_REQUESTS', False)
 
 
-def _log_request(request):
-    """Helper function to dump out debug info."""
-    logger.debug("Inbound email received")
+def _truncate(value, max_size):
+    if max_size is None or len(value) <= max_size:
+        return value
+    return "%s... (%s chars)" % (value[:max_size], len(value))
 
-    for k, v in list(request.POST.items()):
-        logger.debug("- POST['%s']='%s'" % (k, v))
 
-    for n, f in list(request.FILES.items()):
-        logger.debug("- FILES['%s']: '%s', %sB", n, f.content_type, f.size)
+class _RequestSummary(object):
+    """The POST and FILES of a request, formatted (and truncated) for logging.
 
+    Nothing is formatted until the log record is actually emitted, and
+    structured log handlers can use `as_dict()` (the record's
+    `inbound_email_request` attribute) rather than the message.
+    """
 
-@require_http_methods(["HEAD", "POST"])
-@csrf_exempt
-def receive_inbound_email(request):
-    """Receives inbound email from SendGrid.
+    def __init__(self, request, max_size):
+        self.request = request
+        self.max_size = max_size
+
+    def as_dict(self):
+        return {
+            'post': [
+                (k, _truncate(v, self.max_size))
+                for k, values in self.request.POST.lists()
+                for v in values
+            ],
+            'files': [
+                (n, f.name, f.content_type, f.size)
+                for n, f in self.request.FILES.items()
+            ],
+        }
+
+    def __str__(self):
+        summary = self.as_dict()
+        lines = ["- POST['%s']='%s'" % field for field in summary['post']]
+        lines += ["- FILES['%s']: '%s', '%s', %sB" % f for f in summary['files']]
+        return '\n'.join(lines)
 
-    This view receives the email from SendGrid, parses the contents, logs
-    the message and the fires the inbound_email signal.
 
+def _log_request(request):
+    """Helper function to dump out debug info.
+
+    Each POST value is truncated to INBOUND_EMAIL_LOG_REQUESTS_MAX_FIELD_SIZE
+    characters (default=1024, None for no limit), and only a fraction of the
+    requests, INBOUND_EMAIL_LOG_REQUESTS_SAMPLE_RATE (default=1.0), are logged.
     """
-    # log the request.POST and request.FILES contents
-    if log_requests is True:
-        _log_request(request)
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    sample_rate = getattr(settings, 'INBOUND_EMAIL_LOG_REQUESTS_SAMPLE_RATE', 1.0)
+    if sample_rate < 1 and random.random() >= sample_rate:
+        return
 
-    # HEAD requests are used by some backends to validate the route
-    if request.method == 'HEAD':
-        return HttpResponse('OK')
+    summary = _RequestSummary(
+        request,
+        max_size=getattr(settings, 'INBOUND_EMAIL_LOG_REQUESTS_MAX_FIELD_SIZE', 1024),
+    )
+    logger.debug(
+        "Inbound email received:\n%s", summary,
+        extra={'inbound_email_request': summary}
+    )
 
-    try:
-        # clean up encodings and extract relevant fields from request.POST
-        backend = get_backend_instance()
-        emails = backend.parse(request)
-
-        # backend.parse can return either an EmailMultiAlternatives
-        # or a list of those
-        if emails:
-            if isinstance(emails, EmailMultiAlternatives):
-                emails = [emails]
-            for email in emails:
-                # fire the signal for each email
-                email_received.send(sender=backend.__class__, email=email, request=request)
-
-    except AttachmentTooLargeError as ex:
-        logger.exception(ex)
-        email_received_unacceptable.send(
-            sender=backend.__class__,
-            email=ex.email,
-            request=request,
-            exception=ex
-        )
-    except AuthenticationError as ex:
-        logger.exception(ex)
-        email_received_unacceptable.send(
-            sender=backend.__class__,
-            email=None,
-            request=request,
-            exception=ex
-        )
 
-    except RequestParseError as ex:
-        logger.exception(ex)
+def _load_post(request):
+    """Parse the multipart body into request.POST and request.FILES."""
+    request.POST, request.FILES
+
+
+def _dispatch_email(backend, request, email):
+    """Hand a parsed email to the dispatcher, to fire the signal."""
+    metrics.incr('emails')
+    metrics.incr('attachments', len(email.attachments))
+    # fire the signal for each email (possibly in the background)
+    with metrics.timer('dispatch'):
+        get_dispatcher().dispatch(sender=backend.__class__, email=email, request=request)
+    # only now is the email recorded for dedupe, so that it is received
+    # again if the provider retries it after an error
+    backend.received(request, email)
+
+
+def _dispatch_emails(backend, request, emails):
+    """Hand each parsed email to the dispatcher, to fire the signal."""
+    # backend.parse can return either an EmailMultiAlternatives
+    # or a list of those
+    if isinstance(emails, (EmailMultiAlternatives, InboundEmail)):
+        emails = [emails]
+    emails = iter(emails or [])
+    dispatched = 0
+    while True:
+        # emails may be parsed lazily, so time each one separately
+        try:
+            with metrics.timer('parse'):
+                email = next(emails, None)
+        except RequestParseError as ex:
+            # the earlier emails in a batch have already been dispatched, so
+            # _handle_error mustn't make the provider retry them
+            ex.dispatched = dispatched
+            raise
+        if email is None:
+            break
+        _dispatch_email(backend, request, email)
+        dispatched += 1
+
+
+async def _adispatch_emails(backend, request, emails):
+    """Async version of _dispatch_emails, for an async iterator of emails."""
+    dispatched = 0
+    while True:
+        try:
+            with metrics.timer('parse'):
+                email = await emails.__anext__()
+        except StopAsyncIteration:
+            break
+        except RequestParseError as ex:
+            ex.dispatched = dispatched
+            raise
+        await sync_to_async(_dispatch_email)(backend, request, email)
+        dispatched += 1
+
+
+def _handle_error(backend, request, ex):
+    """Handle an error raised during parsing, and return the response."""
+    logger.exception(ex)
+    metrics.record_failure(ex)
+
+    if isinstance(ex, RequestDataTooBig):
+        # a POST field (e.g. a raw MIME message) was larger than
+        # DATA_UPLOAD_MAX_MEMORY_SIZE - Django would respond with a 400, and
+        # the provider would keep retrying it
+        ex = RequestParseError("Inbound request is too large to parse: %s" % ex)
+
+    if isinstance(ex, RequestParseError):
         if getattr(settings, 'INBOUND_EMAIL_RESPONSE_200', True):
             # NB even if we have a problem, always use HTTP_STATUS=200, as
             # otherwise the email service will continue polling us with the email.
             # This is the default behaviour.
             status_code = 200
+        elif getattr(ex, 'dispatched', 0):
+            # part of a batch was dispatched before the error, and a retry
+            # would dispatch those emails again
+            status_code = 200
         else:
             status_code = 400
 
@@ -94,4 +180,138 @@ def receive_inbound_email(request):
             status=status_code
         )
 
+    email_received_unacceptable.send(
+        sender=backend.__class__,
+        email=getattr(ex, 'email', None),
+        request=request,
+        exception=ex
+    )
     return HttpResponse("Successfully parsed inbound email.", status=200)
+
+
+def _spool_request(spool, backend, request):
+    """Authenticate the request and append it to the spool, returning the response."""
+    try:
+        # the body is buffered first, so that it can still be spooled after
+        # authenticate has read it (or request.POST)
+        with spool.buffer(request) as body:
+            # unauthenticated requests aren't worth spooling
+            backend.authenticate(request)
+            spool.append(request, body)
+    except (AuthenticationError, RequestTooLargeError, RequestDataTooBig) as ex:
+        return _handle_error(backend, request, ex)
+    return HttpResponse("Successfully spooled inbound email.", status=200)
+
+
+def process_inbound_request(request):
+    """Parse the request and fire the signals, returning the response.
+
+    This is the body of receive_inbound_email, and is also used to process
+    the requests in the spool (see the process_inbound_spool command).
+
+    """
+    backend = get_backend_instance()
+
+    # skip oversized attachments while they are being uploaded - this must
+    # happen before anything reads request.POST or request.FILES
+    install_upload_handler(request, max_size=backend.max_file_size)
+
+    with metrics.collect(backend.__class__):
+        metrics.incr('bytes', int(request.META.get('CONTENT_LENGTH') or 0))
+        try:
+            backend.authenticate(request)
+        except (AuthenticationError, RequestDataTooBig) as ex:
+            return _handle_error(backend, request, ex)
+
+        try:
+            with metrics.timer('multipart'):
+                _load_post(request)
+        except RequestDataTooBig as ex:
+            return _handle_error(backend, request, ex)
+
+        # log the request.POST and request.FILES contents
+        if log_requests is True:
+            _log_request(request)
+
+        try:
+            # clean up encodings and extract relevant fields from request.POST;
+            # each email is dispatched as soon as it has been parsed
+            _dispatch_emails(backend, request, backend.iter_parse(request))
+        except (RequestParseError, AttachmentTooLargeError, AuthenticationError) as ex:
+            return _handle_error(backend, request, ex)
+
+        return HttpResponse("Successfully parsed inbound email.", status=200)
+
+
+@require_http_methods(["HEAD", "POST"])
+@csrf_exempt
+def receive_inbound_email(request):
+    """Receives inbound email from SendGrid.
+
+    This view receives the email from SendGrid, parses the contents, logs
+    the message and the fires the inbound_email signal - or, if the spool is
+    enabled, just saves the request to be processed later.
+
+    """
+    # HEAD requests are used by some backends to validate the route
+    if request.method == 'HEAD':
+        return HttpResponse('OK')
+
+    spool = get_spool()
+    if spool is not None:
+        return _spool_request(spool, get_backend_instance(), request)
+
+    return process_inbound_request(request)
+
+
+async def receive_inbound_email_async(request):
+    """Async version of receive_inbound_email, for use under ASGI.
+
+    The parsing is run in an executor by RequestParser.aiter_parse, and the
+    signals are sent via sync_to_async, so that the event loop is never
+    blocked and a single worker can handle many concurrent requests.
+
+    Requires Django 3.1 or above.
+
+    """
+    if request.method not in ("HEAD", "POST"):
+        return HttpResponseNotAllowed(["HEAD", "POST"])
+
+    if request.method == 'HEAD':
+        return HttpResponse('OK')
+
+    backend = get_backend_instance()
+    spool = get_spool()
+    if spool is not None:
+        return await sync_to_async(_spool_request)(spool, backend, request)
+
+    install_upload_handler(request, max_size=backend.max_file_size)
+
+    with metrics.collect(backend.__class__):
+        metrics.incr('bytes', int(request.META.get('CONTENT_LENGTH') or 0))
+        try:
+            await sync_to_async(backend.authenticate)(request)
+        except (AuthenticationError, RequestDataTooBig) as ex:
+            return await sync_to_async(_handle_error)(backend, request, ex)
+
+        try:
+            # NB parsing the multipart body is CPU-bound, so it isn't run in
+            # the (single) thread that sync_to_async uses by default
+            with metrics.timer('multipart'):
+                await sync_to_async(_load_post, thread_sensitive=False)(request)
+        except RequestDataTooBig as ex:
+            return await sync_to_async(_handle_error)(backend, request, ex)
+
+        if log_requests is True:
+            await sync_to_async(_log_request)(request)
+
+        try:
+            await _adispatch_emails(backend, request, backend.aiter_parse(request))
+        except (RequestParseError, AttachmentTooLargeError, AuthenticationError) as ex:
+            return await sync_to_async(_handle_error)(backend, request, ex)
+
+        return HttpResponse("Successfully parsed inbound email.", status=200)
+
+
+# csrf_exempt and require_http_methods don't support async views before Django 5.0
+receive_inbound_email_async.csrf_exempt = True
@@ -10,7 +10,13 @@ setup(
     name='django-inbound-email',
     version='0.12',
     packages=find_packages(),
+    # contextvars, and ProcessPoolExecutor's initializer, need Python 3.7
+    python_requires='>=3.7',
     install_requires=['Django>=1.11'],
+    extras_require={
+        # for INBOUND_SENDGRID_VERIFICATION_KEY
+        'sendgrid': ['cryptography'],
+    },
     include_package_data=True,
     description='A Django app for receiving inbound emails.',
     license='MIT',
@@ -29,7 +35,9 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
     ],